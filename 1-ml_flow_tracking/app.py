@@ -16,6 +16,8 @@ from sklearn.metrics import  mean_squared_error, mean_absolute_percentage_error,
 from sklearn.linear_model import LinearRegression
 #import joblib
 
+from training_profile import profile_from_frame, log_profile
+
 
 if __name__ == "__main__":
     ### MLFLOW Experiment setup
@@ -76,6 +78,9 @@ if __name__ == "__main__":
         model.fit(X_train, Y_train)
         predictions = model.predict(X_train)
 
+        # Most frequent categories... read by the API with the model
+        log_profile(profile_from_frame(X_train, predictions))
+
         # Log model seperately to have more flexibility on setup 
         mlflow.sklearn.log_model(sk_model=model, 
             artifact_path="pricing_getaround", 
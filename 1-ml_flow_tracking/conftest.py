@@ -0,0 +1,48 @@
+# Fixtures shared by the tests of the training scripts: the pricing dataset and the Pipeline of app.py
+import os
+
+import pandas as pd
+import pytest
+
+
+PRICING_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), "get_around_pricing_project.csv")
+
+
+def fit_pricing_pipeline(X, Y, handle_unknown="error"):
+    # Same Pipeline as app.py
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import OneHotEncoder, StandardScaler
+    from sklearn.compose import ColumnTransformer
+    from sklearn.linear_model import LinearRegression
+
+    categorical_features = X.select_dtypes("object").columns
+    numerical_features = X.columns[~X.columns.isin(categorical_features)]
+    preprocessor = ColumnTransformer(
+        transformers=[
+            ("categorical_transformer", OneHotEncoder(drop='first', handle_unknown=handle_unknown, sparse_output=False), categorical_features),
+            ("numerical_transformer", StandardScaler(), numerical_features)
+        ]
+    )
+    return Pipeline(steps=[("features_preprocessing", preprocessor), ("reg", LinearRegression())]).fit(X, Y)
+
+
+@pytest.fixture(scope="session")
+def pricing_csv():
+    return PRICING_CSV
+
+
+@pytest.fixture(scope="session")
+def pricing_data():
+    # Whole dataset, features and rental_price_per_day (not to be modified by the tests)
+    return pd.read_csv(PRICING_CSV, index_col=0)
+
+
+@pytest.fixture(scope="session")
+def pricing(pricing_data):
+    # (features, rental_price_per_day)
+    return pricing_data.drop(columns="rental_price_per_day"), pricing_data["rental_price_per_day"]
+
+
+@pytest.fixture(scope="session")
+def fit_pipeline():
+    return fit_pricing_pipeline
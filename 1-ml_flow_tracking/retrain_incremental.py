@@ -0,0 +1,185 @@
+# Incremental retraining of the pricing model
+# Instead of training again on the whole dataset, the statistics of the last model (sufficient_stats.npz,
+# logged by train_streaming.py or by a previous incremental run) are updated with the rows added since its
+# watermark, and the linear regression is solved again: seconds, whatever the size of the history.
+# - rows with a watermark (row index, or --watermark-column) above the last one are added
+# - a row with sign = -1 (optional "sign" column of the source) is removed: a changed row is sent twice,
+#   its old values with sign -1 and its new values with sign 1 (with a --watermark-column such as an update
+#   date given to train_streaming.py, so that rows keep their index and stay in the same train / test set)
+# - categories seen in less than --min-category-count rows are merged into "__other__". Unknown categories
+#   still make the model fail (handle_unknown='error', as app.py): ignoring them would encode them as the
+#   dropped reference category and price them as it. The API replaces them first, e.g. by "__other__"
+#   (UNKNOWN_CATEGORY_POLICY, see 2-API/category_validation.py)
+# The new statistics (with the new watermark) are logged with the model, registered as lin_reg.
+#
+# Terminal command : python retrain_incremental.py --source new_rentals.csv [--min-category-count 5]
+import os
+import time
+import argparse
+import tempfile
+
+import numpy as np
+import mlflow
+
+from mlflow.models.signature import infer_signature
+
+from sufficient_stats import SufficientStats, build_pipeline, CATEGORICAL_FEATURES, BOOLEAN_FEATURES, FEATURES
+from train_streaming import read_chunks, test_mask, watermark_of, to_json_value
+from training_profile import profile_from_stats, log_profile
+
+
+STATS_ARTIFACT = "sufficient_stats.npz"
+
+
+def latest_stats_run(client, model_name="lin_reg"):
+    """
+    Run of the most recent version of the model that has statistics (versions registered by app.py or
+    sweep.py have none).
+    """
+    versions = sorted(client.search_model_versions(f"name='{model_name}'"), key=lambda version: int(version.version), reverse=True)
+    for version in versions:
+        if any(artifact.path == STATS_ARTIFACT for artifact in client.list_artifacts(version.run_id)):
+            return version.run_id
+    raise RuntimeError(f"No version of {model_name} has {STATS_ARTIFACT}: train it once with train_streaming.py")
+
+
+def load_base_stats(base_run_id=None):
+    """
+    Returns (stats, metadata, run id) of the statistics to update.
+    """
+    client = mlflow.tracking.MlflowClient()
+    run_id = base_run_id or latest_stats_run(client)
+    path = mlflow.artifacts.download_artifacts(run_id=run_id, artifact_path=STATS_ARTIFACT)
+    stats, metadata = SufficientStats.load(path)
+    return stats, metadata, run_id
+
+
+def apply_delta(stats, source, chunksize, watermark, watermark_column, test_fraction):
+    """
+    Adds / removes the rows of the source above the watermark. Test rows are kept out of the statistics
+    (same hash as train_streaming.py) and returned to compare the old and the new model on them.
+    Returns (nb rows added, nb rows removed, new watermark, test rows, first chunk).
+    """
+    nb_added = nb_removed = 0
+    new_watermark = None
+    test_chunks, first_chunk = [], None
+    for chunk in read_chunks(source, chunksize):
+        values = chunk.index if watermark_column is None else chunk[watermark_column]
+        if watermark is not None:
+            chunk = chunk[np.asarray(values > watermark)]
+        if chunk.empty:
+            continue
+        first_chunk = chunk if first_chunk is None else first_chunk
+        chunk_watermark = watermark_of(chunk, watermark_column)
+        if new_watermark is None or chunk_watermark > new_watermark:
+            new_watermark = chunk_watermark
+
+        in_test = test_mask(chunk.index, test_fraction)
+        if in_test.any():
+            test_chunks.append(chunk[in_test])
+        chunk = chunk[~in_test]
+        sign = chunk["sign"].to_numpy() if "sign" in chunk.columns else np.ones(len(chunk))
+        stats.add(chunk, weight=sign)
+        nb_added += int((sign > 0).sum())
+        nb_removed += int((sign < 0).sum())
+    return nb_added, nb_removed, watermark if new_watermark is None else new_watermark, test_chunks, first_chunk
+
+
+def fit_model(stats, min_count):
+    """
+    Returns (stats with the categories seen in less than min_count rows merged into "__other__", their
+    coefficients, sklearn Pipeline). Unknown categories are refused by the Pipeline (handle_unknown='error').
+    """
+    pooled = stats.pooled(min_count)
+    coefficients = pooled.solve()
+    return pooled, coefficients, build_pipeline(pooled, coefficients)
+
+
+def test_rmse(stats, coefficients, test_chunks):
+    # RMSE of the model on the new test rows (removed rows excluded)
+    test = SufficientStats()
+    for chunk in test_chunks:
+        if "sign" in chunk.columns:
+            chunk = chunk[chunk["sign"] > 0]
+        test.add(chunk)
+    return stats.evaluate(test, coefficients)["rmse"] if test.nb_rows else None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Update the pricing model with the new rows")
+    parser.add_argument("--source", required=True, help="CSV or Parquet file with the new / changed rows")
+    parser.add_argument("--chunksize", type=int, default=100000, help="Rows read at a time")
+    parser.add_argument("--base-run", help="Run of the statistics to update (default: latest lin_reg version with statistics)")
+    parser.add_argument("--min-category-count", type=int, default=None, help="Categories seen in fewer rows are merged into __other__")
+    args = parser.parse_args()
+
+    ### MLFLOW Experiment setup
+    mlflow.set_tracking_uri(os.environ["MLFLOW_TRACKING_URI"])
+    experiment_name="rental _price"
+    mlflow.set_experiment(experiment_name)
+
+    start_time = time.time()
+    stats, metadata, base_run_id = load_base_stats(args.base_run)
+    watermark_column = metadata.get("watermark_column")
+    min_count = args.min_category_count if args.min_category_count is not None else metadata.get("min_category_count", 1)
+    test_fraction = metadata.get("test_fraction", 0.2)
+
+    # Model before the update, to compare on the new rows
+    previous = stats.pooled(min_count)
+    previous_coefficients = previous.solve()
+    vocabulary_sizes = {feature: len(stats.vocabulary[feature]) for feature in CATEGORICAL_FEATURES}
+
+    nb_added, nb_removed, watermark, test_chunks, first_chunk = apply_delta(
+        stats, args.source, args.chunksize, metadata.get("watermark"), watermark_column, test_fraction)
+    if nb_added + nb_removed == 0:
+        print(f"No rows after watermark {metadata.get('watermark')}, nothing to retrain")
+        raise SystemExit(0)
+
+    pooled, coefficients, model = fit_model(stats, min_count)
+    update_time = time.time() - start_time
+
+    with mlflow.start_run(run_name="incremental"):
+        mlflow.log_params({
+            "source": args.source,
+            "base_run_id": base_run_id,
+            "stats_version": metadata.get("stats_version", 1) + 1,
+            "watermark_from": metadata.get("watermark"),
+            "watermark_to": to_json_value(watermark),
+            "min_category_count": min_count,
+        })
+        metrics = {
+            "nb_rows_added": nb_added,
+            "nb_rows_removed": nb_removed,
+            "nb_train_rows": stats.nb_rows,
+            "nb_new_categories": sum(len(stats.vocabulary[feature]) - size for feature, size in vocabulary_sizes.items()),
+            "nb_pooled_categories": sum(category not in pooled.vocabulary[feature]
+                                        for feature in CATEGORICAL_FEATURES for category in stats.vocabulary[feature]),
+            "update_time": update_time,
+        }
+        metrics.update({f"train_{name}": value for name, value in pooled.evaluate(pooled, coefficients).items()})
+        rmse_before, rmse_after = test_rmse(previous, previous_coefficients, test_chunks), test_rmse(pooled, coefficients, test_chunks)
+        if rmse_after is not None:
+            metrics["delta_test_rmse_before"], metrics["delta_test_rmse_after"] = rmse_before, rmse_after
+        mlflow.log_metrics(metrics)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            stats_path = os.path.join(tmp_dir, STATS_ARTIFACT)
+            # Raw statistics (categories not merged): the next update can use another min count
+            stats.save(stats_path, **{**metadata, "stats_version": metadata.get("stats_version", 1) + 1,
+                                      "watermark": to_json_value(watermark), "min_category_count": min_count,
+                                      "base_run_id": base_run_id})
+            mlflow.log_artifact(stats_path)
+
+        log_profile(profile_from_stats(pooled))
+
+        sample = first_chunk[FEATURES].head(100).astype({feature: "object" for feature in CATEGORICAL_FEATURES})
+        sample[BOOLEAN_FEATURES] = sample[BOOLEAN_FEATURES].astype(bool)
+        mlflow.sklearn.log_model(sk_model=model,
+            artifact_path="pricing_getaround",
+            registered_model_name = "lin_reg",
+            signature=infer_signature(sample, model.predict(sample))
+            )
+
+    print(f"...Done! {nb_added} rows added, {nb_removed} removed, watermark {to_json_value(watermark)}")
+    for name, value in metrics.items():
+        print(f"---{name}: {value:.3f}")
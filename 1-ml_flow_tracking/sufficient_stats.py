@@ -0,0 +1,252 @@
+# Sufficient statistics of the linear pricing model
+# A least squares fit only needs X'X, X'y and y'y: they are accumulated chunk by chunk (any number of rows,
+# memory = size of X'X) and the regression is solved once at the end. Columns of X are the intercept,
+# the raw numerical and boolean features, and one column per category seen so far (the vocabulary grows
+# with the chunks). The scaler moments come from the same matrix (X'X row of the intercept = sums, diagonal
+# = sums of squares), so the fitted model is turned into the same sklearn Pipeline as app.py.
+import json
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+
+TARGET = "rental_price_per_day"
+CATEGORICAL_FEATURES = ["model_key", "fuel", "paint_color", "car_type"]
+NUMERICAL_FEATURES = ["mileage", "engine_power"]
+BOOLEAN_FEATURES = ["private_parking_available", "has_gps", "has_air_conditioning", "automatic_car",
+                    "has_getaround_connect", "has_speed_regulator", "winter_tires"]
+# Category replacing the categories seen in less than `min_count` rows (see SufficientStats.pooled)
+OTHER_CATEGORY = "__other__"
+
+# Order of the columns of the pricing dataset (and of the /predict endpoint)
+FEATURES = ["model_key", "mileage", "engine_power", "fuel", "paint_color", "car_type"] + BOOLEAN_FEATURES
+
+# Compact types to read the data: categories, booleans as uint8
+DTYPES = {
+    **{feature: "category" for feature in CATEGORICAL_FEATURES},
+    "mileage": "int32",
+    "engine_power": "int16",
+    **{feature: "bool" for feature in BOOLEAN_FEATURES},
+    TARGET: "float32",
+}
+
+
+class SufficientStats:
+    """
+    X'X, X'y, y'y of the rows added so far. Rows can be added with a weight (e.g. -1 to remove a row
+    added before). Column 0 is the intercept, then the numerical and boolean features (raw values),
+    then one column per (feature, category) in order of appearance.
+    """
+    def __init__(self):
+        self.numerical = [feature for feature in FEATURES if feature not in CATEGORICAL_FEATURES]
+        self.vocabulary = {feature: {} for feature in CATEGORICAL_FEATURES} # category -> column
+        self.columns = ["intercept"] + self.numerical
+        self.xtx = np.zeros((len(self.columns), len(self.columns)))
+        self.xty = np.zeros(len(self.columns))
+        self.yty = 0.0
+
+    @property
+    def nb_rows(self):
+        return self.xtx[0, 0]
+
+    def category_counts(self, feature):
+        # Number of rows of each category seen so far (diagonal of X'X)
+        return {category: self.xtx[column, column] for category, column in self.vocabulary[feature].items()}
+
+    def _columns_of(self, feature, values):
+        """
+        Column of every value of a categorical feature, new categories being added to the vocabulary.
+        """
+        values = pd.Categorical(values)
+        vocabulary = self.vocabulary[feature]
+        mapping = np.empty(len(values.categories), dtype=np.int64)
+        for code, category in enumerate(values.categories):
+            if category not in vocabulary:
+                vocabulary[category] = len(self.columns)
+                self.columns.append(f"{feature}={category}")
+            mapping[code] = vocabulary[category]
+        if (values.codes < 0).any():
+            raise ValueError(f"Missing values in {feature}")
+        return mapping[values.codes]
+
+    def design_matrix(self, chunk):
+        """
+        Sparse design matrix of a chunk: one row per car, with the intercept, the numerical values and
+        a 1 in the column of each of its categories.
+        """
+        nb_rows = len(chunk)
+        indices = [np.zeros(nb_rows, dtype=np.int64)]
+        data = [np.ones(nb_rows)]
+        for position, feature in enumerate(self.numerical, start=1):
+            indices.append(np.full(nb_rows, position, dtype=np.int64))
+            data.append(chunk[feature].to_numpy(dtype=np.float64))
+        for feature in CATEGORICAL_FEATURES:
+            indices.append(self._columns_of(feature, chunk[feature]))
+            data.append(np.ones(nb_rows))
+        nb_values = len(indices)
+        return sp.csr_matrix(
+            (np.column_stack(data).ravel(), np.column_stack(indices).ravel(), np.arange(0, nb_rows * nb_values + 1, nb_values)),
+            shape=(nb_rows, len(self.columns)))
+
+    def _grow(self):
+        # New categories: new empty rows / columns in X'X and X'y
+        size = len(self.columns)
+        if size > len(self.xty):
+            xtx = np.zeros((size, size))
+            xtx[:len(self.xty), :len(self.xty)] = self.xtx
+            self.xtx = xtx
+            self.xty = np.concatenate([self.xty, np.zeros(size - len(self.xty))])
+
+    def add(self, chunk, weight=1.0):
+        """
+        Adds the rows of a chunk (DataFrame with the features and the target). weight: one value or one per row.
+        """
+        X = self.design_matrix(chunk)
+        self._grow()
+        y = chunk[TARGET].to_numpy(dtype=np.float64)
+        weight = np.broadcast_to(np.asarray(weight, dtype=np.float64), y.shape)
+        Xw = X.multiply(weight[:, None]).tocsr()
+        self.xtx += (X.T @ Xw).toarray()
+        self.xty += Xw.T @ y
+        self.yty += float(np.dot(weight * y, y))
+        return len(chunk)
+
+    def moments(self):
+        # Mean and variance of the numerical features (as StandardScaler)
+        n = self.nb_rows
+        positions = np.arange(1, len(self.numerical) + 1)
+        mean = self.xtx[0, positions] / n
+        var = np.maximum(self.xtx[positions, positions] / n - mean ** 2, 0)
+        return mean, var
+
+    def encoder_categories(self, feature):
+        """
+        Categories of a feature, sorted as OneHotEncoder.categories_. Categories without any row
+        left (all removed) are ignored.
+        """
+        return sorted(category for category, count in self.category_counts(feature).items() if count > 0.5)
+
+    def pooled(self, min_count):
+        """
+        Stats where the categories seen in less than min_count rows are merged into OTHER_CATEGORY.
+        Summing one-hot columns of X is summing the matching rows / columns of X'X, no data is read again.
+        """
+        pooled = SufficientStats()
+        target = np.arange(len(self.columns)) # column of the pooled stats of each column
+        for feature in CATEGORICAL_FEATURES:
+            counts = self.category_counts(feature)
+            for category, column in self.vocabulary[feature].items():
+                name = category if counts[category] >= min_count else OTHER_CATEGORY
+                if name not in pooled.vocabulary[feature]:
+                    pooled.vocabulary[feature][name] = len(pooled.columns)
+                    pooled.columns.append(f"{feature}={name}")
+                target[column] = pooled.vocabulary[feature][name]
+        merge = sp.csr_matrix((np.ones(len(target)), (np.arange(len(target)), target)), shape=(len(target), len(pooled.columns)))
+        pooled.xtx = np.asarray(merge.T @ (merge.T @ self.xtx).T)
+        pooled.xty = merge.T @ self.xty
+        pooled.yty = self.yty
+        return pooled
+
+    def solve(self):
+        """
+        Least squares with the first category of each feature dropped (as OneHotEncoder(drop='first')).
+        X'X is scaled by its diagonal (Jacobi) first: raw mileages and one-hot columns differ by 10 orders
+        of magnitude. Returns the coefficients of every column (0 for the dropped categories).
+        """
+        kept = list(range(1 + len(self.numerical)))
+        for feature in CATEGORICAL_FEATURES:
+            kept += [self.vocabulary[feature][category] for category in self.encoder_categories(feature)[1:]]
+        A = self.xtx[np.ix_(kept, kept)]
+        b = self.xty[kept]
+
+        diagonal = np.diag(A).copy()
+        diagonal[diagonal <= 0] = 1
+        scaling = 1 / np.sqrt(diagonal)
+        solution, *_ = np.linalg.lstsq(A * scaling[:, None] * scaling[None, :], b * scaling, rcond=None)
+
+        coefficients = np.zeros(len(self.columns))
+        coefficients[kept] = solution * scaling
+        return coefficients
+
+    def sse(self, coefficients):
+        # Sum of squared errors of a linear model on the rows added: y'y - 2 b'X'y + b'X'X b
+        return float(self.yty - 2 * coefficients @ self.xty + coefficients @ self.xtx @ coefficients)
+
+    def evaluate(self, stats, coefficients):
+        """
+        RMSE and R2 of the coefficients fitted on these stats, on the rows of other stats (e.g. a test set),
+        matching columns by name (categories unknown by the model count as 0).
+        """
+        by_name = dict(zip(self.columns, coefficients))
+        aligned = np.array([by_name.get(column, 0.0) for column in stats.columns])
+        n = stats.nb_rows
+        sse = stats.sse(aligned)
+        sst = stats.yty - stats.xty[0] ** 2 / n
+        return {"rmse": float(np.sqrt(max(sse, 0) / n)), "r2": float(1 - sse / sst) if sst > 0 else 0.0}
+
+    def save(self, path, **metadata):
+        """
+        Saves the stats as a .npz file. metadata: JSON-serializable values kept with them.
+        """
+        np.savez(path, xtx=self.xtx, xty=self.xty, yty=self.yty,
+                 columns=json.dumps(self.columns), metadata=json.dumps(metadata))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Returns (stats, metadata) saved with save().
+        """
+        with np.load(path) as data:
+            stats = cls()
+            stats.xtx, stats.xty, stats.yty = data["xtx"], data["xty"], float(data["yty"])
+            stats.columns = json.loads(str(data["columns"]))
+            metadata = json.loads(str(data["metadata"]))
+        for column, name in enumerate(stats.columns):
+            feature, separator, category = name.partition("=")
+            if separator:
+                stats.vocabulary[feature][category] = column
+        return stats, metadata
+
+
+def build_pipeline(stats, coefficients, handle_unknown="error"):
+    """
+    sklearn Pipeline of app.py (one-hot encoding + standard scaling + linear regression) with the fitted
+    values of the stats: predictions are the same as the coefficients on raw values.
+    """
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import OneHotEncoder, StandardScaler
+    from sklearn.compose import ColumnTransformer
+    from sklearn.linear_model import LinearRegression
+
+    categories = {feature: stats.encoder_categories(feature) for feature in CATEGORICAL_FEATURES}
+    numerical_features = stats.numerical
+    preprocessor = ColumnTransformer(
+        transformers=[
+            ("categorical_transformer", OneHotEncoder(drop='first', handle_unknown=handle_unknown, sparse_output=False), CATEGORICAL_FEATURES),
+            ("numerical_transformer", StandardScaler(), numerical_features)
+        ]
+    )
+    # Fitted on a few rows holding every category, then the scaler gets the moments of all the rows
+    nb_rows = max(len(values) for values in categories.values())
+    sample = pd.DataFrame({feature: [categories[feature][i % len(categories[feature])] for i in range(nb_rows)]
+                           if feature in categories else np.zeros(nb_rows) for feature in FEATURES})
+    preprocessor.fit(sample)
+
+    mean, var = stats.moments()
+    scaler = preprocessor.named_transformers_["numerical_transformer"]
+    scaler.mean_, scaler.var_ = mean, var
+    scaler.scale_ = np.where(var > 0, np.sqrt(var), 1.0)
+    scaler.n_samples_seen_ = int(round(stats.nb_rows))
+
+    # Regression on [one-hot columns (sorted categories, first dropped), scaled numerical features]
+    weights = []
+    for feature in CATEGORICAL_FEATURES:
+        weights += [coefficients[stats.vocabulary[feature][category]] for category in categories[feature][1:]]
+    numerical_coefficients = coefficients[1:len(numerical_features) + 1]
+    regressor = LinearRegression()
+    regressor.coef_ = np.array(weights + (numerical_coefficients * scaler.scale_).tolist())
+    regressor.intercept_ = float(coefficients[0] + numerical_coefficients @ mean)
+    regressor.n_features_in_ = len(regressor.coef_)
+
+    return Pipeline(steps=[("features_preprocessing", preprocessor), ("reg", regressor)])
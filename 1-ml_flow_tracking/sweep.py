@@ -0,0 +1,200 @@
+# Hyperparameter and model-family sweep for the pricing model
+# Every candidate (Ridge, Lasso, gradient boosting...) is cross-validated in parallel on the local cores.
+# The preprocessing (one-hot encoding + scaling) is fitted once per fold and its output is shared by all
+# the candidates. Each candidate is logged as a nested MLflow run and the best one is registered as lin_reg.
+#
+# Terminal command : python sweep.py [--space search_space.json] [--n-jobs -1] [--benchmark]
+import os
+import json
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+pd.options.mode.chained_assignment = None
+import mlflow
+
+from joblib import Parallel, delayed
+from mlflow.models.signature import infer_signature
+from sklearn.model_selection import train_test_split, KFold, ParameterGrid
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import OneHotEncoder, StandardScaler
+from sklearn.compose import ColumnTransformer
+from sklearn.metrics import mean_squared_error, mean_absolute_error, r2_score
+from sklearn.linear_model import LinearRegression, Ridge, Lasso
+from sklearn.ensemble import HistGradientBoostingRegressor
+
+from training_profile import profile_from_frame, log_profile
+
+
+ESTIMATORS = {
+    "LinearRegression": LinearRegression,
+    "Ridge": Ridge,
+    "Lasso": Lasso,
+    "HistGradientBoostingRegressor": HistGradientBoostingRegressor,
+}
+
+# Default search space: estimator name -> grid of parameters (same format in the --space JSON file)
+SEARCH_SPACE = {
+    "LinearRegression": {},
+    "Ridge": {"alpha": [0.1, 1, 10, 100]},
+    "Lasso": {"alpha": [0.01, 0.1, 1], "max_iter": [5000]},
+    "HistGradientBoostingRegressor": {"learning_rate": [0.05, 0.1], "max_leaf_nodes": [15, 31], "max_iter": [300]},
+}
+
+
+def make_preprocessor(X):
+    # Same preprocessing as app.py, except unknown categories: a validation fold can hold a car model
+    # absent from its training folds
+    categorical_features = X.select_dtypes("object").columns
+    numerical_features = X.columns[~X.columns.isin(categorical_features)]
+    return ColumnTransformer(
+        transformers=[
+            ("categorical_transformer", OneHotEncoder(drop='first', handle_unknown='ignore', sparse_output=False), categorical_features),
+            ("numerical_transformer", StandardScaler(), numerical_features)
+        ]
+    )
+
+
+def expand_space(space):
+    # One trial per combination of parameters: (estimator name, params)
+    return [(name, params) for name, grid in space.items() for params in ParameterGrid({k: list(v) for k, v in grid.items()})]
+
+
+def prepare_folds(X, Y, n_splits):
+    """
+    Fits the preprocessing once per fold. Returns a list of (X_train, y_train, X_val, y_val) arrays,
+    shared by all the trials (joblib memory-maps large arrays for the worker processes).
+    """
+    folds = []
+    for train_index, val_index in KFold(n_splits=n_splits, shuffle=True, random_state=0).split(X):
+        preprocessor = make_preprocessor(X)
+        X_fold_train = preprocessor.fit_transform(X.iloc[train_index])
+        X_fold_val = preprocessor.transform(X.iloc[val_index])
+        folds.append((X_fold_train, Y.iloc[train_index].to_numpy(), X_fold_val, Y.iloc[val_index].to_numpy()))
+    return folds
+
+
+def fit_fold(name, params, fold):
+    # One fit of one trial on one fold (runs in a worker process)
+    X_fold_train, y_fold_train, X_fold_val, y_fold_val = fold
+    start_time = time.perf_counter()
+    estimator = ESTIMATORS[name](**params).fit(X_fold_train, y_fold_train)
+    fit_seconds = time.perf_counter() - start_time
+    predictions = estimator.predict(X_fold_val)
+    return {
+        "rmse": mean_squared_error(y_fold_val, predictions) ** 0.5,
+        "mae": mean_absolute_error(y_fold_val, predictions),
+        "r2": r2_score(y_fold_val, predictions),
+        "fit_seconds": fit_seconds,
+    }
+
+
+def run_trials(trials, folds, n_jobs):
+    """
+    Cross-validates all the trials, (trial, fold) fits running in parallel.
+    Returns (one dict of mean metrics per trial, wall-clock seconds).
+    """
+    start_time = time.perf_counter()
+    results = Parallel(n_jobs=n_jobs)(delayed(fit_fold)(name, params, fold) for name, params in trials for fold in folds)
+    wall_clock = time.perf_counter() - start_time
+
+    summaries = []
+    for index, (name, params) in enumerate(trials):
+        fold_results = results[index * len(folds):(index + 1) * len(folds)]
+        summary = {f"cv_{metric}": float(np.mean([r[metric] for r in fold_results])) for metric in ("rmse", "mae", "r2")}
+        summary["cv_rmse_std"] = float(np.std([r["rmse"] for r in fold_results]))
+        summary["fit_seconds"] = float(np.sum([r["fit_seconds"] for r in fold_results]))
+        summaries.append(summary)
+    return summaries, wall_clock
+
+
+def single_run_time(X_train, Y_train):
+    # Time of the current training script (app.py): one LinearRegression pipeline fitted once
+    model = Pipeline(steps=[("features_preprocessing", make_preprocessor(X_train)), ("reg", LinearRegression())])
+    start_time = time.perf_counter()
+    model.fit(X_train, Y_train)
+    return time.perf_counter() - start_time
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cross-validated sweep of pricing models")
+    parser.add_argument("--space", help="JSON file {estimator name: {param: [values]}} (default: SEARCH_SPACE)")
+    parser.add_argument("--n-jobs", type=int, default=-1, help="Number of parallel processes (-1 = all cores)")
+    parser.add_argument("--folds", type=int, default=5, help="Number of cross-validation folds")
+    parser.add_argument("--benchmark", action="store_true", help="Also run the sweep serially to compare wall-clock times")
+    args = parser.parse_args()
+
+    ### MLFLOW Experiment setup
+    mlflow.set_tracking_uri(os.environ["MLFLOW_TRACKING_URI"])
+    experiment_name="rental _price"
+    mlflow.set_experiment(experiment_name)
+
+    space = SEARCH_SPACE
+    if args.space:
+        with open(args.space) as f:
+            space = json.load(f)
+    trials = expand_space(space)
+
+    #import dataset
+    df = pd.read_csv("get_around_pricing_project.csv", index_col =0)
+    target_name = "rental_price_per_day"
+    Y = df.loc[:,target_name]
+    X = df.drop(target_name, axis = 1)
+    X_train, X_test, Y_train, Y_test = train_test_split(X, Y, test_size=0.2, random_state=0)
+
+    print(f"sweeping {len(trials)} trials x {args.folds} folds...")
+    folds = prepare_folds(X_train, Y_train, args.folds)
+
+    with mlflow.start_run(run_name="sweep") as parent_run:
+        summaries, wall_clock = run_trials(trials, folds, args.n_jobs)
+        nb_fits = len(trials) * len(folds)
+
+        # One nested run per trial
+        for (name, params), summary in zip(trials, summaries):
+            with mlflow.start_run(run_name=name, nested=True):
+                mlflow.log_param("estimator", name)
+                mlflow.log_params(params)
+                mlflow.log_metrics(summary)
+
+        # Wall-clock / throughput comparison with the current single-run script
+        baseline_seconds = single_run_time(X_train, Y_train)
+        benchmark = {
+            "sweep_wall_clock_seconds": wall_clock,
+            "sweep_fits_per_second": nb_fits / wall_clock,
+            "single_run_seconds": baseline_seconds,
+        }
+        if args.benchmark:
+            _, serial_wall_clock = run_trials(trials, folds, n_jobs=1)
+            benchmark["serial_wall_clock_seconds"] = serial_wall_clock
+            benchmark["serial_fits_per_second"] = nb_fits / serial_wall_clock
+            benchmark["parallel_speedup"] = serial_wall_clock / wall_clock
+        mlflow.log_metrics(benchmark)
+
+        # Best trial: refitted on the whole training set, evaluated on the test set and registered
+        best_index = int(np.argmin([summary["cv_rmse"] for summary in summaries]))
+        best_name, best_params = trials[best_index]
+        mlflow.log_param("best_estimator", best_name)
+        mlflow.log_params({f"best_{key}": value for key, value in best_params.items()})
+
+        model = Pipeline(steps=[("features_preprocessing", make_preprocessor(X_train)),
+                        ("reg", ESTIMATORS[best_name](**best_params))
+                        ])
+        model.fit(X_train, Y_train)
+        test_predictions = model.predict(X_test)
+        mlflow.log_metrics({
+            "test_rmse": mean_squared_error(Y_test, test_predictions) ** 0.5,
+            "test_mae": mean_absolute_error(Y_test, test_predictions),
+            "test_r2": r2_score(Y_test, test_predictions),
+        })
+        train_predictions = model.predict(X_train)
+        log_profile(profile_from_frame(X_train, train_predictions))
+        mlflow.sklearn.log_model(sk_model=model,
+            artifact_path="pricing_getaround",
+            registered_model_name = "lin_reg",
+            signature=infer_signature(X_train, train_predictions)
+            )
+
+    print(f"best trial: {best_name} {best_params} (cv rmse {summaries[best_index]['cv_rmse']:.2f})")
+    for key, value in benchmark.items():
+        print(f"---{key}: {value:.3f}")
@@ -0,0 +1,69 @@
+# Incremental retraining (retrain_incremental.py): updated statistics against a fit on the final data (see conftest.py)
+# Terminal command : python -m pytest test_retrain_incremental.py
+import numpy as np
+import pytest
+
+from sufficient_stats import build_pipeline, CATEGORICAL_FEATURES, OTHER_CATEGORY, TARGET
+from train_streaming import accumulate
+from retrain_incremental import apply_delta, fit_model
+
+
+def assert_same_predictions(fit_pipeline, stats, expected_rows, handle_unknown="error"):
+    X, Y = expected_rows.drop(columns=TARGET), expected_rows[TARGET]
+    model = build_pipeline(stats, stats.solve(), handle_unknown=handle_unknown)
+    np.testing.assert_allclose(model.predict(X), fit_pipeline(X, Y).predict(X), rtol=0, atol=1e-6)
+
+
+def test_base_plus_delta_is_full_fit(pricing_data, fit_pipeline, tmp_path):
+    # Base trained on the first rows, the next ones added after its watermark (row index)
+    base_csv, full_csv = tmp_path / "base.csv", tmp_path / "full.csv"
+    pricing_data.iloc[:3000].to_csv(base_csv)
+    pricing_data.to_csv(full_csv)
+    stats, _, _, watermark = accumulate(str(base_csv), 1000, test_fraction=0)
+
+    nb_added, nb_removed, new_watermark, _, _ = apply_delta(stats, str(full_csv), 700, watermark, None, test_fraction=0)
+    assert (nb_added, nb_removed, new_watermark) == (len(pricing_data) - 3000, 0, pricing_data.index.max())
+    assert_same_predictions(fit_pipeline, stats, pricing_data)
+
+
+def test_retraction_is_fit_without_the_rows(pricing_data, fit_pipeline, tmp_path):
+    # Rows sent again with sign = -1 and a newer watermark column are removed from the statistics
+    base = pricing_data.assign(updated=0)
+    removed = base.sample(500, random_state=0).assign(updated=1, sign=-1)
+    base_csv, delta_csv = tmp_path / "base.csv", tmp_path / "delta.csv"
+    base.to_csv(base_csv)
+    removed.to_csv(delta_csv)
+    stats, _, _, watermark = accumulate(str(base_csv), 1000, test_fraction=0, watermark_column="updated")
+
+    nb_added, nb_removed, _, _, _ = apply_delta(stats, str(delta_csv), 100, watermark, "updated", test_fraction=0)
+    assert (nb_added, nb_removed) == (0, 500)
+    assert stats.nb_rows == len(pricing_data) - 500
+    assert_same_predictions(fit_pipeline, stats, pricing_data.drop(index=removed.index))
+
+
+def test_pooling_is_fit_on_pooled_data(pricing_data, pricing_csv, fit_pipeline):
+    min_count = 20
+    stats, _, _, _ = accumulate(pricing_csv, 1000, test_fraction=0)
+    pooled_data = pricing_data.copy()
+    for feature in CATEGORICAL_FEATURES:
+        counts = pooled_data[feature].value_counts()
+        rare = pooled_data[feature].isin(counts.index[counts < min_count])
+        pooled_data.loc[rare, feature] = OTHER_CATEGORY
+    assert (pooled_data[CATEGORICAL_FEATURES] == OTHER_CATEGORY).any().any()
+
+    pooled = stats.pooled(min_count)
+    assert OTHER_CATEGORY in pooled.vocabulary["model_key"]
+    assert_same_predictions(fit_pipeline, pooled, pooled_data)
+
+
+@pytest.mark.parametrize("min_count", [1, 20])
+def test_unseen_category_is_not_priced_as_the_reference(pricing_data, pricing_csv, min_count):
+    stats, _, _, _ = accumulate(pricing_csv, 1000, test_fraction=0)
+    pooled, _, model = fit_model(stats, min_count)
+    car = pricing_data.drop(columns=TARGET).iloc[[0]]
+    # An all-zero one-hot row would be the reference (dropped) category: the model refuses the car instead
+    with pytest.raises(ValueError):
+        model.predict(car.assign(model_key="Tesla"))
+    if OTHER_CATEGORY in pooled.vocabulary["model_key"]:
+        reference = pooled.encoder_categories("model_key")[0]
+        assert model.predict(car.assign(model_key=OTHER_CATEGORY))[0] != pytest.approx(model.predict(car.assign(model_key=reference))[0])
@@ -0,0 +1,40 @@
+# Streaming training (sufficient_stats.py, train_streaming.py) against LinearRegression on the same encoding
+# Terminal command : python -m pytest test_sufficient_stats.py
+import numpy as np
+import pytest
+
+from sufficient_stats import SufficientStats, build_pipeline
+from train_streaming import accumulate
+
+
+@pytest.mark.parametrize("chunksize", [7, 500, 100000])
+def test_streaming_fit_matches_linear_regression(pricing, pricing_csv, fit_pipeline, chunksize):
+    X, Y = pricing
+    train, _, _, _ = accumulate(pricing_csv, chunksize, test_fraction=0)
+    assert train.nb_rows == len(X)
+
+    coefficients = train.solve()
+    expected = fit_pipeline(X, Y).predict(X)
+    np.testing.assert_allclose(build_pipeline(train, coefficients).predict(X), expected, rtol=0, atol=1e-6)
+    # RMSE from the statistics only (no prediction)
+    rmse = np.sqrt(np.mean((Y.to_numpy() - expected) ** 2))
+    assert train.evaluate(train, coefficients)["rmse"] == pytest.approx(rmse, rel=1e-6)
+
+
+def test_scaler_moments(pricing, pricing_csv):
+    X, _ = pricing
+    train, _, _, _ = accumulate(pricing_csv, 1000, test_fraction=0)
+    scaler = build_pipeline(train, train.solve()).named_steps["features_preprocessing"].named_transformers_["numerical_transformer"]
+    numerical = X[train.numerical].astype(float)
+    np.testing.assert_allclose(scaler.mean_, numerical.mean(), rtol=1e-9)
+    np.testing.assert_allclose(scaler.var_, numerical.var(ddof=0), rtol=1e-6)
+
+
+def test_saved_stats(pricing_csv, tmp_path):
+    train, _, _, _ = accumulate(pricing_csv, 1000, test_fraction=0)
+    path = tmp_path / "sufficient_stats.npz"
+    train.save(path, watermark=3)
+    loaded, metadata = SufficientStats.load(path)
+    assert metadata == {"watermark": 3}
+    assert loaded.columns == train.columns and loaded.vocabulary == train.vocabulary
+    np.testing.assert_array_equal(loaded.solve(), train.solve())
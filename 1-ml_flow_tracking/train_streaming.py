@@ -0,0 +1,138 @@
+# Out-of-core training of the pricing model
+# Same model as app.py (one-hot encoding + standard scaling + linear regression), for datasets too big for
+# memory: the CSV or Parquet file is read by chunks with compact types, each chunk becomes a sparse design
+# matrix and is added to the normal equations (see sufficient_stats.py), and the regression is solved at
+# the end. Memory depends on the chunk size and the number of categories, not on the number of rows.
+# Test rows (--test-fraction) are chosen by a hash of the row index and evaluated the same way.
+# The statistics are logged with the model (sufficient_stats.npz), with the watermark of the rows read
+# (max row index or --watermark-column), for incremental retraining (see retrain_incremental.py).
+#
+# Terminal command : python train_streaming.py [--source get_around_pricing_project.csv] [--chunksize 100000]
+import os
+import time
+import argparse
+import resource
+import tempfile
+
+import numpy as np
+import pandas as pd
+import mlflow
+
+from mlflow.models.signature import infer_signature
+
+from sufficient_stats import SufficientStats, build_pipeline, DTYPES, BOOLEAN_FEATURES, FEATURES
+from training_profile import profile_from_stats, log_profile
+
+
+def read_chunks(source, chunksize):
+    """
+    DataFrames of at most chunksize rows from a CSV (first column = index) or Parquet file,
+    with categories for the text columns and booleans as uint8.
+    """
+    if source.endswith(".parquet"):
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(source)
+        batches = (batch.to_pandas() for batch in parquet_file.iter_batches(batch_size=chunksize))
+    else:
+        batches = pd.read_csv(source, index_col=0, dtype=DTYPES, chunksize=chunksize)
+    for chunk in batches:
+        chunk = chunk.astype({column: dtype for column, dtype in DTYPES.items() if column in chunk.columns})
+        chunk[BOOLEAN_FEATURES] = chunk[BOOLEAN_FEATURES].astype(np.uint8)
+        yield chunk
+
+
+def watermark_of(chunk, watermark_column=None):
+    # Values compared with the watermark of the last training: row index, or a column (e.g. an update date)
+    values = chunk.index if watermark_column is None else chunk[watermark_column]
+    return values.max() if len(values) else None
+
+
+def to_json_value(value):
+    # numpy / pandas scalar -> int, float or str kept in the metadata of the stats
+    if hasattr(value, "item"):
+        value = value.item()
+    return value if isinstance(value, (int, float, str)) or value is None else str(value)
+
+
+def test_mask(index, test_fraction):
+    # Same rows in the test set at every run, whatever the chunks
+    return pd.util.hash_array(np.asarray(index)) % 10000 < test_fraction * 10000
+
+
+def accumulate(source, chunksize, test_fraction, watermark_column=None):
+    """
+    Returns (train stats, test stats, first chunk, watermark = max index or watermark column) of the whole source.
+    """
+    train, test = SufficientStats(), SufficientStats()
+    first_chunk, watermark = None, None
+    for chunk in read_chunks(source, chunksize):
+        if first_chunk is None:
+            first_chunk = chunk
+        chunk_watermark = watermark_of(chunk, watermark_column)
+        if watermark is None or (chunk_watermark is not None and chunk_watermark > watermark):
+            watermark = chunk_watermark
+        in_test = test_mask(chunk.index, test_fraction)
+        train.add(chunk[~in_test])
+        if in_test.any():
+            test.add(chunk[in_test])
+    return train, test, first_chunk, watermark
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train the pricing model by chunks")
+    parser.add_argument("--source", default="get_around_pricing_project.csv", help="CSV or Parquet file")
+    parser.add_argument("--chunksize", type=int, default=100000, help="Rows read at a time")
+    parser.add_argument("--test-fraction", type=float, default=0.2, help="Share of rows kept for the test metrics")
+    parser.add_argument("--watermark-column", help="Column giving the rows added / updated since the last training (default: row index)")
+    args = parser.parse_args()
+
+    ### MLFLOW Experiment setup
+    mlflow.set_tracking_uri(os.environ["MLFLOW_TRACKING_URI"])
+    experiment_name="rental _price"
+    mlflow.set_experiment(experiment_name)
+
+    print("training model...")
+    start_time = time.time()
+
+    train, test, first_chunk, watermark = accumulate(args.source, args.chunksize, args.test_fraction, args.watermark_column)
+    coefficients = train.solve()
+    model = build_pipeline(train, coefficients)
+    training_time = time.time() - start_time
+
+    with mlflow.start_run(run_name="streaming"):
+        mlflow.log_params({
+            "source": args.source,
+            "chunksize": args.chunksize,
+            "test_fraction": args.test_fraction,
+            "nb_train_rows": int(train.nb_rows),
+            "nb_columns": len(train.columns),
+        })
+        metrics = {f"train_{name}": value for name, value in train.evaluate(train, coefficients).items()}
+        if test.nb_rows:
+            metrics.update({f"test_{name}": value for name, value in train.evaluate(test, coefficients).items()})
+        metrics["training_time"] = training_time
+        # ru_maxrss is in kilobytes on Linux
+        metrics["peak_memory_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        mlflow.log_metrics(metrics)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            stats_path = os.path.join(tmp_dir, "sufficient_stats.npz")
+            # Starting point of the incremental retraining (see retrain_incremental.py)
+            train.save(stats_path, source=args.source, test_fraction=args.test_fraction, stats_version=1,
+                       watermark=to_json_value(watermark), watermark_column=args.watermark_column)
+            mlflow.log_artifact(stats_path)
+
+        log_profile(profile_from_stats(train))
+
+        # Signature from the first rows, with the types the API sends
+        sample = first_chunk[FEATURES].head(100).astype({feature: "object" for feature in FEATURES if str(first_chunk[feature].dtype) == "category"})
+        sample[BOOLEAN_FEATURES] = sample[BOOLEAN_FEATURES].astype(bool)
+        mlflow.sklearn.log_model(sk_model=model,
+            artifact_path="pricing_getaround",
+            registered_model_name = "lin_reg",
+            signature=infer_signature(sample, model.predict(sample))
+            )
+
+    print("...Done!")
+    for name, value in metrics.items():
+        print(f"---{name}: {value:.3f}")
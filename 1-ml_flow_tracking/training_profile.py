@@ -0,0 +1,71 @@
+# Profile of the training data, logged with the model as training_profile.json (mlflow.log_dict)
+# The API reads it when it loads the model:
+# - most frequent category of each categorical feature, used to replace unknown categories with
+#   UNKNOWN_CATEGORY_POLICY=most_frequent (see 2-API/category_validation.py)
+# - reference distributions for the drift monitoring (see 2-API/monitoring.py): histogram of each numerical
+#   feature (edges at the quantiles of the training data), counts of the categories, histogram of the predictions
+import numpy as np
+import mlflow
+
+
+PROFILE_ARTIFACT = "training_profile.json"
+# Bins of the reference histograms, and categories counted per feature (the others are summed in nb_other)
+NB_BINS = 10
+MAX_CATEGORIES = 200
+
+
+def histogram(values, nb_bins=NB_BINS):
+    """
+    Edges at the quantiles of the values (repeated edges removed) and number of values in each bin. The first
+    and last bins are open: bin i holds the values v with edges[i-1] <= v < edges[i] (np.searchsorted side="right").
+    """
+    values = np.asarray(values, dtype=float)
+    edges = np.unique(np.quantile(values, np.linspace(0, 1, nb_bins + 1)[1:-1]))
+    counts = np.bincount(np.searchsorted(edges, values, side="right"), minlength=len(edges) + 1)
+    return {"edges": edges.tolist(), "counts": counts.tolist()}
+
+
+def category_counts(counts, max_categories=MAX_CATEGORIES):
+    # {category: count} -> the max_categories most frequent, and the number of rows of the other ones
+    ordered = sorted(counts.items(), key=lambda item: item[1], reverse=True)
+    return {
+        "counts": {str(category): int(count) for category, count in ordered[:max_categories]},
+        "nb_other": int(sum(count for _, count in ordered[max_categories:])),
+    }
+
+
+def profile_from_frame(X, predictions=None):
+    """
+    Profile of a training DataFrame (text columns = categorical features, the others numerical),
+    with the histogram of the predictions of the model on it if given.
+    """
+    categorical_features = X.select_dtypes(["object", "category"]).columns
+    numerical_features = X.columns[~X.columns.isin(categorical_features)]
+    profile = {
+        "nb_rows": len(X),
+        "most_frequent": {feature: str(X[feature].value_counts().idxmax()) for feature in categorical_features},
+        "numerical": {feature: histogram(X[feature]) for feature in numerical_features},
+        "categorical": {feature: category_counts(X[feature].value_counts().to_dict()) for feature in categorical_features},
+    }
+    if predictions is not None:
+        profile["prediction"] = histogram(predictions)
+    return profile
+
+
+def profile_from_stats(stats):
+    """
+    Profile of sufficient statistics (see sufficient_stats.py), read from their category counts. The statistics
+    have no quantiles: the numerical features and the predictions have no reference histogram.
+    """
+    most_frequent, categorical = {}, {}
+    for feature in stats.vocabulary:
+        counts = {category: int(round(count)) for category, count in stats.category_counts(feature).items()}
+        if counts:
+            most_frequent[feature] = max(counts, key=counts.get)
+            categorical[feature] = category_counts(counts)
+    return {"nb_rows": int(round(stats.nb_rows)), "most_frequent": most_frequent, "categorical": categorical}
+
+
+def log_profile(profile):
+    # In the active run, next to the model
+    mlflow.log_dict(profile, PROFILE_ARTIFACT)
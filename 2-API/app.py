@@ -1,19 +1,80 @@
 # Importing libraries
-import mlflow 
+import os
 import uvicorn
 import json
 import pandas as pd 
+import pyarrow as pa
+from contextlib import asynccontextmanager
 from pydantic import BaseModel
 from typing import Literal, List, Union
-from fastapi import FastAPI, File, UploadFile
+import gc
+import time
+import shutil
+from fastapi import FastAPI, File, Form, Query, UploadFile, HTTPException, Request
+from fastapi.responses import StreamingResponse, JSONResponse, Response, FileResponse
+from starlette.concurrency import run_in_threadpool
 
-# 2 suivants chez inspi K
-import boto3
-import pickle
+from model_store import ModelStore, ModelChanged
+from micro_batching import MicroBatcher, MICRO_BATCHING
+from inference_pool import InferencePool, PoolFull
+from prediction_cache import PredictionCache, PREDICTION_CACHE_SIZE
+from category_validation import UnknownCategory
+from delay_index import DelayIndexFile, UnknownScope, COMPLETE_SCOPE
+from monitoring import DriftMonitor, MONITORING
+from jobs import JobRunner, make_job_store, input_format_of, resolve_input_path
+from metrics import registry, MetricsMiddleware, stage_timer, request_started, STAGE_SECONDS, BATCH_SIZE
 
 
-# suivant chez inspi K mais pas sur corrigé)
-mlflow.set_tracking_uri("https://mlfga.herokuapp.com/") 
+# ML flow server (read by mlflow when it is imported, i.e. only if the model is not baked in the image)
+os.environ.setdefault("MLFLOW_TRACKING_URI", "https://mlfga.herokuapp.com/")
+
+# Model kept warm in memory, see model_store.py (MODEL_URI and MODEL_RELOAD_INTERVAL env variables)
+store = ModelStore()
+
+# Predictions run in a bounded pool of threads or processes, see inference_pool.py
+# (INFERENCE_EXECUTOR, INFERENCE_WORKERS and INFERENCE_QUEUE_SIZE env variables)
+pool = InferencePool()
+# forked processes keep the model they were created with: new processes after a reload
+store.listeners.append(lambda loaded: pool.restart())
+
+# Cache of /predict results, see prediction_cache.py (PREDICTION_CACHE_SIZE, PREDICTION_CACHE_TTL
+# and PREDICTION_CACHE_BACKEND env variables). Emptied when a new model version is loaded
+cache = PredictionCache() if PREDICTION_CACHE_SIZE > 0 else None
+if cache is not None:
+    store.listeners.append(lambda loaded: cache.clear())
+
+
+async def cache_call(function, *args):
+    # A Redis round-trip blocks: run it in a thread so that a slow cache does not stall the event loop
+    if cache.backend.remote:
+        return await run_in_threadpool(function, *args)
+    return function(*args)
+
+# Drift of the cars received against the training data of the model, see monitoring.py (MONITORING,
+# MONITORING_LOG_INTERVAL, MONITORING_MLFLOW env variables). The reference changes with the model
+monitor = DriftMonitor() if MONITORING else None
+if monitor is not None:
+    store.listeners.append(monitor.set_model)
+
+# Model loads, see /metrics
+MODEL_LOADS = registry.counter("api_model_loads_total", "Models loaded (startup and hot reloads)")
+MODEL_LOAD_SECONDS = registry.histogram("api_model_load_seconds", "Model load time", buckets=(0.01, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60))
+def count_model_load(loaded):
+    MODEL_LOADS.inc()
+    MODEL_LOAD_SECONDS.observe(loaded.load_seconds)
+store.listeners.append(count_model_load)
+registry.gauge("api_model_reload_failures_total", "Hot reloads that failed", lambda: store.nb_reload_failures, kind="counter")
+
+# With gunicorn --preload, load the model when the app is imported by the master process:
+# the forked workers then share the model memory (copy-on-write) instead of loading one copy each
+if os.environ.get("PRELOAD_MODEL", "0") == "1":
+    store.load()
+    gc.freeze() # objects created so far are never touched by the garbage collector, so their pages stay shared
+
+# Batch predictions: max number of rows scored in one call to the model (bigger batches are
+# scored chunk by chunk and the response is streamed), and max number of rows per request
+PREDICT_BATCH_SIZE = int(os.environ.get("PREDICT_BATCH_SIZE", 5000))
+MAX_BATCH_ROWS = int(os.environ.get("MAX_BATCH_ROWS", 200000))
 
 
 description = """
@@ -30,10 +91,52 @@ tags_metadata = [
     {
         "name": "Machine Learning Endpoint",
         "description": "Rental cars right pricing"
+    },
+
+    {
+        "name": "Model Endpoint",
+        "description": "Information about the model currently served"
+    },
+
+    {
+        "name": "Delay Analysis Endpoint",
+        "description": "Rentals affected by a minimum delay between 2 rentals"
+    },
+
+    {
+        "name": "Jobs Endpoint",
+        "description": "Offline scoring of big files"
+    },
+
+    {
+        "name": "Monitoring Endpoint",
+        "description": "Metrics to tune the API"
     }
 ]
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load the model once at startup (unless preloaded), then check the registry in background for new versions
+    if store.current is None:
+        store.load()
+    store.start_watcher()
+    if batcher is not None:
+        await batcher.start()
+    # Scoring jobs of this worker, and the ones left unfinished by a previous run
+    jobs.start()
+    if monitor is not None:
+        monitor.start()
+    yield
+    if monitor is not None:
+        await run_in_threadpool(monitor.stop)
+    await run_in_threadpool(jobs.stop)
+    if batcher is not None:
+        await batcher.stop()
+    store.stop_watcher()
+    pool.shutdown()
+
+
 app = FastAPI(
     title= "🚗 Estimate the right price and rent your car!",
     description=description,
@@ -42,8 +145,11 @@ app = FastAPI(
         "name": "Elisa Ouillé",
         "url": "https://www.linkedin.com/in/elisaouille/",
     },
-    openapi_tags=tags_metadata
+    openapi_tags=tags_metadata,
+    lifespan=lifespan
 )
+# Requests counted and timed by route, see /metrics
+app.add_middleware(MetricsMiddleware)
 
 
 class PredictionFeatures(BaseModel):
@@ -62,6 +168,46 @@ class PredictionFeatures(BaseModel):
     winter_tires: bool = True
     # if empty, replacing by most common data (or mean) from our model prediction dataset
 
+FEATURE_NAMES = list(dict(PredictionFeatures()))
+
+
+def predict_columns(columns, version=None):
+    # Scores a DataFrame or a dict of columns, with the compiled scorer when available (see fast_scorer.py).
+    # With a version, raises ModelChanged if the model served is another one (hot reload)
+    loaded = store.current
+    if version is not None and loaded.version != version:
+        raise ModelChanged(f"The model changed from version {version} to {loaded.version}")
+    if loaded.scorer is not None:
+        with stage_timer("scorer"):
+            return loaded.scorer.predict(columns)
+    with stage_timer("dataframe"):
+        df = pd.DataFrame(columns)[FEATURE_NAMES]
+    with stage_timer("model"):
+        return loaded.model.predict(df)
+
+
+def predict_rows(rows):
+    # Scores a list of feature dicts in one call to the model
+    columns = {name: [row[name] for row in rows] for name in FEATURE_NAMES}
+    return predict_columns(columns).tolist()
+
+
+# Opt-in micro-batching of concurrent /predict requests, see micro_batching.py
+# (MICRO_BATCHING, MICRO_BATCH_MAX_WAIT_MS and MICRO_BATCH_MAX_SIZE env variables)
+batcher = MicroBatcher(predict_rows, run=pool.run) if MICRO_BATCHING else None
+
+
+@app.exception_handler(PoolFull)
+async def pool_full_handler(request: Request, exc: PoolFull):
+    # Backpressure: the client should retry later instead of waiting in an ever growing queue
+    return JSONResponse(status_code=429, content={"detail": "Too many predictions in progress, retry later"}, headers={"Retry-After": "1"})
+
+
+@app.exception_handler(UnknownCategory)
+async def unknown_category_handler(request: Request, exc: UnknownCategory):
+    # Category unknown by the model with UNKNOWN_CATEGORY_POLICY=reject: rejected before calling the model
+    return JSONResponse(status_code=422, content={"detail": exc.detail()})
+
 
 @app.get("/", tags=["Introduction Endpoint"])
 async def index():
@@ -72,29 +218,359 @@ async def index():
 
 
 @app.post("/predict", tags=["Machine Learning Endpoint"])
-async def predict(features: PredictionFeatures):
+async def predict(features: PredictionFeatures, request: Request):
     """
     Estimation of rental price for cars.
     """
-    # Read data 
-    df = pd.DataFrame(dict(features), index=[0])
+    # Time between the request arrival and here: reading the body and pydantic validation
+    started = request_started(request)
+    if started is not None:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage="validation")
+    # Model already loaded at startup (kept until a new version is promoted)
+    loaded = store.current
 
-    # Log model from mlflow 
-    logged_model = 'runs:/22442f6913df4a0fa3b2c9d44c0e6570/pricing_getaround'
+    # Categories unknown by the model: rejected (422) or replaced, see category_validation.py
+    received = dict(features)
+    with stage_timer("category_validation"):
+        try:
+            row = loaded.validator.check_row(received)
+        except UnknownCategory:
+            # Rejected cars are part of the drift too (new categories)
+            if monitor is not None:
+                monitor.observe(received)
+            raise
 
-    # Load model as a PyFuncModel.
-    loaded_model = mlflow.pyfunc.load_model(logged_model)
+    # Same car already priced by this model version
+    if cache is not None:
+        with stage_timer("cache"):
+            prediction = await cache_call(cache.get, row, loaded.version)
+        if prediction is not None:
+            if monitor is not None:
+                monitor.observe(received, prediction)
+            return {"prediction": prediction}
 
-    # If you want to load model persisted locally
-    #loaded_model = joblib.load('salary_predictor/model.joblib')
+    if batcher is not None:
+        # Scored together with the other requests received at the same time
+        with stage_timer("micro_batch"):
+            prediction = await batcher.predict(row)
+    elif loaded.scorer is not None:
+        # Compiled scorer: a few microseconds, no need to leave the event loop
+        with stage_timer("scorer"):
+            prediction = loaded.scorer.predict_one(row)
+    else:
+        # DataFrame + sklearn: run in the inference pool (waiting time included)
+        with stage_timer("inference_pool"):
+            prediction = (await pool.run(predict_rows, [row]))[0]
 
-    prediction = loaded_model.predict(df)
+    if cache is not None:
+        await cache_call(cache.set, row, loaded.version, prediction)
+    # Counted for the drift monitoring in background (the car as received, before the replacement of unknown categories)
+    if monitor is not None:
+        monitor.observe(received, prediction)
 
     # Format response
-    response = {"prediction": prediction.tolist()[0]}
+    response = {"prediction": prediction}
     return response
 
 
+@app.get("/model", tags=["Model Endpoint"])
+async def model_info():
+    """
+    Model currently served: URI, registered name, version, load time.
+    """
+    response = store.current.info()
+    response["reload_interval"] = store.reload_interval
+    response["categories"] = store.current.validator.stats()
+    return response
+
+
+@app.get("/batching", tags=["Monitoring Endpoint"])
+async def batching_stats():
+    """
+    Micro-batching settings and metrics: queue depth and batch sizes.
+    """
+    if batcher is None:
+        return {"enabled": False}
+    return {"enabled": True, **batcher.stats()}
+
+
+@app.get("/inference", tags=["Monitoring Endpoint"])
+async def inference_stats():
+    """
+    Inference pool settings, predictions in progress and number of requests rejected (429).
+    """
+    return pool.stats()
+
+
+# Metrics of the batcher, the inference pool and the cache, read when /metrics is called
+registry.gauge("api_inference_pending", "Predictions in progress or queued in the inference pool", lambda: pool.pending)
+registry.gauge("api_inference_background_pending", "Background predictions (streamed responses, jobs) in progress", lambda: pool.background_pending)
+registry.gauge("api_inference_rejected_total", "Requests rejected because the inference pool was full (429)", lambda: pool.nb_rejected, kind="counter")
+if batcher is not None:
+    registry.gauge("api_micro_batch_queue_depth", "Predictions waiting to be micro-batched", lambda: batcher.stats()["queue_depth"])
+    registry.gauge("api_micro_batches_total", "Micro-batches scored", lambda: batcher.nb_batches, kind="counter")
+if cache is not None:
+    registry.gauge("api_cache_size", "Predictions in the cache", lambda: cache.stats()["size"])
+    registry.gauge("api_cache_requests_total", "Cache lookups by result", lambda: {"hit": cache.hits, "miss": cache.misses}, "result", kind="counter")
+    registry.gauge("api_cache_evictions_total", "Predictions evicted from the cache", lambda: cache.backend.nb_evictions, kind="counter")
+
+
+registry.gauge("api_unknown_categories_total", "Categories unknown by the model served, by feature",
+               lambda: store.current.validator.nb_unknown if store.current is not None else None, "feature", kind="counter")
+
+
+@app.get("/metrics", tags=["Monitoring Endpoint"])
+async def metrics():
+    """
+    Metrics of this worker in the Prometheus text format: requests, latencies, prediction stages, model loads,
+    inference pool, micro-batching and cache.
+    """
+    return Response(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/monitoring/drift", tags=["Monitoring Endpoint"])
+async def drift():
+    """
+    Drift of the cars received by this worker since the start of the window, against the training data of the
+    model: PSI per feature and of the predictions, ranges seen, most frequent categories unknown by the training data.
+    """
+    if monitor is None:
+        return {"enabled": False}
+    return {"enabled": True, **await run_in_threadpool(monitor.report)}
+
+
+if monitor is not None:
+    registry.gauge("api_drift_psi", "PSI of the cars received since the start of the window against the training data, by feature",
+                   lambda: {feature: score for feature, score in monitor.scores().items() if score is not None}, "feature")
+    registry.gauge("api_drift_dropped_total", "Requests not counted by the drift monitoring (queue full)", lambda: monitor.nb_dropped, kind="counter")
+
+
+@app.get("/cache", tags=["Monitoring Endpoint"])
+async def cache_stats():
+    """
+    Predictions cache: size, hits, misses and evictions.
+    """
+    if cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **cache.stats()}
+
+
+def iter_predictions(chunks, validator=None, version=None):
+    """
+    Scores each chunk of rows in one call to the model, in the inference pool. With a validator, unknown
+    categories are replaced, or for the rejected features their rows are predicted as null (the response
+    is already streaming, it cannot become a 422 anymore).
+    With a version, all the chunks are scored by that model version: ModelChanged is raised after a hot reload.
+    """
+    for chunk in chunks:
+        if not len(chunk):
+            continue
+        if validator is None:
+            yield pool.call(predict_columns, chunk, version).tolist()
+        elif not validator.rejected_features:
+            yield pool.call(predict_columns, validator.check_columns(chunk), version).tolist()
+        else:
+            known = validator.known_rows(chunk)
+            predictions = [None] * len(chunk)
+            if known.any():
+                for position, prediction in zip(known.nonzero()[0], pool.call(predict_columns, validator.check_columns(chunk[known]), version).tolist()):
+                    predictions[position] = prediction
+            yield predictions
+
+
+def split_rows(df):
+    for start in range(0, len(df), PREDICT_BATCH_SIZE):
+        yield df.iloc[start:start + PREDICT_BATCH_SIZE]
+
+
+def stream_predictions(chunks, validator=None, version=None):
+    # Same JSON as the non streamed response, written chunk by chunk: {"predictions": [...]}.
+    # If the model is reloaded while streaming, the predictions already sent are not mixed with the new
+    # version: the response ends there with {"predictions": [...], "error": "..."} and can be sent again
+    yield '{"predictions": ['
+    separator = ""
+    try:
+        for prediction in iter_predictions(chunks, validator, version):
+            yield separator + json.dumps(prediction)[1:-1]
+            separator = ", "
+    except ModelChanged as error:
+        yield f'], "error": {json.dumps(str(error))}}}'
+        return
+    yield ']}'
+
+
+@app.post("/predict/batch", tags=["Machine Learning Endpoint"])
+async def predict_batch(features: List[PredictionFeatures], request: Request):
+    """
+    Estimation of rental price for a list of cars, in the same order as the input.
+    """
+    started = request_started(request)
+    if started is not None:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage="batch_validation")
+    BATCH_SIZE.observe(len(features), endpoint="/predict/batch")
+    if len(features) > MAX_BATCH_ROWS:
+        raise HTTPException(status_code=413, detail=f"Too many cars, the maximum is {MAX_BATCH_ROWS} per request")
+    if not features:
+        return {"predictions": []}
+
+    # Build one columnar frame for the whole batch (instead of one DataFrame per car)
+    with stage_timer("batch_dataframe"):
+        df = pd.DataFrame({name: [getattr(car, name) for car in features] for name in FEATURE_NAMES})
+    received = df
+    # One model version for the whole response
+    loaded = store.current
+    try:
+        df = loaded.validator.check_columns(df)
+    except UnknownCategory:
+        if monitor is not None:
+            monitor.observe(received)
+        raise
+
+    if len(df) <= PREDICT_BATCH_SIZE:
+        prediction = (await pool.run(predict_columns, df)).tolist()
+        if monitor is not None:
+            monitor.observe(received, prediction)
+        return {"predictions": prediction}
+
+    # Streamed: the predictions are not kept, only the cars are counted
+    if monitor is not None:
+        monitor.observe(received)
+    return StreamingResponse(stream_predictions(split_rows(df), version=loaded.version), media_type="application/json")
+
+
+# Errors of pandas / pyarrow on a file that is empty or is not a CSV / Parquet file
+FILE_READ_ERRORS = (pd.errors.EmptyDataError, pd.errors.ParserError, UnicodeDecodeError, pa.ArrowException)
+
+
+def open_file_chunks(file):
+    # (first chunk, iterator of the next chunks) of an uploaded CSV or Parquet file
+    if file.filename.endswith(".parquet"):
+        chunks = split_rows(pd.read_parquet(file.file))
+    else:
+        # CSV files are read chunk by chunk
+        chunks = pd.read_csv(file.file, chunksize=PREDICT_BATCH_SIZE)
+    chunks = iter(chunks)
+    return next(chunks, pd.DataFrame(columns=FEATURE_NAMES)), chunks
+
+
+@app.post("/predict/batch/file", tags=["Machine Learning Endpoint"])
+async def predict_batch_file(file: UploadFile = File(...)):
+    """
+    Estimation of rental price for a CSV or Parquet file of cars (one car per row, one column per feature).
+    Predictions are streamed back in the same order as the rows of the file.
+    """
+    # Files are opened and parsed in a thread, not in the event loop. The first chunk is read before streaming
+    # so that a file that cannot be read, or without the expected columns, is rejected (422)
+    try:
+        first_chunk, chunks = await run_in_threadpool(open_file_chunks, file)
+    except FILE_READ_ERRORS as error:
+        raise HTTPException(status_code=422, detail=f"Cannot read {file.filename}: {error}")
+
+    missing_columns = [name for name in FEATURE_NAMES if name not in first_chunk.columns]
+    if missing_columns:
+        raise HTTPException(status_code=422, detail=f"Missing columns: {', '.join(missing_columns)}")
+    # Unknown categories of the first chunk rejected (422) before streaming, the next ones while streaming
+    loaded = store.current
+    first_chunk = loaded.validator.check_columns(first_chunk)
+
+    def all_chunks():
+        yield first_chunk
+        yield from chunks
+
+    return StreamingResponse(stream_predictions(all_chunks(), loaded.validator, loaded.version), media_type="application/json")
+
+
+# Threshold index exported by the dashboard, see delay_index.py (DELAY_INDEX_PATH env variable)
+delay_index = DelayIndexFile()
+
+
+@app.get("/delay/threshold", tags=["Delay Analysis Endpoint"])
+async def delay_threshold(threshold: float = Query(..., ge=0, description="Minimum minutes between 2 rentals"),
+                          scope: str = Query(COMPLETE_SCOPE, description="Complete scope, connect or mobile")):
+    """
+    For a minimum delay between 2 rentals of the same car: rentals affected, problematic cases solved (out of
+    problematic_cases), missed opportunities and revenue lost (if exported with the index), on a scope.
+    """
+    index = delay_index.get()
+    if index is None:
+        raise HTTPException(status_code=503, detail="The delay index is not available")
+    try:
+        return index.query(threshold, scope)
+    except UnknownScope as error:
+        raise HTTPException(status_code=422, detail=str(error))
+
+
+def score_job_chunk(chunk, version):
+    # Predictions of a chunk of a job by the model version of the job (None for the rows with unknown
+    # categories with the policy "reject"), ModelChanged if that version is no longer served
+    return next(iter_predictions([chunk[FEATURE_NAMES]], store.current.validator, version))
+
+
+# Offline scoring jobs, see jobs.py (JOBS_DIR, JOB_INPUT_DIR, JOB_CHUNK_SIZE, JOB_WORKERS, JOB_STORE env variables)
+jobs = JobRunner(make_job_store(), score_job_chunk, lambda: store.current.version, FEATURE_NAMES)
+registry.gauge("api_job_chunks_scored_total", "Chunks of jobs scored by this worker", lambda: jobs.nb_chunks_scored, kind="counter")
+
+
+def get_job(job_id):
+    job = jobs.info(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job {job_id}")
+    return job
+
+
+@app.post("/jobs", tags=["Jobs Endpoint"], status_code=202)
+async def create_job(file: UploadFile = File(None), path: str = Form(None)):
+    """
+    Submits a CSV or Parquet file of cars to score in background: uploaded, or the path of a file of the
+    server input folder. Returns the id of the job, to follow it with /jobs/{job_id}.
+    """
+    if (file is None) == (path is None):
+        raise HTTPException(status_code=422, detail="Send either a file or a path")
+    if path is not None:
+        try:
+            source = resolve_input_path(path)
+        except ValueError as error:
+            raise HTTPException(status_code=422, detail=str(error))
+        input_format = input_format_of(source)
+    job_id = await run_in_threadpool(jobs.new_job)
+    if file is not None:
+        # Written in the folder of the job before the job exists, so no worker starts on a partial file
+        input_format = input_format_of(file.filename)
+        source = os.path.join(jobs.job_dir(job_id), f"input.{input_format}")
+
+        def save_upload():
+            with open(source, "wb") as f:
+                shutil.copyfileobj(file.file, f)
+
+        await run_in_threadpool(save_upload)
+    await run_in_threadpool(jobs.create, job_id, source, input_format)
+    await run_in_threadpool(jobs.submit, job_id)
+    return await run_in_threadpool(get_job, job_id)
+
+
+@app.get("/jobs/{job_id}", tags=["Jobs Endpoint"])
+def job_status(job_id: str):
+    """
+    Status of a job (queued, running, done or failed), rows scored so far and error if any.
+    """
+    return get_job(job_id)
+
+
+@app.get("/jobs/{job_id}/result", tags=["Jobs Endpoint"])
+def job_result(job_id: str, format: Literal["parquet", "csv"] = "parquet"):
+    """
+    Predictions of a finished job: one row per car of the file, "row" (position in the file) and "prediction"
+    (empty for the cars with a category unknown by the model).
+    """
+    job = get_job(job_id)
+    if job["status"] != "done":
+        raise HTTPException(status_code=409, detail=f"Job {job_id} is {job['status']}")
+    if format == "csv":
+        return StreamingResponse(jobs.iter_csv(job_id), media_type="text/csv",
+                                 headers={"Content-Disposition": f'attachment; filename="{job_id}.csv"'})
+    return FileResponse(jobs.result_path(job_id), media_type="application/vnd.apache.parquet", filename=f"{job_id}.parquet")
+
+
 if __name__=="__main__":
     uvicorn.run(app, host="0.0.0.0", port=4000) # Here you define your web server to run the `app` variable 
                                     # (which contains FastAPI instance), with a specific host IP (0.0.0.0) and port (4000)
\ No newline at end of file
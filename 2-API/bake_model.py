@@ -0,0 +1,70 @@
+# Bake the pricing model into the image
+# Resolves MODEL_URI on the ML flow server and writes the model in a local folder copied by the Dockerfile:
+#   model/<name>-<version>/pipeline.joblib  sklearn Pipeline, uncompressed so that it is memory-mapped when loaded
+#   model/<name>-<version>/scorer.json      compiled scorer (see fast_scorer.py), if the Pipeline can be compiled
+#   model/<name>-<version>/meta.json        URI, name and version of the model
+#   model/<name>-<version>/profile.json     training profile logged with the model (most frequent categories...), if any
+#   model/current                           name of the folder served
+# The API then starts without mlflow / boto3 and without the ML flow server (see model_store.py).
+#
+# Terminal command (before docker build): python bake_model.py [--model-uri models:/lin_reg/latest] [--out model]
+import os
+import json
+import argparse
+from datetime import datetime, timezone
+
+import joblib
+
+from model_store import ModelStore, MODEL_URI, LOCAL_MODEL_DIR
+from fast_scorer import compile_pipeline
+
+
+def write_model(pipeline, out_dir, uri, name, version, profile=None):
+    """
+    Writes a fitted Pipeline in out_dir and makes it the current one. Returns the folder of the version.
+    """
+    model_dir = os.path.join(out_dir, f"{name or 'run'}-{os.path.basename(str(version))}")
+    os.makedirs(model_dir, exist_ok=True)
+    joblib.dump(pipeline, os.path.join(model_dir, "pipeline.joblib"))
+    try:
+        compile_pipeline(pipeline).save(os.path.join(model_dir, "scorer.json"))
+    except ValueError as error:
+        print(f"No compiled scorer: {error}")
+    with open(os.path.join(model_dir, "meta.json"), "w") as f:
+        json.dump({
+            "uri": uri,
+            "name": name,
+            "version": version,
+            "baked_at": datetime.now(timezone.utc).isoformat(),
+        }, f)
+    if profile is not None:
+        with open(os.path.join(model_dir, "profile.json"), "w") as f:
+            json.dump(profile, f)
+
+    # Switched last, so that a failed bake keeps the previous version
+    with open(os.path.join(out_dir, "current"), "w") as f:
+        f.write(os.path.basename(model_dir))
+    return model_dir
+
+
+def bake(uri=MODEL_URI, out_dir=LOCAL_MODEL_DIR):
+    """
+    Writes the model the URI resolves to in out_dir and makes it the current one.
+    Returns the folder of the baked version.
+    """
+    import mlflow
+
+    store = ModelStore(uri, reload_interval=0)
+    name, version, resolved_uri = store.resolve()
+    pipeline = mlflow.sklearn.load_model(resolved_uri)
+    return write_model(pipeline, out_dir, resolved_uri, name, version, store.load_profile(name, version, resolved_uri))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bake the pricing model in a local folder")
+    parser.add_argument("--model-uri", default=MODEL_URI, help="MLflow URI of the model (default: MODEL_URI)")
+    parser.add_argument("--out", default=LOCAL_MODEL_DIR, help="Local model folder (default: LOCAL_MODEL_DIR)")
+    args = parser.parse_args()
+
+    os.environ.setdefault("MLFLOW_TRACKING_URI", "https://mlfga.herokuapp.com/")
+    print(f"Model baked in {bake(args.model_uri, args.out)}")
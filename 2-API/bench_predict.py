@@ -0,0 +1,295 @@
+# Load test of the API
+# Starts the API locally on a stub model (the pricing Pipeline fitted on get_around_pricing_project.csv and
+# written as a baked model, see bake_model.py: no ML flow server needed), then sends /predict and
+# /predict/batch requests from `--concurrency` clients for `--duration` seconds. Cars are drawn from the
+# pricing dataset. Reports the requests per second, the p50 / p95 / p99 latencies per endpoint and the
+# memory of every server process, as JSON.
+#
+# Terminal commands (needs httpx):
+#   python bench_predict.py --concurrency 32 --duration 20 --mix predict:9,batch:1 --out results.json
+#   python bench_predict.py --workers 2 --env MICRO_BATCHING=1 --out micro_batching.json --compare results.json
+# The load is generated by one Python process: on a small machine it competes with the server for the CPU.
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import threading
+import subprocess
+
+import numpy as np
+import pandas as pd
+import psutil
+import httpx
+
+
+PRICING_CSV = "../1-ml_flow_tracking/get_around_pricing_project.csv"
+ENDPOINTS = {"predict": "/predict", "batch": "/predict/batch"}
+
+
+def fit_stub_model(csv_path, out_dir):
+    """
+    Fits the pricing Pipeline of 1-ml_flow_tracking on the whole dataset and writes it as a baked model
+    in out_dir. Returns (folder of the model, its URI): the API only serves a baked model of its MODEL_URI.
+    """
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import OneHotEncoder, StandardScaler
+    from sklearn.compose import ColumnTransformer
+    from sklearn.linear_model import LinearRegression
+    from bake_model import write_model
+
+    df = pd.read_csv(csv_path, index_col=0)
+    Y = df.pop("rental_price_per_day")
+    categorical_features = df.select_dtypes("object").columns
+    numerical_features = df.columns[~df.columns.isin(categorical_features)]
+    preprocessor = ColumnTransformer(
+        transformers=[
+            ("categorical_transformer", OneHotEncoder(drop='first', handle_unknown='ignore', sparse_output=False), categorical_features),
+            ("numerical_transformer", StandardScaler(), numerical_features)
+        ]
+    )
+    pipeline = Pipeline(steps=[("features_preprocessing", preprocessor), ("reg", LinearRegression())])
+    pipeline.fit(df, Y)
+    profile = {"most_frequent": {feature: df[feature].value_counts().idxmax() for feature in categorical_features}}
+    uri = f"stub:{os.path.abspath(csv_path)}"
+    return write_model(pipeline, out_dir, uri, "stub", "1", profile), uri
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(model_dir, model_uri, port, workers, env):
+    """
+    Starts the API (uvicorn, `workers` processes) on the model baked in model_dir from model_uri, and waits
+    until it answers.
+    """
+    server_env = dict(os.environ, LOCAL_MODEL_DIR=model_dir, MODEL_URI=model_uri, MODEL_RELOAD_INTERVAL="0", **env)
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=server_env)
+    deadline = time.monotonic() + 120
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The API stopped with code {process.returncode}")
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/model", timeout=1).status_code == 200:
+                return process
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("The API did not start in 120s")
+
+
+class MemorySampler:
+    """
+    Samples the memory of the server process and of its workers every `interval` seconds, in a thread.
+    Keeps the max RSS and USS (memory used by this process only, shared pages excluded) of each process.
+    """
+    def __init__(self, pid, interval=0.5):
+        self.root = psutil.Process(pid)
+        self.interval = interval
+        self.peaks = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def sample(self):
+        for process in [self.root] + self.root.children(recursive=True):
+            try:
+                memory = process.memory_full_info()
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+            peak = self.peaks.setdefault(process.pid, {"rss_mb": 0.0, "uss_mb": 0.0})
+            peak["rss_mb"] = max(peak["rss_mb"], memory.rss / 2**20)
+            peak["uss_mb"] = max(peak["uss_mb"], memory.uss / 2**20)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.sample()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return {str(pid): {key: round(value, 1) for key, value in peak.items()} for pid, peak in self.peaks.items()}
+
+
+def parse_mix(mix):
+    # "predict:9,batch:1" -> {"predict": 0.9, "batch": 0.1}
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.partition(":")
+        if name not in ENDPOINTS:
+            raise ValueError(f"Unknown endpoint {name!r}, expected one of {list(ENDPOINTS)}")
+        weights[name] = float(weight or 1)
+    total = sum(weights.values())
+    return {name: weight / total for name, weight in weights.items()}
+
+
+def make_payloads(df, nb_payloads, batch_size, seed):
+    """
+    Request bodies (already encoded) drawn from the pricing dataset: one car for /predict,
+    batch_size cars for /predict/batch.
+    """
+    rng = np.random.default_rng(seed)
+    rows = [json.dumps(row).encode() for row in json.loads(df.to_json(orient="records"))]
+    payloads = {"predict": [rows[i] for i in rng.integers(0, len(rows), nb_payloads)], "batch": []}
+    for _ in range(max(1, nb_payloads // batch_size)):
+        payloads["batch"].append(b"[" + b",".join(rows[i] for i in rng.integers(0, len(rows), batch_size)) + b"]")
+    return payloads
+
+
+async def drive(base_url, payloads, mix, concurrency, duration, warmup, seed):
+    """
+    Closed loop: `concurrency` clients send one request after the other for warmup + duration seconds.
+    Returns {endpoint: list of (status code, latency in seconds)} for the requests sent after the warmup.
+    """
+    results = {name: [] for name in mix}
+    names, probabilities = list(mix), list(mix.values())
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        start_time = time.perf_counter()
+        measure_from, end_time = start_time + warmup, start_time + warmup + duration
+
+        async def client_loop(index):
+            rng = np.random.default_rng(seed + index)
+            while True:
+                name = names[rng.choice(len(names), p=probabilities)]
+                body = payloads[name][rng.integers(len(payloads[name]))]
+                sent = time.perf_counter()
+                if sent >= end_time:
+                    return
+                try:
+                    response = await client.post(ENDPOINTS[name], content=body, headers={"Content-Type": "application/json"})
+                    status = response.status_code
+                except httpx.HTTPError:
+                    status = 0
+                if sent >= measure_from:
+                    results[name].append((status, time.perf_counter() - sent))
+
+        await asyncio.gather(*(client_loop(index) for index in range(concurrency)))
+    return results
+
+
+def summarize(results, duration, batch_size):
+    summary = {}
+    for name, requests in results.items():
+        latencies = np.array([latency for status, latency in requests if status == 200]) * 1000
+        statuses = [status for status, _ in requests]
+        endpoint = {
+            "nb_requests": len(requests),
+            "nb_errors": sum(status != 200 for status in statuses),
+            "nb_rejected": statuses.count(429),
+            "rps": round(len(latencies) / duration, 1),
+        }
+        if name == "batch":
+            endpoint["cars_per_second"] = round(len(latencies) * batch_size / duration, 1)
+        if len(latencies):
+            endpoint.update({
+                "latency_ms_mean": round(float(latencies.mean()), 3),
+                "latency_ms_p50": round(float(np.percentile(latencies, 50)), 3),
+                "latency_ms_p95": round(float(np.percentile(latencies, 95)), 3),
+                "latency_ms_p99": round(float(np.percentile(latencies, 99)), 3),
+                "latency_ms_max": round(float(latencies.max()), 3),
+            })
+        summary[name] = endpoint
+    return summary
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, baseline, max_regression):
+    """
+    Prints the change of every metric against a previous result file. Returns False if the RPS dropped
+    or the p99 latency rose by more than max_regression (ratio) on an endpoint.
+    """
+    ok = True
+    print(f"Compared with {baseline.get('commit')} ({baseline.get('date')}):")
+    for name, endpoint in results["endpoints"].items():
+        before = baseline["endpoints"].get(name)
+        if before is None:
+            continue
+        for metric in ("rps", "latency_ms_p50", "latency_ms_p95", "latency_ms_p99"):
+            if metric not in endpoint or not before.get(metric):
+                continue
+            change = endpoint[metric] / before[metric] - 1
+            print(f"  {name:8} {metric:15} {before[metric]:>10} -> {endpoint[metric]:>10} ({change:+.1%})")
+            if (metric == "rps" and change < -max_regression) or (metric == "latency_ms_p99" and change > max_regression):
+                ok = False
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test of the /predict endpoints")
+    parser.add_argument("--csv", default=PRICING_CSV, help="Pricing dataset (stub model and payloads)")
+    parser.add_argument("--concurrency", type=int, default=16, help="Number of concurrent clients")
+    parser.add_argument("--duration", type=float, default=20, help="Measured seconds")
+    parser.add_argument("--warmup", type=float, default=3, help="Seconds sent before measuring")
+    parser.add_argument("--mix", default="predict:1", help="Weights of the endpoints, e.g. predict:9,batch:1")
+    parser.add_argument("--batch-size", type=int, default=100, help="Cars per /predict/batch request")
+    parser.add_argument("--workers", type=int, default=1, help="Number of server processes")
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE setting of the API (repeatable), e.g. MICRO_BATCHING=1")
+    parser.add_argument("--url", help="Load test an API already running at this URL instead of starting one")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="Save the results in this JSON file")
+    parser.add_argument("--compare", help="Previous results file to compare with")
+    parser.add_argument("--max-regression", type=float, default=0.1, help="Max RPS drop / p99 rise accepted by --compare")
+    args = parser.parse_args()
+
+    env = dict(item.split("=", 1) for item in args.env)
+    mix = parse_mix(args.mix)
+    df = pd.read_csv(args.csv, index_col=0).drop(columns="rental_price_per_day")
+    payloads = make_payloads(df, 10000, args.batch_size, args.seed)
+
+    server, sampler = None, None
+    base_url = args.url
+    with tempfile.TemporaryDirectory() as model_dir:
+        if base_url is None:
+            _, model_uri = fit_stub_model(args.csv, model_dir)
+            port = free_port()
+            server = start_server(model_dir, model_uri, port, args.workers, env)
+            base_url = f"http://127.0.0.1:{port}"
+            sampler = MemorySampler(server.pid)
+            sampler.start()
+        try:
+            raw = asyncio.run(drive(base_url, payloads, mix, args.concurrency, args.duration, args.warmup, args.seed))
+        finally:
+            memory = sampler.stop() if sampler else None
+            if server:
+                server.terminate()
+                server.wait()
+
+    results = {
+        "commit": git_commit(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {
+            "concurrency": args.concurrency, "duration": args.duration, "mix": mix, "batch_size": args.batch_size,
+            "workers": args.workers, "env": env, "url": args.url, "cpu_count": os.cpu_count(),
+        },
+        "endpoints": summarize(raw, args.duration, args.batch_size),
+        "memory_per_process": memory,
+    }
+    print(json.dumps(results, indent=2))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            ok = compare(results, json.load(f), args.max_regression)
+        sys.exit(0 if ok else 1)
@@ -0,0 +1,71 @@
+# Startup benchmark of the API
+# Starts the API several times in fresh Python processes and measures the cold start:
+# - import_seconds: import of app.py (FastAPI, pandas, ...)
+# - load_seconds: model load (baked model of LOCAL_MODEL_DIR, or download from the ML flow server)
+# - first_prediction_seconds: first /predict prediction
+# - total_seconds: time to first prediction
+# Results are printed as JSON, with the median of each value, and the command fails if the median
+# time to first prediction is over the budget.
+#
+# Terminal command : python bench_startup.py [--runs 5] [--budget-seconds 3] [--out startup.json]
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+
+def measure():
+    # One cold start, in the current (fresh) process
+    start_time = time.perf_counter()
+    import app
+    imported = time.perf_counter()
+    if app.store.current is None:
+        app.store.load()
+    loaded = time.perf_counter()
+    app.predict_rows([dict(app.PredictionFeatures())])
+    predicted = time.perf_counter()
+    return {
+        "import_seconds": imported - start_time,
+        "load_seconds": loaded - imported,
+        "first_prediction_seconds": predicted - loaded,
+        "total_seconds": predicted - start_time,
+        "model_version": app.store.current.version,
+        "mlflow_imported": "mlflow" in sys.modules,
+        "boto3_imported": "boto3" in sys.modules,
+    }
+
+
+def run(nb_runs):
+    runs = []
+    for _ in range(nb_runs):
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child"], check=True,
+                                stdout=subprocess.PIPE, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        runs.append(json.loads(output.stdout.strip().splitlines()[-1]))
+    summary = {key: statistics.median(run[key] for run in runs) for key in runs[0] if key.endswith("_seconds")}
+    return {"runs": runs, "median": summary}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cold start benchmark of the API")
+    parser.add_argument("--runs", type=int, default=5, help="Number of cold starts")
+    parser.add_argument("--budget-seconds", type=float, default=float(os.environ.get("STARTUP_BUDGET_SECONDS", 3)),
+                        help="Max median time to first prediction")
+    parser.add_argument("--out", help="Also save the results in this JSON file")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure()))
+        sys.exit(0)
+
+    results = run(args.runs)
+    results["budget_seconds"] = args.budget_seconds
+    results["within_budget"] = results["median"]["total_seconds"] <= args.budget_seconds
+    print(json.dumps(results, indent=2))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+    sys.exit(0 if results["within_budget"] else 1)
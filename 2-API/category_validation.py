@@ -0,0 +1,158 @@
+# Validation of the categorical features before they reach the model
+# The categories known by the model (encoder vocabulary) are loaded with it as sets, so checking a request
+# is one set lookup per categorical feature. A category unknown by the model is handled according to
+# UNKNOWN_CATEGORY_POLICY:
+# - reject (default): the API answers 422, the model is not called
+# - other: replaced by "__other__" if the model has it (categories pooled at training, see
+#   retrain_incremental.py), otherwise by the most frequent category, otherwise rejected
+# - most_frequent: replaced by the most frequent category of the training data (training_profile.json
+#   logged with the model), otherwise by "__other__", otherwise rejected
+# An unknown category is never replaced by the reference (dropped) category of the encoder: that would
+# silently price the car as this real category. The features falling back to "reject" are listed in /model.
+import os
+import logging
+
+
+UNKNOWN_CATEGORY_POLICY = os.environ.get("UNKNOWN_CATEGORY_POLICY", "reject")
+POLICIES = ("reject", "other", "most_frequent")
+OTHER_CATEGORY = "__other__"
+
+logger = logging.getLogger(__name__)
+
+
+class UnknownCategory(Exception):
+    """
+    Categories unknown by the model: errors = list of (location, feature, value), location being the
+    position of the car in a batch (None for /predict).
+    """
+    def __init__(self, errors):
+        super().__init__(f"{len(errors)} unknown categories")
+        self.errors = errors
+
+    def detail(self, max_errors=20):
+        # Same format as the 422 errors of FastAPI
+        return [{
+            "loc": ["body"] + ([location] if location is not None else []) + [feature],
+            "msg": f"Unknown category {value!r} for {feature}",
+            "type": "value_error.unknown_category",
+        } for location, feature, value in self.errors[:max_errors]]
+
+
+def pipeline_vocabulary(pipeline):
+    # {feature: categories} of the OneHotEncoder of the Pipeline ("features_preprocessing" step)
+    from sklearn.preprocessing import OneHotEncoder
+
+    vocabulary = {}
+    for _, transformer, columns in pipeline.named_steps["features_preprocessing"].transformers_:
+        if isinstance(transformer, OneHotEncoder):
+            for feature, categories in zip(columns, transformer.categories_):
+                vocabulary[feature] = categories.tolist()
+    return vocabulary
+
+
+class CategoryValidator:
+    """
+    Known categories of each categorical feature and replacement of the unknown ones (None = reject).
+    Counts the unknown categories seen per feature.
+    """
+    def __init__(self, vocabulary, most_frequent=None, policy=UNKNOWN_CATEGORY_POLICY):
+        if policy not in POLICIES:
+            raise ValueError(f"UNKNOWN_CATEGORY_POLICY must be one of {POLICIES}, not {policy!r}")
+        self.policy = policy
+        self.vocabulary = {feature: frozenset(categories) for feature, categories in vocabulary.items()}
+        self.replacements = {}
+        for feature, categories in vocabulary.items():
+            if policy == "reject" or not categories:
+                self.replacements[feature] = None
+                continue
+            candidates = [OTHER_CATEGORY, (most_frequent or {}).get(feature)]
+            if policy == "most_frequent":
+                candidates.reverse()
+            replacement = next((candidate for candidate in candidates if candidate in self.vocabulary[feature]), None)
+            if replacement is None:
+                logger.warning("Neither %r nor a most frequent category known for %s, unknown categories will be rejected", OTHER_CATEGORY, feature)
+            elif replacement != candidates[0]:
+                logger.warning("No %r category for %s, unknown categories will be replaced by %r", candidates[0], feature, replacement)
+            self.replacements[feature] = replacement
+        self.nb_unknown = {feature: 0 for feature in vocabulary}
+
+    @classmethod
+    def from_model(cls, scorer, pipeline, profile=None, policy=UNKNOWN_CATEGORY_POLICY):
+        """
+        Validator of a loaded model: vocabulary of the compiled scorer if any (the Pipeline is not needed),
+        of the Pipeline otherwise. profile: training_profile.json of the model, if any.
+        """
+        vocabulary = {feature: list(table) for feature, table in scorer.categorical.items()} if scorer is not None else pipeline_vocabulary(pipeline)
+        return cls(vocabulary, (profile or {}).get("most_frequent"), policy)
+
+    def check_row(self, row, location=None):
+        """
+        Returns the row, with the unknown categories replaced (in a copy). Raises UnknownCategory for the rejected features.
+        """
+        errors = None
+        for feature, categories in self.vocabulary.items():
+            value = row[feature]
+            if value in categories:
+                continue
+            self.nb_unknown[feature] += 1
+            replacement = self.replacements[feature]
+            if replacement is None:
+                errors = (errors or []) + [(location, feature, value)]
+            else:
+                row = {**row, feature: replacement}
+        if errors:
+            raise UnknownCategory(errors)
+        return row
+
+    def check_rows(self, rows):
+        # Same as check_row for a batch: all the errors are reported
+        checked, errors = [], []
+        for location, row in enumerate(rows):
+            try:
+                checked.append(self.check_row(row, location))
+            except UnknownCategory as error:
+                errors += error.errors
+        if errors:
+            raise UnknownCategory(errors)
+        return checked
+
+    def check_columns(self, df, offset=0):
+        """
+        Same as check_row for a DataFrame (vectorized). Returns the DataFrame, with the unknown
+        categories replaced. offset: position of the first row in the file (error locations).
+        """
+        copied = False
+        for feature, categories in self.vocabulary.items():
+            unknown = ~df[feature].isin(categories).to_numpy()
+            nb_unknown = int(unknown.sum())
+            if not nb_unknown:
+                continue
+            self.nb_unknown[feature] += nb_unknown
+            replacement = self.replacements[feature]
+            if replacement is None:
+                positions = unknown.nonzero()[0][:100]
+                raise UnknownCategory([(offset + int(i), feature, df[feature].iloc[i]) for i in positions])
+            if not copied:
+                df, copied = df.copy(), True
+            df.loc[unknown, feature] = replacement
+        return df
+
+    @property
+    def rejected_features(self):
+        # Features whose unknown categories are rejected (all of them with the policy "reject")
+        return [feature for feature, replacement in self.replacements.items() if replacement is None]
+
+    def known_rows(self, df):
+        # Boolean mask of the rows without unknown categories in the rejected features (nothing counted or replaced)
+        known = True
+        for feature in self.rejected_features:
+            known = known & df[feature].isin(self.vocabulary[feature]).to_numpy()
+        return known
+
+    def stats(self):
+        return {
+            "policy": self.policy,
+            "replacements": {feature: replacement for feature, replacement in self.replacements.items() if replacement is not None},
+            "rejected_features": self.rejected_features,
+            "nb_unknown": dict(self.nb_unknown),
+        }
@@ -0,0 +1,101 @@
+# Delay analysis for a threshold
+# Answers "with a minimum delay of T minutes between 2 rentals on a scope, how many rentals are affected,
+# how many problematic cases are solved and how many opportunities are missed" from the index exported by
+# the dashboard (3-streamlit/threshold_engine.py): sorted time deltas per scope and metric, so a query is
+# one binary search per metric, whatever the threshold (not only the ones of the dashboard charts).
+# The file is read again when it changes (new dataset version), checked at most every DELAY_INDEX_RELOAD_INTERVAL seconds.
+import os
+import time
+import logging
+import zipfile
+import threading
+
+import numpy as np
+
+
+DELAY_INDEX_PATH = os.environ.get("DELAY_INDEX_PATH", "data/delay_index.npz")
+DELAY_INDEX_RELOAD_INTERVAL = float(os.environ.get("DELAY_INDEX_RELOAD_INTERVAL", 60))
+
+COMPLETE_SCOPE = "Complete scope"
+METRICS = ("rentals_affected", "cases_solved", "missed_opportunities")
+
+logger = logging.getLogger(__name__)
+
+
+class UnknownScope(Exception):
+    """
+    Scope not in the index.
+    """
+
+
+class DelayIndex:
+    """
+    Index of one dataset version: {scope: {metric: sorted time deltas}}, and the cumulative revenue of the
+    rentals sorted by time delta if the index was exported with the revenue.
+    """
+    def __init__(self, arrays):
+        self.data_version = str(arrays["data_version"])
+        self.scopes = {}
+        for i, scope in enumerate(arrays["scopes"].tolist()):
+            self.scopes[scope] = {
+                "nb_rentals": int(arrays["nb_rentals"][i]),
+                "total_revenue": float(arrays["total_revenue"][i]) if "total_revenue" in arrays else None,
+                "revenue_lost": arrays.get(f"revenue_lost_{i}"),
+                **{metric: arrays[f"{metric}_{i}"] for metric in METRICS},
+            }
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as npz:
+            return cls({key: npz[key] for key in npz.files})
+
+    def query(self, threshold, scope=COMPLETE_SCOPE):
+        """
+        Metrics for a threshold in minutes: rentals whose time delta with the previous rental is <= threshold.
+        """
+        if scope not in self.scopes:
+            raise UnknownScope(f"Unknown scope {scope!r}, expected one of {list(self.scopes)}")
+        index = self.scopes[scope]
+        result = {"threshold": threshold, "scope": scope, "data_version": self.data_version, "nb_rentals": index["nb_rentals"]}
+        for metric in METRICS:
+            result[metric] = int(np.searchsorted(index[metric], threshold, side="right"))
+        # Problematic cases solved with the longest threshold
+        result["problematic_cases"] = len(index["cases_solved"])
+        if index["revenue_lost"] is not None:
+            cumulated = index["revenue_lost"]
+            result["revenue_lost"] = float(cumulated[result["rentals_affected"] - 1]) if result["rentals_affected"] else 0.0
+            result["total_revenue"] = index["total_revenue"]
+        return result
+
+
+class DelayIndexFile:
+    """
+    DelayIndex of DELAY_INDEX_PATH, loaded on first use and again when the file changes.
+    """
+    def __init__(self, path=DELAY_INDEX_PATH, reload_interval=DELAY_INDEX_RELOAD_INTERVAL):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._index = None
+        self._mtime = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        # Current index, None if the file does not exist
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.reload_interval:
+            return self._index
+        with self._lock:
+            self._checked_at = now
+            try:
+                mtime = os.path.getmtime(self.path)
+            except OSError:
+                return self._index
+            if mtime != self._mtime:
+                try:
+                    self._index, self._mtime = DelayIndex.load(self.path), mtime
+                    logger.info("Delay index %s loaded (dataset version %s)", self.path, self._index.data_version)
+                except (OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile):
+                    # Partial or corrupted file: the previous index is kept, and the file read again when it changes
+                    logger.exception("Could not load the delay index %s", self.path)
+            return self._index
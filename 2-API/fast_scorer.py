@@ -0,0 +1,192 @@
+# Pure-NumPy scoring engine for the pricing model
+# The trained Pipeline is ColumnTransformer(OneHotEncoder(drop='first'), StandardScaler) + LinearRegression,
+# so a prediction is: intercept + one weight per category + dot product on the numerical features.
+# `compile_pipeline` flattens the fitted Pipeline into those weights (the scaler means and scales are
+# folded into the linear weights), and `FastScorer` computes predictions without pandas or sklearn.
+#
+# Export and parity check against the Pipeline:
+#   python fast_scorer.py --csv ../1-ml_flow_tracking/get_around_pricing_project.csv --out fast_scorer.json
+import os
+import json
+import argparse
+
+import numpy as np
+
+
+class FastScorer:
+    """
+    Linear pricing model flattened into:
+    - categorical: {feature: {category: weight}} (weight 0 for the dropped category)
+    - numerical_names / numerical_weights: weights applied to the raw (unscaled) values
+    - intercept
+    `handle_unknown` follows the OneHotEncoder: "error" raises on an unknown category,
+    "ignore" gives it a weight of 0.
+    """
+    def __init__(self, intercept, categorical, numerical_names, numerical_weights, handle_unknown="error"):
+        self.intercept = float(intercept)
+        self.categorical = categorical
+        self.numerical_names = list(numerical_names)
+        self.numerical_weights = np.asarray(numerical_weights, dtype=float)
+        self.handle_unknown = handle_unknown
+        self._numerical_items = list(zip(self.numerical_names, self.numerical_weights.tolist()))
+
+    @property
+    def feature_names(self):
+        return list(self.categorical) + self.numerical_names
+
+    def _weight(self, feature, category):
+        try:
+            return self.categorical[feature][category]
+        except KeyError:
+            if self.handle_unknown == "ignore":
+                return 0.0
+            raise ValueError(f"Found unknown category {category!r} for {feature}")
+
+    def predict_one(self, row):
+        """
+        Prediction for one car given as a dict of features (plain Python, no array created).
+        """
+        value = self.intercept
+        for feature in self.categorical:
+            value += self._weight(feature, row[feature])
+        for name, weight in self._numerical_items:
+            value += weight * row[name]
+        return value
+
+    def predict(self, columns):
+        """
+        Predictions for a batch given as a DataFrame or a dict of columns {feature: values}.
+        """
+        nb_rows = len(columns[self.numerical_names[0]]) if self.numerical_names else len(columns[next(iter(self.categorical))])
+        prediction = np.full(nb_rows, self.intercept)
+        for feature in self.categorical:
+            prediction += np.fromiter((self._weight(feature, category) for category in columns[feature]), dtype=float, count=nb_rows)
+        if self.numerical_names:
+            numerical = np.column_stack([np.asarray(columns[name], dtype=float) for name in self.numerical_names])
+            prediction += numerical @ self.numerical_weights
+        return prediction
+
+    def to_dict(self):
+        return {
+            "intercept": self.intercept,
+            "categorical": self.categorical,
+            "numerical_names": self.numerical_names,
+            "numerical_weights": self.numerical_weights.tolist(),
+            "handle_unknown": self.handle_unknown,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+
+def compile_pipeline(pipeline):
+    """
+    Flattens a fitted Pipeline(("features_preprocessing", ColumnTransformer), ("reg", linear model))
+    into a FastScorer. Raises ValueError if a step cannot be expressed as linear weights.
+    """
+    from sklearn.preprocessing import OneHotEncoder, StandardScaler
+
+    preprocessor = pipeline.named_steps["features_preprocessing"]
+    regressor = pipeline.named_steps["reg"]
+    if not hasattr(regressor, "coef_"):
+        raise ValueError(f"{type(regressor).__name__} is not a linear model")
+    coef = np.ravel(regressor.coef_)
+    if coef.shape[0] != len(preprocessor.get_feature_names_out()):
+        raise ValueError("The regressor does not have one coefficient per preprocessed feature")
+
+    intercept = float(np.ravel(regressor.intercept_)[0])
+    categorical = {}
+    numerical_names = []
+    numerical_weights = []
+    handle_unknown = "error"
+
+    for name, transformer, columns in preprocessor.transformers_:
+        if transformer == "drop":
+            continue
+        weights = coef[preprocessor.output_indices_[name]]
+        columns = list(columns)
+
+        if isinstance(transformer, OneHotEncoder):
+            if getattr(transformer, "infrequent_categories_", None) is not None and any(
+                    categories is not None for categories in transformer.infrequent_categories_):
+                raise ValueError("Infrequent categories are not supported")
+            handle_unknown = "ignore" if transformer.handle_unknown != "error" else "error"
+            drop_idx = transformer.drop_idx_ if transformer.drop_idx_ is not None else [None] * len(columns)
+            position = 0
+            for feature, categories, drop in zip(columns, transformer.categories_, drop_idx):
+                table = {}
+                for index, category in enumerate(categories.tolist()):
+                    if drop is not None and index == drop:
+                        table[category] = 0.0
+                    else:
+                        table[category] = float(weights[position])
+                        position += 1
+                categorical[feature] = table
+
+        elif isinstance(transformer, StandardScaler):
+            mean = transformer.mean_ if transformer.mean_ is not None else np.zeros(len(columns))
+            scale = transformer.scale_ if transformer.scale_ is not None else np.ones(len(columns))
+            # w * (x - mean) / scale = (w / scale) * x - w * mean / scale
+            folded = weights / scale
+            intercept -= float(np.dot(folded, mean))
+            numerical_names += columns
+            numerical_weights += folded.tolist()
+
+        elif transformer == "passthrough":
+            numerical_names += columns
+            numerical_weights += weights.tolist()
+
+        else:
+            raise ValueError(f"Transformer {name} ({type(transformer).__name__}) cannot be compiled")
+
+    return FastScorer(intercept, categorical, numerical_names, numerical_weights, handle_unknown)
+
+
+def check_parity(pipeline, scorer, df, atol=1e-6):
+    """
+    Compares the scorer with Pipeline.predict on the rows of df whose categories are known
+    by the model. Returns (number of rows compared, max absolute difference).
+    """
+    known = np.ones(len(df), dtype=bool)
+    for feature, table in scorer.categorical.items():
+        known &= df[feature].isin(list(table)).to_numpy()
+    df = df[known]
+    expected = pipeline.predict(df)
+    max_difference = float(np.max(np.abs(scorer.predict(df) - expected))) if len(df) else 0.0
+    one_by_one = max((abs(scorer.predict_one(row) - value) for row, value in zip(df.to_dict("records"), expected)), default=0.0)
+    max_difference = max(max_difference, one_by_one)
+    if max_difference > atol:
+        raise AssertionError(f"Scorer differs from Pipeline.predict by {max_difference}")
+    return len(df), max_difference
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile the pricing Pipeline into a FastScorer artifact")
+    parser.add_argument("--model-uri", default=os.environ.get("MODEL_URI"), help="MLflow URI of the model (default: MODEL_URI)")
+    parser.add_argument("--csv", default="../1-ml_flow_tracking/get_around_pricing_project.csv", help="Dataset used for the parity check")
+    parser.add_argument("--out", default="fast_scorer.json", help="Path of the exported scorer")
+    args = parser.parse_args()
+
+    import pandas as pd
+    import mlflow
+
+    mlflow.set_tracking_uri(os.environ.get("MLFLOW_TRACKING_URI", "https://mlfga.herokuapp.com/"))
+    pipeline = mlflow.sklearn.load_model(args.model_uri)
+    scorer = compile_pipeline(pipeline)
+
+    df = pd.read_csv(args.csv, index_col=0).drop(columns="rental_price_per_day", errors="ignore")
+    nb_rows, max_difference = check_parity(pipeline, scorer, df)
+    print(f"Parity check on {nb_rows} rows: max difference {max_difference:.2e}")
+
+    scorer.save(args.out)
+    print(f"Scorer saved to {args.out}")
@@ -0,0 +1,124 @@
+# Execution model for predictions
+# pandas / sklearn work is CPU-bound and blocking: it runs in a bounded pool of threads (or processes)
+# instead of the asyncio event loop, so one slow prediction does not stall the other requests.
+# When too many predictions are already waiting, new ones are rejected (HTTP 429) instead of piling up.
+# Background work (streamed responses, jobs) is not counted in that limit: it waits for one of its own
+# INFERENCE_BACKGROUND_WORKERS slots instead, so it never takes all the workers from the requests.
+import os
+import asyncio
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+
+# "thread" or "process". Processes are forked from the API worker, so they share its loaded model
+INFERENCE_EXECUTOR = os.environ.get("INFERENCE_EXECUTOR", "thread")
+# Number of threads / processes running predictions
+INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", 4))
+# Max number of predictions running or waiting in the pool before new ones are rejected
+INFERENCE_QUEUE_SIZE = int(os.environ.get("INFERENCE_QUEUE_SIZE", 64))
+# Max number of background predictions (call()) running at the same time, the next ones wait
+INFERENCE_BACKGROUND_WORKERS = int(os.environ.get("INFERENCE_BACKGROUND_WORKERS", max(1, INFERENCE_WORKERS // 2)))
+
+
+class PoolFull(Exception):
+    """
+    Raised when the pool already holds INFERENCE_QUEUE_SIZE predictions.
+    """
+
+
+class InferencePool:
+    """
+    Bounded pool running prediction functions.
+
+    Functions and arguments must be picklable with the "process" executor: use module-level
+    functions reading the model from the module-level store (inherited by the forked processes).
+    """
+    def __init__(self, executor=INFERENCE_EXECUTOR, workers=INFERENCE_WORKERS, queue_size=INFERENCE_QUEUE_SIZE,
+                 background_workers=INFERENCE_BACKGROUND_WORKERS):
+        self.executor_type = executor
+        self.workers = workers
+        self.queue_size = queue_size
+        self.background_workers = background_workers
+        self.pending = 0
+        self.background_pending = 0
+        self._background_slots = threading.Semaphore(background_workers)
+        self.nb_rejected = 0
+        self._lock = threading.Lock()
+        self._executor = None # created on first use, i.e. after the model is loaded
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                if self.executor_type == "process":
+                    # fork (not spawn) so that processes start with the model already in memory
+                    self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("fork"))
+                else:
+                    self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="inference")
+            return self._executor
+
+    def restart(self):
+        """
+        Replaces the processes, e.g. after a model reload (forked processes keep the model they
+        were created with). Predictions already submitted finish on the old processes.
+        """
+        if self.executor_type != "process":
+            return
+        with self._lock:
+            old_executor, self._executor = self._executor, None
+        if old_executor is not None:
+            old_executor.shutdown(wait=False)
+
+    def _acquire(self):
+        with self._lock:
+            if self.pending >= self.queue_size:
+                self.nb_rejected += 1
+                raise PoolFull(f"{self.pending} predictions already in progress")
+            self.pending += 1
+
+    def _release(self, *_):
+        with self._lock:
+            self.pending -= 1
+
+    async def run(self, function, *args):
+        """
+        Runs function(*args) in the pool and waits for the result without blocking the event loop.
+        Raises PoolFull right away if the pool is full.
+        """
+        self._acquire()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._get_executor(), function, *args)
+        finally:
+            self._release()
+
+    def call(self, function, *args):
+        """
+        Blocking version of run() for code already running outside the event loop (streamed
+        responses, jobs). It waits for a background slot instead of raising PoolFull, since a response
+        already started cannot be turned into a 429, and is not counted in pending.
+        """
+        with self._background_slots:
+            with self._lock:
+                self.background_pending += 1
+            try:
+                return self._get_executor().submit(function, *args).result()
+            finally:
+                with self._lock:
+                    self.background_pending -= 1
+
+    def stats(self):
+        return {
+            "executor": self.executor_type,
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "pending": self.pending,
+            "background_workers": self.background_workers,
+            "background_pending": self.background_pending,
+            "nb_rejected": self.nb_rejected,
+        }
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
@@ -0,0 +1,397 @@
+# Offline scoring jobs
+# Files too big for /predict/batch/file (or that would take longer than an HTTP request) are submitted as jobs:
+# the file is read chunk by chunk (JOB_CHUNK_SIZE rows), the chunks are scored in parallel by JOB_WORKERS
+# threads and each scored chunk is written as a checkpoint file (jobs/<job id>/chunks/). If the API stops
+# in the middle of a job, the job is resumed from its checkpoints instead of starting again. When all the
+# chunks are scored, they are merged into jobs/<job id>/result.parquet (row position + prediction).
+#
+# The state of the jobs is kept in a JobStore: SQLiteJobStore (jobs/jobs.sqlite) works for one machine,
+# shared by all the gunicorn workers. Another backend (a database shared by several machines, with JOBS_DIR
+# on a shared volume) only needs the methods of JobStore. A job is run by the worker that claims it: the
+# claim is atomic, and a running job whose heartbeat is older than JOB_STALE_SECONDS (its worker died) can
+# be claimed again by another worker.
+import os
+import abc
+import time
+import uuid
+import shutil
+import socket
+import sqlite3
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from model_store import ModelChanged
+
+
+JOBS_DIR = os.environ.get("JOBS_DIR", "jobs")
+# Server folder of the files that can be submitted by path (instead of uploaded)
+JOB_INPUT_DIR = os.environ.get("JOB_INPUT_DIR", "data")
+JOB_CHUNK_SIZE = int(os.environ.get("JOB_CHUNK_SIZE", 50000))
+# Threads scoring the chunks of a job (one job at a time per API worker)
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+# A running job without heartbeat for this long is resumed by another worker
+JOB_STALE_SECONDS = float(os.environ.get("JOB_STALE_SECONDS", 120))
+# Interval between two looks for jobs to resume (queued, or stale), 0 = only at startup
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", 30))
+# "sqlite" (JOBS_DIR/jobs.sqlite)
+JOB_STORE = os.environ.get("JOB_STORE", "sqlite")
+
+logger = logging.getLogger(__name__)
+
+
+class JobStore(abc.ABC):
+    """
+    State of the jobs: one dict per job, with the keys of SQLiteJobStore.COLUMNS.
+    """
+    @abc.abstractmethod
+    def create(self, job_id, source, input_format, chunk_size):
+        """
+        Adds a queued job.
+        """
+
+    @abc.abstractmethod
+    def get(self, job_id):
+        """
+        Job dict, or None if unknown.
+        """
+
+    @abc.abstractmethod
+    def update(self, job_id, **fields):
+        """
+        Sets the given columns of the job.
+        """
+
+    @abc.abstractmethod
+    def claim(self, job_id, owner, stale_seconds):
+        """
+        Atomically marks the job as running by owner if it is queued, or running with a heartbeat older
+        than stale_seconds. Returns True if the job was claimed.
+        """
+
+    @abc.abstractmethod
+    def unfinished(self):
+        """
+        Ids of the queued and running jobs, oldest first.
+        """
+
+
+class SQLiteJobStore(JobStore):
+    """
+    Jobs in a SQLite file, shared by the processes of the machine.
+    """
+    COLUMNS = ("id", "status", "source", "input_format", "chunk_size", "model_version", "nb_chunks_done",
+               "nb_rows_done", "nb_rows", "owner", "heartbeat", "created_at", "started_at", "finished_at", "error")
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # One connection per process, opened on first use: a SQLite connection must not cross a fork (gunicorn --preload)
+        connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY, status TEXT NOT NULL, source TEXT NOT NULL, input_format TEXT NOT NULL,
+                chunk_size INTEGER NOT NULL, model_version TEXT, nb_chunks_done INTEGER DEFAULT 0,
+                nb_rows_done INTEGER DEFAULT 0, nb_rows INTEGER, owner TEXT, heartbeat REAL,
+                created_at REAL NOT NULL, started_at REAL, finished_at REAL, error TEXT
+            )""")
+        return connection
+
+    def _execute(self, query, parameters=()):
+        with self._lock:
+            if self._pid != os.getpid():
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                self._connection, self._pid = self._connect(), os.getpid()
+            return self._connection.execute(query, parameters)
+
+    def create(self, job_id, source, input_format, chunk_size):
+        self._execute("INSERT INTO jobs (id, status, source, input_format, chunk_size, created_at) VALUES (?, 'queued', ?, ?, ?, ?)",
+                      (job_id, source, input_format, chunk_size, time.time()))
+
+    def get(self, job_id):
+        row = self._execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def update(self, job_id, **fields):
+        unknown = set(fields) - set(self.COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown job fields: {sorted(unknown)}")
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        self._execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    def claim(self, job_id, owner, stale_seconds):
+        now = time.time()
+        cursor = self._execute(
+            "UPDATE jobs SET status = 'running', owner = ?, heartbeat = ?, started_at = COALESCE(started_at, ?) "
+            "WHERE id = ? AND (status = 'queued' OR (status = 'running' AND (heartbeat IS NULL OR heartbeat < ?)))",
+            (owner, now, now, job_id, now - stale_seconds))
+        return cursor.rowcount == 1
+
+    def unfinished(self):
+        rows = self._execute("SELECT id FROM jobs WHERE status IN ('queued', 'running') ORDER BY created_at").fetchall()
+        return [row["id"] for row in rows]
+
+
+def make_job_store(kind=JOB_STORE, jobs_dir=JOBS_DIR):
+    if kind == "sqlite":
+        return SQLiteJobStore(os.path.join(jobs_dir, "jobs.sqlite"))
+    raise ValueError(f"JOB_STORE must be 'sqlite', not {kind!r}")
+
+
+def read_chunks(path, input_format, chunk_size):
+    # DataFrames of chunk_size rows of a CSV or Parquet file, always cut at the same rows (resumed jobs)
+    if input_format == "parquet":
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, chunksize=chunk_size)
+
+
+def input_format_of(filename):
+    return "parquet" if filename.endswith(".parquet") else "csv"
+
+
+def resolve_input_path(path, input_dir=JOB_INPUT_DIR):
+    """
+    Absolute path of a file submitted by path: it must be in JOB_INPUT_DIR (no other file of the server
+    can be read). Raises ValueError otherwise.
+    """
+    root = os.path.realpath(input_dir)
+    resolved = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, resolved]) != root:
+        raise ValueError(f"{path} is not in the input folder")
+    if not os.path.isfile(resolved):
+        raise ValueError(f"{path} does not exist")
+    return resolved
+
+
+class JobInterrupted(Exception):
+    """
+    Raised in a job when the API stops: the job goes back to the queue.
+    """
+
+
+class JobRunner:
+    """
+    Runs the jobs claimed by this process, one at a time, their chunks in parallel.
+
+    score(chunk, version) returns the predictions of a DataFrame by that model version (None for the rows
+    that cannot be scored) or raises ModelChanged, model_version() the version of the model served, columns
+    the features the file must have.
+    A job is scored by one model version: if the version changed when a job is resumed (or while it
+    runs, after a hot reload), its checkpoints are dropped and the job starts again.
+    """
+    def __init__(self, store, score, model_version, columns, jobs_dir=JOBS_DIR, workers=JOB_WORKERS,
+                 stale_seconds=JOB_STALE_SECONDS, poll_interval=JOB_POLL_INTERVAL):
+        self.store = store
+        self.score = score
+        self.model_version = model_version
+        self.columns = columns
+        self.jobs_dir = jobs_dir
+        self.workers = workers
+        self.stale_seconds = stale_seconds
+        self.poll_interval = poll_interval
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.nb_chunks_scored = 0
+        self._jobs = None
+        self._chunks = None
+        self._stop = threading.Event()
+        self._poller = None
+        self._submitted = set() # jobs queued in this process
+        self._lock = threading.Lock()
+
+    def job_dir(self, job_id):
+        return os.path.join(os.path.abspath(self.jobs_dir), job_id)
+
+    def result_path(self, job_id):
+        return os.path.join(self.job_dir(job_id), "result.parquet")
+
+    def new_job(self):
+        # Id and folder of a new job (an uploaded file is written in the folder before the job is created)
+        job_id = uuid.uuid4().hex
+        os.makedirs(os.path.join(self.job_dir(job_id), "chunks"), exist_ok=True)
+        return job_id
+
+    def create(self, job_id, source, input_format, chunk_size=JOB_CHUNK_SIZE):
+        # Queued job scoring the file source: from now on any worker can claim it
+        self.store.create(job_id, source, input_format, chunk_size)
+
+    def submit(self, job_id):
+        """
+        Queues the job in this process. It is claimed when it starts: if another worker claimed it
+        meanwhile (or it is already running in a live worker), it is skipped.
+        """
+        with self._lock:
+            if self._jobs is None or self._stop.is_set() or job_id in self._submitted:
+                return
+            self._submitted.add(job_id)
+            self._jobs.submit(self._run, job_id)
+
+    def resume(self):
+        # Jobs queued, or left running by a worker that stopped
+        for job_id in self.store.unfinished():
+            self.submit(job_id)
+
+    def start(self):
+        # Executors created here, i.e. in the worker process (not in the gunicorn master with --preload)
+        self._stop.clear()
+        self._submitted.clear()
+        self._chunks = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="job-chunk")
+        self._jobs = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job")
+        self.resume()
+        if self.poll_interval > 0:
+            self._poller = threading.Thread(target=self._poll, daemon=True, name="job-poller")
+            self._poller.start()
+
+    def stop(self):
+        # The job in progress is interrupted after its current chunks and goes back to the queue
+        self._stop.set()
+        with self._lock:
+            executors, self._jobs = (self._jobs, self._chunks), None
+        if executors[0] is not None:
+            executors[0].shutdown(wait=True, cancel_futures=True)
+            executors[1].shutdown(wait=True)
+            self._chunks = None
+
+    def _poll(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.resume()
+            except Exception:
+                logger.exception("Could not look for jobs to resume")
+
+    def _run(self, job_id):
+        try:
+            if not self.store.claim(job_id, self.owner, self.stale_seconds):
+                return
+            self._process(self.store.get(job_id))
+        except JobInterrupted:
+            logger.info("Job %s interrupted, back in the queue", job_id)
+            self.store.update(job_id, status="queued", owner=None, heartbeat=None)
+        except Exception as error:
+            logger.exception("Job %s failed", job_id)
+            self.store.update(job_id, status="failed", error=f"{type(error).__name__}: {error}", finished_at=time.time())
+        finally:
+            with self._lock:
+                self._submitted.discard(job_id)
+
+    def _chunk_path(self, job_id, index):
+        return os.path.join(self.job_dir(job_id), "chunks", f"{index:06d}.parquet")
+
+    def _score_chunk(self, job_id, index, start, version, chunk):
+        try:
+            predictions = self.score(chunk, version)
+        except ModelChanged:
+            # Hot reload while the chunk was scored: no checkpoint, the job starts again (see _process)
+            return 0
+        scored = pd.DataFrame({
+            "row": np.arange(start, start + len(chunk), dtype=np.int64),
+            "prediction": pd.array(predictions, dtype="Float64"),
+        })
+        # Written under another name then renamed: a checkpoint file is always complete
+        path = self._chunk_path(job_id, index)
+        scored.to_parquet(path + ".tmp", index=False)
+        os.replace(path + ".tmp", path)
+        self.nb_chunks_scored += 1
+        return len(chunk)
+
+    def _process(self, job):
+        job_id = job["id"]
+        version = str(self.model_version())
+        if job["model_version"] is not None and job["model_version"] != version:
+            logger.info("Job %s was started with model version %s, scored again with version %s", job_id, job["model_version"], version)
+            shutil.rmtree(os.path.join(self.job_dir(job_id), "chunks"), ignore_errors=True)
+        os.makedirs(os.path.join(self.job_dir(job_id), "chunks"), exist_ok=True)
+        self.store.update(job_id, model_version=version)
+
+        nb_chunks = nb_rows = 0
+        pending = deque()
+
+        def wait_oldest():
+            nonlocal nb_rows
+            nb_rows += pending.popleft().result()
+            self.store.update(job_id, nb_chunks_done=nb_chunks - len(pending), nb_rows_done=nb_rows, heartbeat=time.time())
+
+        start = 0
+        for index, chunk in enumerate(read_chunks(job["source"], job["input_format"], job["chunk_size"])):
+            if self._stop.is_set():
+                while pending:
+                    wait_oldest()
+                raise JobInterrupted()
+            if str(self.model_version()) != version:
+                while pending:
+                    wait_oldest()
+                return self._process(self.store.get(job_id))
+            if index == 0:
+                missing_columns = [name for name in self.columns if name not in chunk.columns]
+                if missing_columns:
+                    raise ValueError(f"Missing columns: {', '.join(missing_columns)}")
+            nb_chunks += 1
+            if os.path.exists(self._chunk_path(job_id, index)):
+                # Scored before the job was interrupted
+                nb_rows += len(chunk)
+            else:
+                pending.append(self._chunks.submit(self._score_chunk, job_id, index, start, version, chunk))
+                # At most 2 chunks per thread in memory
+                while len(pending) >= 2 * self.workers:
+                    wait_oldest()
+            start += len(chunk)
+        while pending:
+            wait_oldest()
+        if str(self.model_version()) != version:
+            return self._process(self.store.get(job_id))
+
+        self._merge(job_id, nb_chunks)
+        self.store.update(job_id, status="done", nb_chunks_done=nb_chunks, nb_rows_done=nb_rows, nb_rows=nb_rows,
+                          finished_at=time.time(), error=None)
+        logger.info("Job %s done: %d rows in %d chunks", job_id, nb_rows, nb_chunks)
+
+    def _merge(self, job_id, nb_chunks):
+        # Checkpoints -> one Parquet file (one row group per chunk), then the checkpoints are removed
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        path = self.result_path(job_id)
+        schema = pa.schema([("row", pa.int64()), ("prediction", pa.float64())])
+        with pq.ParquetWriter(path + ".tmp", schema) as writer:
+            for index in range(nb_chunks):
+                writer.write_table(pq.read_table(self._chunk_path(job_id, index), schema=schema))
+        os.replace(path + ".tmp", path)
+        shutil.rmtree(os.path.join(self.job_dir(job_id), "chunks"), ignore_errors=True)
+
+    def info(self, job_id):
+        # Public view of a job, None if unknown
+        job = self.store.get(job_id)
+        if job is None:
+            return None
+        return {
+            "job_id": job["id"],
+            "status": job["status"],
+            "model_version": job["model_version"],
+            "nb_chunks_done": job["nb_chunks_done"],
+            "nb_rows_done": job["nb_rows_done"],
+            "nb_rows": job["nb_rows"],
+            "created_at": job["created_at"],
+            "started_at": job["started_at"],
+            "finished_at": job["finished_at"],
+            "error": job["error"],
+        }
+
+    def iter_csv(self, job_id):
+        # Result as CSV text, one row group (chunk) at a time
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(self.result_path(job_id))
+        for group in range(parquet_file.num_row_groups):
+            yield parquet_file.read_row_group(group).to_pandas().to_csv(index=False, header=group == 0)
@@ -0,0 +1,251 @@
+# Metrics of the API in the Prometheus text format (endpoint /metrics)
+# A few counters and histograms kept in memory by each worker: updating one is a dict lookup and an
+# addition under a lock, cheap enough to stay on under load. The middleware measures every request
+# and `stage_timer` the stages of a prediction (validation, cache, DataFrame, model...).
+#
+# A request sent with the header "X-Profile: 1" is profiled when PROFILE_REQUESTS=1: with pyinstrument
+# (sampling profiler) if installed, cProfile otherwise. The profile is written in PROFILE_DIR and its path
+# returned in the X-Profile-Path response header.
+import os
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+
+
+PROFILE_REQUESTS = os.environ.get("PROFILE_REQUESTS", "0") == "1"
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+
+# Latency buckets in seconds, from 100 microseconds (compiled scorer) to 10 seconds (big batches)
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Batch size buckets in rows
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 1000, 5000, 20000, 100000)
+
+logger = logging.getLogger(__name__)
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{str(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    """
+    Value that only goes up, one per combination of labels.
+    """
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield self.name, _format_labels(self.labelnames, key), value
+
+
+class Histogram:
+    """
+    Distribution of observed values in fixed buckets (upper bounds), one per combination of labels.
+    """
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {} # labels -> [count per bucket (+Inf last), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][index] += 1
+            counts[1] += value
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        for key, counts, total in values:
+            cumulated = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulated += count
+                yield self.name + "_bucket", _format_labels(self.labelnames, key, [("le", bound)]), cumulated
+            yield self.name + "_sum", _format_labels(self.labelnames, key), total
+            yield self.name + "_count", _format_labels(self.labelnames, key), cumulated
+
+
+class Gauge:
+    """
+    Value read when /metrics is called: `function` returns a number, or a dict {label value: number}
+    for a gauge with one label. kind="counter" for a total kept elsewhere (e.g. cache hits).
+    """
+    def __init__(self, name, help, function, labelname=None, kind="gauge"):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.labelname = labelname
+        self.kind = kind
+
+    def samples(self):
+        value = self.function()
+        if value is None:
+            return
+        if self.labelname is None:
+            yield self.name, "", value
+        else:
+            for label, item in value.items():
+                yield self.name, _format_labels((self.labelname,), (label,)), item
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def gauge(self, name, help, function, labelname=None, kind="gauge"):
+        return self.register(Gauge(name, help, function, labelname, kind))
+
+    def render(self):
+        """
+        All the metrics in the Prometheus text format.
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            try:
+                for name, labels, value in metric.samples():
+                    lines.append(f"{name}{labels} {_format_value(value)}")
+            except Exception:
+                # a broken gauge must not hide the other metrics
+                logger.exception("Metric %s cannot be read", metric.name)
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+REQUESTS = registry.counter("api_requests_total", "Requests by endpoint and status code", ("endpoint", "status"))
+REQUEST_SECONDS = registry.histogram("api_request_seconds", "Request latency by endpoint", ("endpoint",))
+STAGE_SECONDS = registry.histogram("api_stage_seconds", "Time spent in each stage of a prediction", ("stage",))
+BATCH_SIZE = registry.histogram("api_batch_size", "Number of cars per prediction request", ("endpoint",), SIZE_BUCKETS)
+
+
+@contextmanager
+def stage_timer(stage):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start_time, stage=stage)
+
+
+def request_started(request):
+    # Time the request reached the middleware (None if it did not go through it)
+    return request.scope.get("state", {}).get("metrics_start_time")
+
+
+class Profile:
+    """
+    Profiles one request with pyinstrument if installed, cProfile otherwise, and writes the report in PROFILE_DIR.
+    """
+    def __init__(self, path):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        self.path = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{time.perf_counter_ns() % 10**6:06d}-{os.getpid()}-{path.strip('/').replace('/', '_') or 'index'}")
+        try:
+            from pyinstrument import Profiler
+            self.profiler = Profiler(async_mode="enabled")
+            self.path += ".html"
+        except ImportError:
+            import cProfile
+            # cProfile is not async aware: it also records the other requests running at the same time
+            self.profiler = cProfile.Profile()
+            self.path += ".prof"
+
+    def start(self):
+        if hasattr(self.profiler, "enable"):
+            self.profiler.enable()
+        else:
+            self.profiler.start()
+
+    def stop(self):
+        if hasattr(self.profiler, "disable"):
+            self.profiler.disable()
+            self.profiler.dump_stats(self.path) # read with: python -m pstats <file>
+        else:
+            self.profiler.stop()
+            with open(self.path, "w") as f:
+                f.write(self.profiler.output_html())
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware (lighter than @app.middleware("http")): counts the requests and measures their latency
+    by route, and profiles the requests with the header X-Profile: 1 when PROFILE_REQUESTS=1.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start_time = time.perf_counter()
+        scope.setdefault("state", {})["metrics_start_time"] = start_time
+        status = 500
+        profile = None
+        if PROFILE_REQUESTS and (b"x-profile", b"1") in scope["headers"]:
+            profile = Profile(scope["path"])
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if profile is not None:
+                    message["headers"] = list(message.get("headers", [])) + [(b"x-profile-path", profile.path.encode())]
+            await send(message)
+
+        if profile is not None:
+            profile.start()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            if profile is not None:
+                profile.stop()
+            # Route template (e.g. /predict), not the raw path, to keep a bounded number of labels
+            route = scope.get("route")
+            endpoint = getattr(route, "path", "other")
+            REQUESTS.inc(endpoint=endpoint, status=status)
+            REQUEST_SECONDS.observe(time.perf_counter() - start_time, endpoint=endpoint)
@@ -0,0 +1,128 @@
+# Server-side micro-batching of /predict requests
+# Concurrent requests are queued, gathered for a few milliseconds and scored together in one
+# vectorized call to the model, which pays the fixed pandas/sklearn cost once per batch instead
+# of once per car.
+import os
+import asyncio
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# Opt-in: set MICRO_BATCHING=1 to route /predict through the batcher
+MICRO_BATCHING = os.environ.get("MICRO_BATCHING", "0") == "1"
+# Max time a request waits for other requests before its batch is scored (milliseconds)
+MICRO_BATCH_MAX_WAIT_MS = float(os.environ.get("MICRO_BATCH_MAX_WAIT_MS", 5))
+# Max number of requests scored together
+MICRO_BATCH_MAX_SIZE = int(os.environ.get("MICRO_BATCH_MAX_SIZE", 64))
+
+
+class MicroBatcher:
+    """
+    Gathers single predictions into batches.
+
+    `predict_rows` receives a list of feature dicts and returns one prediction per dict, in the
+    same order. It is called through `run(predict_rows, rows)`, a coroutine running it outside the
+    event loop (default: the default thread pool) so the loop keeps accepting requests while a
+    batch is scored.
+    """
+    def __init__(self, predict_rows, max_wait_ms=MICRO_BATCH_MAX_WAIT_MS, max_batch_size=MICRO_BATCH_MAX_SIZE, run=None):
+        self.predict_rows = predict_rows
+        self.run = run or self._run_in_default_executor
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch_size = max_batch_size
+        self._queue = None
+        self._task = None
+        # metrics
+        self.nb_batches = 0
+        self.nb_items = 0
+        self.max_seen_batch_size = 0
+        self.batch_size_counts = {} # batch size bucket (1, 2, 4, 8...) -> number of batches
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    @staticmethod
+    async def _run_in_default_executor(function, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+    async def predict(self, row):
+        """
+        Queues one car and waits for its prediction.
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((row, future))
+        return await future
+
+    async def _next_batch(self):
+        # Wait for a first request, then gather others until the batch is full or the max wait is over
+        batch = [await self._queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            # requests cancelled by the client while waiting are not scored
+            batch = [(row, future) for row, future in batch if not future.cancelled()]
+            if not batch:
+                continue
+            self._record(len(batch))
+            try:
+                predictions = await self.run(self.predict_rows, [row for row, _ in batch])
+                # one prediction per request, otherwise the requests left without one would wait forever
+                if len(predictions) != len(batch):
+                    raise RuntimeError(f"{len(predictions)} predictions returned for a batch of {len(batch)} cars")
+            except Exception as error:
+                logger.warning("Micro-batch of %s predictions failed: %r", len(batch), error)
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            for (_, future), prediction in zip(batch, predictions):
+                if not future.done():
+                    future.set_result(prediction)
+
+    def _record(self, batch_size):
+        self.nb_batches += 1
+        self.nb_items += batch_size
+        self.max_seen_batch_size = max(self.max_seen_batch_size, batch_size)
+        bucket = 1
+        while bucket < batch_size:
+            bucket *= 2
+        self.batch_size_counts[bucket] = self.batch_size_counts.get(bucket, 0) + 1
+
+    def stats(self):
+        return {
+            "max_wait_ms": self.max_wait * 1000,
+            "max_batch_size": self.max_batch_size,
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "nb_batches": self.nb_batches,
+            "nb_predictions": self.nb_items,
+            "mean_batch_size": round(self.nb_items / self.nb_batches, 2) if self.nb_batches else 0,
+            "max_seen_batch_size": self.max_seen_batch_size,
+            # key = upper bound of the bucket, e.g. "8" counts batches of 5 to 8 predictions
+            "batch_size_histogram": {str(bucket): count for bucket, count in sorted(self.batch_size_counts.items())},
+        }
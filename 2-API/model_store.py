@@ -0,0 +1,274 @@
+# Model registry cache for the API
+# The pricing model is loaded once at startup and kept warm in memory, instead of being
+# downloaded from the ML flow server / S3 and unpickled again on every request.
+# mlflow (and boto3 behind it) is only imported when the model comes from the ML flow server:
+# a model baked in the image (see bake_model.py) is loaded without it.
+import os
+import json
+import time
+import logging
+import threading
+from datetime import datetime, timezone
+
+from fast_scorer import FastScorer, compile_pipeline
+from category_validation import CategoryValidator
+
+
+logger = logging.getLogger(__name__)
+
+# Model to serve. Can be a run URI ("runs:/<run_id>/pricing_getaround") or a registry URI:
+# "models:/lin_reg/latest", "models:/lin_reg/Production" (stage) or "models:/lin_reg@champion" (alias)
+DEFAULT_MODEL_URI = "runs:/22442f6913df4a0fa3b2c9d44c0e6570/pricing_getaround"
+MODEL_URI = os.environ.get("MODEL_URI", DEFAULT_MODEL_URI)
+
+# Seconds between two checks of the registry for a newly promoted version (0 = no hot-reload)
+MODEL_RELOAD_INTERVAL = float(os.environ.get("MODEL_RELOAD_INTERVAL", 60))
+
+# Score with the pure-NumPy scorer compiled from the Pipeline (see fast_scorer.py), 0 to use sklearn
+FAST_SCORER = os.environ.get("FAST_SCORER", "1") == "1"
+
+# Folder of the model baked in the image by bake_model.py, served at startup if it exists
+LOCAL_MODEL_DIR = os.environ.get("LOCAL_MODEL_DIR", "model")
+
+
+class ModelChanged(Exception):
+    """
+    Raised when the model served is no longer the version a streamed response or a job started with.
+    """
+
+
+class LoadedModel:
+    """
+    Snapshot of a loaded model: the sklearn Pipeline, its compiled scorer (None if the Pipeline
+    cannot be compiled or FAST_SCORER is off), the validator of its categories (see category_validation.py),
+    its training profile (training_profile.json logged with the model, None if absent) and where / when
+    it comes from.
+    A snapshot is never modified, a reload creates a new one.
+    `model` can also be a function returning the Pipeline: it is then loaded the first time it is
+    needed (with a compiled scorer, most requests never need it).
+    """
+    def __init__(self, model, scorer, uri, name, version, load_seconds, profile=None):
+        self._model = model
+        self._model_lock = threading.Lock()
+        self.scorer = scorer
+        self.profile = profile
+        self.validator = CategoryValidator.from_model(scorer, None if scorer is not None else self.model, profile)
+        self.uri = uri
+        self.name = name
+        self.version = version
+        self.loaded_at = datetime.now(timezone.utc)
+        self.load_seconds = load_seconds
+
+    @property
+    def model(self):
+        if callable(self._model):
+            with self._model_lock:
+                if callable(self._model):
+                    self._model = self._model()
+        return self._model
+
+    def info(self):
+        return {
+            "uri": self.uri,
+            "name": self.name,
+            "version": self.version,
+            "loaded_at": self.loaded_at.isoformat(),
+            "load_seconds": round(self.load_seconds, 3),
+            "fast_scorer": self.scorer is not None,
+            "unknown_category_policy": self.validator.policy,
+        }
+
+
+class ModelStore:
+    """
+    Holds the model currently served by the API.
+
+    The model is loaded with `load()` (at startup), then read through `store.current`.
+    When the URI points to the model registry, a background thread checks regularly which
+    version the URI resolves to, loads the new version next to the old one and swaps them
+    in one assignment: in-flight requests keep the snapshot they already hold.
+    """
+    def __init__(self, uri=MODEL_URI, reload_interval=MODEL_RELOAD_INTERVAL):
+        self.uri = uri
+        self.reload_interval = reload_interval
+        self.current = None
+        self.listeners = [] # functions called with the new LoadedModel after each load
+        self.nb_reload_failures = 0
+        self._lock = threading.Lock() # only one load at a time
+        self._stop = threading.Event()
+        self._watcher = None
+
+    @property
+    def model(self):
+        if self.current is None:
+            raise RuntimeError("No model loaded yet, call load() first")
+        return self.current.model
+
+    def _parse_registry_uri(self):
+        # "models:/lin_reg/Production" -> ("lin_reg", "Production", None)
+        # "models:/lin_reg@champion"  -> ("lin_reg", None, "champion")
+        path = self.uri[len("models:/"):]
+        if "@" in path:
+            name, alias = path.split("@", 1)
+            return name, None, alias
+        name, _, version_or_stage = path.partition("/")
+        return name, version_or_stage or "latest", None
+
+    def resolve(self):
+        """
+        Returns (name, version, uri to load) for the configured URI.
+        Registry URIs are resolved to an explicit version so that the loaded model and
+        the reported version always match.
+        """
+        if not self.uri.startswith("models:/"):
+            # runs:/ or local path: the run id (or path) is the version
+            version = self.uri.split("/")[1] if self.uri.startswith("runs:/") else self.uri
+            return None, version, self.uri
+
+        import mlflow
+        name, version_or_stage, alias = self._parse_registry_uri()
+        client = mlflow.tracking.MlflowClient()
+        if alias is not None:
+            version = client.get_model_version_by_alias(name, alias).version
+        elif version_or_stage.isdigit():
+            version = version_or_stage
+        elif version_or_stage.lower() == "latest":
+            versions = client.search_model_versions(f"name='{name}'")
+            version = str(max(int(v.version) for v in versions))
+        else:
+            version = client.get_latest_versions(name, stages=[version_or_stage])[0].version
+        return name, str(version), f"models:/{name}/{version}"
+
+    def load_profile(self, name, version, uri):
+        """
+        training_profile.json logged in the run of the model by the training scripts (None if absent).
+        """
+        import mlflow
+        try:
+            if uri.startswith("runs:/"):
+                run_id = uri.split("/")[1]
+            else:
+                run_id = mlflow.tracking.MlflowClient().get_model_version(name, version).run_id
+            return mlflow.artifacts.load_dict(f"runs:/{run_id}/training_profile.json")
+        except Exception as error:
+            logger.info("No training profile for model %s (%s)", uri, error)
+            return None
+
+    def serves(self, uri):
+        """
+        True if a model loaded from uri (resolved URI, as in meta.json) can be served for the configured URI:
+        the same URI, or a version of the same registered model (unless the configured URI pins another
+        version). A newer version than the one baked is then loaded by the watcher.
+        """
+        if uri == self.uri:
+            return True
+        if not self.uri.startswith("models:/") or not uri.startswith("models:/"):
+            return False
+        name, version_or_stage, _ = self._parse_registry_uri()
+        baked_name, _, baked_version = uri[len("models:/"):].partition("/")
+        if baked_name != name:
+            return False
+        return version_or_stage is None or not version_or_stage.isdigit() or version_or_stage == baked_version
+
+    def baked_model_dir(self):
+        # Folder of the version baked by bake_model.py (LOCAL_MODEL_DIR/current holds its name), None if there
+        # is none or if it was baked from another model than the configured URI
+        try:
+            with open(os.path.join(LOCAL_MODEL_DIR, "current")) as f:
+                model_dir = os.path.join(LOCAL_MODEL_DIR, f.read().strip())
+            with open(os.path.join(model_dir, "meta.json")) as f:
+                baked_uri = json.load(f)["uri"]
+        except (OSError, ValueError, KeyError):
+            return None
+        if not self.serves(baked_uri):
+            logger.warning("Model baked in %s (%s) is not a version of %s: loading %s from ML flow", model_dir, baked_uri, self.uri, self.uri)
+            return None
+        return model_dir
+
+    def _load_baked(self, model_dir):
+        import joblib
+        start_time = time.perf_counter()
+        with open(os.path.join(model_dir, "meta.json")) as f:
+            meta = json.load(f)
+        pipeline_path = os.path.join(model_dir, "pipeline.joblib")
+        # Pipeline memory-mapped (not copied) when loaded
+        load_pipeline = lambda: joblib.load(pipeline_path, mmap_mode="r")
+        scorer_path = os.path.join(model_dir, "scorer.json")
+        if FAST_SCORER and os.path.exists(scorer_path):
+            scorer, model = FastScorer.load(scorer_path), load_pipeline
+        else:
+            scorer, model = None, load_pipeline()
+        profile = None
+        if os.path.exists(os.path.join(model_dir, "profile.json")):
+            with open(os.path.join(model_dir, "profile.json")) as f:
+                profile = json.load(f)
+        return LoadedModel(model, scorer, meta["uri"], meta["name"], meta["version"], time.perf_counter() - start_time, profile)
+
+    def _load_remote(self):
+        import mlflow
+        name, version, uri = self.resolve()
+        start_time = time.perf_counter()
+        # Load the sklearn Pipeline itself (not the pyfunc wrapper) to call it directly
+        model = mlflow.sklearn.load_model(uri)
+        scorer = self._compile(model) if FAST_SCORER else None
+        profile = self.load_profile(name, version, uri)
+        return LoadedModel(model, scorer, uri, name, version, time.perf_counter() - start_time, profile)
+
+    def load(self):
+        """
+        Loads the model and makes it the served model: at startup the model baked in the image
+        if any, otherwise (and for reloads) the model the URI currently resolves to.
+        """
+        with self._lock:
+            baked_model_dir = self.baked_model_dir() if self.current is None else None
+            loaded = self._load_baked(baked_model_dir) if baked_model_dir else self._load_remote()
+            self.current = loaded # atomic swap
+            logger.info("Model %s (version %s) loaded in %.2fs", loaded.uri, loaded.version, loaded.load_seconds)
+        for listener in self.listeners:
+            listener(loaded)
+        return loaded
+
+    def _compile(self, model):
+        try:
+            return compile_pipeline(model)
+        except ValueError as error:
+            # e.g. gradient boosting model: not a linear model
+            logger.warning("Model %s cannot be compiled (%s), predictions will use sklearn", self.uri, error)
+            return None
+        except Exception:
+            logger.exception("Model %s cannot be compiled, predictions will use sklearn", self.uri)
+            return None
+
+    def reload_if_changed(self):
+        """
+        Loads the model again only if the URI now resolves to another version.
+        Returns True if a new version is served.
+        """
+        _, version, _ = self.resolve()
+        if self.current is not None and version == self.current.version:
+            return False
+        self.load()
+        return True
+
+    def _watch(self):
+        while not self._stop.wait(self.reload_interval):
+            try:
+                self.reload_if_changed()
+            except Exception:
+                self.nb_reload_failures += 1
+                # keep serving the current model if the registry or S3 is unavailable
+                logger.exception("Model hot-reload failed, keeping version %s", self.current.version)
+
+    def start_watcher(self):
+        # Only registry URIs can change version
+        if self.reload_interval <= 0 or not self.uri.startswith("models:/"):
+            return
+        self._stop.clear()
+        self._watcher = threading.Thread(target=self._watch, name="model-watcher", daemon=True)
+        self._watcher.start()
+
+    def stop_watcher(self):
+        self._stop.set()
+        if self._watcher is not None:
+            self._watcher.join(timeout=5)
+            self._watcher = None
@@ -0,0 +1,311 @@
+# Drift monitoring of the prediction traffic
+# Cars sent to /predict and /predict/batch are compared with the training data of the model served, read from
+# the training_profile.json logged with it (see 1-ml_flow_tracking/training_profile.py):
+# - numerical features and predictions: counts in the bins of the reference histogram (edges at the quantiles
+#   of the training data), so memory is a few integers per feature whatever the traffic
+# - categorical features: counts of the categories of the reference, the other values in one count, and
+#   their most frequent values approximated with MAX_NEW_CATEGORIES counters (Misra-Gries)
+# The drift of each feature is the PSI (population stability index) between the reference and the current
+# window: < 0.1 no drift, 0.1 - 0.25 moderate, > 0.25 significant.
+#
+# Requests only put their cars in a queue bounded by its number of cars (O(1), dropped when full), so a few
+# big batches cannot hold more memory than many single cars: the counts are updated by a background thread. Every MONITORING_LOG_INTERVAL seconds a new window starts, and with MONITORING_MLFLOW=1 the
+# scores of the window that ends are logged as ML flow metrics (one run per model version and API worker, in the
+# MONITORING_EXPERIMENT experiment). Off by default: every worker would otherwise call the ML flow server.
+import os
+import time
+import queue
+import socket
+import logging
+import threading
+
+import numpy as np
+import pandas as pd
+
+
+MONITORING = os.environ.get("MONITORING", "1") == "1"
+# Max number of cars waiting to be counted (all requests together), the next requests are dropped (see nb_dropped)
+MONITORING_QUEUE_ROWS = int(os.environ.get("MONITORING_QUEUE_ROWS", 50000))
+# Length of a window in seconds, i.e. seconds between two logs of the drift scores (0 = one window)
+MONITORING_LOG_INTERVAL = float(os.environ.get("MONITORING_LOG_INTERVAL", 3600))
+# Log the scores of each window to ML flow (opt-in)
+MONITORING_MLFLOW = os.environ.get("MONITORING_MLFLOW", "0") == "1"
+MONITORING_EXPERIMENT = os.environ.get("MONITORING_EXPERIMENT", "rental_price monitoring")
+# Counters of the categories unknown by the reference, per feature
+MAX_NEW_CATEGORIES = 20
+# Share given to an empty bin in the PSI (log(0) otherwise)
+PSI_EPSILON = 1e-4
+# Bins of the predictions (euros per day) when the reference has no histogram of the predictions
+DEFAULT_PREDICTION_EDGES = list(range(25, 500, 25))
+
+logger = logging.getLogger(__name__)
+
+
+def is_single_car(features):
+    # A dict of features (/predict), not of columns / a DataFrame
+    return isinstance(features, dict) and not isinstance(next(iter(features.values()), None), (list, np.ndarray, pd.Series))
+
+
+def nb_rows_of(features):
+    if is_single_car(features):
+        return 1
+    if isinstance(features, dict):
+        return len(next(iter(features.values()), ()))
+    return len(features)
+
+
+def psi(expected, actual):
+    """
+    Population stability index between 2 lists of counts over the same bins (None if one is empty).
+    """
+    expected, actual = np.asarray(expected, dtype=float), np.asarray(actual, dtype=float)
+    if not expected.sum() or not actual.sum():
+        return None
+    expected = np.maximum(expected / expected.sum(), PSI_EPSILON)
+    actual = np.maximum(actual / actual.sum(), PSI_EPSILON)
+    return float(np.sum((actual - expected) * np.log(actual / expected)))
+
+
+class HistogramSketch:
+    """
+    Counts of the values in fixed bins (same convention as the reference: bin i holds edges[i-1] <= v < edges[i]),
+    with the min and max seen.
+    """
+    def __init__(self, edges):
+        self.edges = np.asarray(edges, dtype=float)
+        self.counts = np.zeros(len(self.edges) + 1, dtype=np.int64)
+        self.min, self.max = np.inf, -np.inf
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return
+        self.counts += np.bincount(np.searchsorted(self.edges, values, side="right"), minlength=len(self.counts))
+        self.min, self.max = min(self.min, values.min()), max(self.max, values.max())
+
+    def stats(self):
+        nb_values = int(self.counts.sum())
+        return {"nb_values": nb_values, "min": float(self.min) if nb_values else None, "max": float(self.max) if nb_values else None}
+
+
+class MisraGries:
+    """
+    Most frequent values of a stream with at most k counters: a count is underestimated by at most
+    (number of values) / (k + 1), every value more frequent than that is kept.
+    """
+    def __init__(self, k=MAX_NEW_CATEGORIES):
+        self.k = k
+        self.counters = {}
+
+    def update(self, value, count=1):
+        if value in self.counters or len(self.counters) < self.k:
+            self.counters[value] = self.counters.get(value, 0) + count
+            return
+        decrement = min(count, min(self.counters.values()))
+        self.counters = {key: n - decrement for key, n in self.counters.items() if n > decrement}
+        if count > decrement:
+            self.counters[value] = count - decrement
+
+    def top(self):
+        return dict(sorted(self.counters.items(), key=lambda item: item[1], reverse=True))
+
+
+class CategorySketch:
+    """
+    Counts of the categories of the reference (last count: the other values), and most frequent other values.
+    """
+    def __init__(self, categories):
+        self.index = {category: i for i, category in enumerate(categories)}
+        self.counts = np.zeros(len(categories) + 1, dtype=np.int64)
+        self.new_categories = MisraGries()
+
+    def update(self, values):
+        for value, count in pd.Series(values, dtype=object).value_counts().items():
+            i = self.index.get(str(value))
+            if i is None:
+                self.counts[-1] += count
+                self.new_categories.update(str(value), int(count))
+            else:
+                self.counts[i] += count
+
+
+class DriftMonitor:
+    """
+    Sketches of the current window and reference of the model served. observe() is called by the requests,
+    the sketches are only touched by the background thread (and read under the lock).
+    """
+    def __init__(self, max_rows=MONITORING_QUEUE_ROWS, log_interval=MONITORING_LOG_INTERVAL, log_to_mlflow=MONITORING_MLFLOW):
+        self.max_rows = max_rows
+        self.log_interval = log_interval
+        self.log_to_mlflow = log_to_mlflow
+        self.nb_dropped = 0
+        self.queued_rows = 0
+        self.last_window = None
+        self._queue = queue.Queue() # bounded by queued_rows (each item holds at least one car)
+        self._queue_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+        self._runs = {} # model version -> ML flow run of this worker
+        self.set_model(None)
+
+    def set_model(self, loaded):
+        # New reference (model loaded or reloaded): the window starts again
+        with self._lock:
+            self.model_version = loaded.version if loaded is not None else None
+            self.model_name = loaded.name if loaded is not None else None
+            self.reference = (loaded.profile if loaded is not None else None) or {}
+            self._reset()
+
+    def _reset(self):
+        self.window_start = time.time()
+        self.nb_observations = 0
+        self.numerical = {feature: HistogramSketch(histogram["edges"]) for feature, histogram in self.reference.get("numerical", {}).items()}
+        self.categorical = {feature: CategorySketch(list(table["counts"])) for feature, table in self.reference.get("categorical", {}).items()}
+        self.prediction = HistogramSketch(self.reference.get("prediction", {}).get("edges", DEFAULT_PREDICTION_EDGES))
+
+    def observe(self, features, predictions=None):
+        """
+        Queues cars to count: a dict of features (one car) or of columns / a DataFrame, with their predictions.
+        Never blocks: the cars are dropped if max_rows cars are already waiting.
+        """
+        nb_rows = nb_rows_of(features)
+        with self._queue_lock:
+            if self.queued_rows + nb_rows > self.max_rows:
+                self.nb_dropped += 1
+                return
+            self.queued_rows += nb_rows
+        self._queue.put_nowait((features, predictions, nb_rows))
+
+    def _update(self, items):
+        # One update of the sketches for all the items waiting: single cars gathered in columns
+        frames, rows, row_predictions = [], [], []
+        for features, predictions, _ in items:
+            if is_single_car(features):
+                rows.append(features)
+                row_predictions.append(predictions)
+            else:
+                frames.append((pd.DataFrame(features), predictions))
+        if rows:
+            frames.append((pd.DataFrame(rows), row_predictions))
+        with self._lock:
+            for df, predictions in frames:
+                self.nb_observations += len(df)
+                for feature, sketch in self.numerical.items():
+                    if feature in df.columns:
+                        sketch.update(df[feature].to_numpy(dtype=float, na_value=np.nan))
+                for feature, sketch in self.categorical.items():
+                    if feature in df.columns:
+                        sketch.update(df[feature])
+                if predictions is not None:
+                    self.prediction.update([np.nan if prediction is None else prediction for prediction in predictions])
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                items = [self._queue.get(timeout=0.5)]
+            except queue.Empty:
+                continue
+            while len(items) < 1000:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            with self._queue_lock:
+                self.queued_rows -= sum(nb_rows for _, _, nb_rows in items)
+            try:
+                self._update(items)
+            except Exception:
+                logger.exception("Could not update the drift sketches")
+
+    def scores(self):
+        # PSI of each feature and of the predictions against the reference (None: no reference or no traffic)
+        with self._lock:
+            scores = {}
+            for feature, sketch in self.numerical.items():
+                scores[feature] = psi(self.reference["numerical"][feature]["counts"], sketch.counts)
+            for feature, sketch in self.categorical.items():
+                table = self.reference["categorical"][feature]
+                scores[feature] = psi(list(table["counts"].values()) + [table.get("nb_other", 0)], sketch.counts)
+            if "prediction" in self.reference:
+                scores["prediction"] = psi(self.reference["prediction"]["counts"], self.prediction.counts)
+            return scores
+
+    def report(self):
+        scores = self.scores()
+        known_scores = [score for score in scores.values() if score is not None]
+        with self._lock:
+            return {
+                "model_name": self.model_name,
+                "model_version": self.model_version,
+                "reference_rows": self.reference.get("nb_rows"),
+                "window_started_at": self.window_start,
+                "nb_observations": self.nb_observations,
+                "nb_dropped": self.nb_dropped,
+                "psi": scores,
+                "max_psi": max(known_scores) if known_scores else None,
+                "numerical": {feature: sketch.stats() for feature, sketch in self.numerical.items()},
+                "prediction": self.prediction.stats(),
+                "new_categories": {feature: sketch.new_categories.top() for feature, sketch in self.categorical.items() if sketch.new_categories.counters},
+                "previous_window": self.last_window,
+            }
+
+    def start(self):
+        # Threads started here, i.e. in the worker process (not in the gunicorn master with --preload)
+        self._stop.clear()
+        self._threads = [threading.Thread(target=self._run, daemon=True, name="drift-monitor")]
+        if self.log_interval > 0:
+            self._threads.append(threading.Thread(target=self._log_loop, daemon=True, name="drift-logger"))
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _log_loop(self):
+        while not self._stop.wait(self.log_interval):
+            try:
+                self.log_window()
+            except Exception:
+                logger.exception("Could not log the drift scores to ML flow")
+
+    def end_window(self):
+        # Report of the window that ends, and start of the next one
+        report = self.report()
+        report.pop("previous_window")
+        with self._lock:
+            self.last_window = report
+            self._reset()
+        return report
+
+    def log_window(self):
+        # End of the window, logged to ML flow with MONITORING_MLFLOW=1 (kept in previous_window of the report anyway)
+        report = self.end_window()
+        if not self.log_to_mlflow or not report["nb_observations"] or self.model_version is None:
+            return
+        metrics = {f"psi_{feature}": score for feature, score in report["psi"].items() if score is not None}
+        metrics["nb_observations"] = report["nb_observations"]
+        if report["max_psi"] is not None:
+            metrics["max_psi"] = report["max_psi"]
+        # step = start of the window (seconds)
+        self._log_metrics(report["model_version"], metrics, int(report["window_started_at"]))
+
+    def _log_metrics(self, version, metrics, step):
+        # mlflow only imported when the first window is logged (see bake_model.py for the startup time)
+        import mlflow
+        from mlflow.entities import Metric
+
+        client = mlflow.tracking.MlflowClient()
+        run_id = self._runs.get(version)
+        if run_id is None:
+            experiment = client.get_experiment_by_name(MONITORING_EXPERIMENT)
+            experiment_id = experiment.experiment_id if experiment is not None else client.create_experiment(MONITORING_EXPERIMENT)
+            run = client.create_run(experiment_id, run_name=f"monitoring {self.model_name} v{version}", tags={
+                "model_name": str(self.model_name), "model_version": str(version), "worker": f"{socket.gethostname()}:{os.getpid()}"})
+            run_id = self._runs[version] = run.info.run_id
+        timestamp = int(time.time() * 1000)
+        client.log_batch(run_id, metrics=[Metric(key, float(value), timestamp, step) for key, value in metrics.items()])
@@ -0,0 +1,175 @@
+# Cache of /predict results
+# Many requests price the same car configuration: the prediction is stored under a hash of the
+# features and of the model version, so a cache hit never touches pandas or sklearn.
+# A shared cache (Redis) is only an optimization: when it is slow or unreachable, a lookup is a miss and a
+# store is skipped (counted in errors), the request is answered by the model.
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+
+# Max number of predictions kept in memory (0 disables the cache) and their lifetime in seconds
+PREDICTION_CACHE_SIZE = int(os.environ.get("PREDICTION_CACHE_SIZE", 10000))
+PREDICTION_CACHE_TTL = float(os.environ.get("PREDICTION_CACHE_TTL", 3600))
+# "local" (one cache per API process) or "redis" (cache shared by all the replicas, needs REDIS_URL)
+PREDICTION_CACHE_BACKEND = os.environ.get("PREDICTION_CACHE_BACKEND", "local")
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+# Seconds to connect to Redis / wait for an answer before giving up (the request is then scored by the model)
+REDIS_TIMEOUT = float(os.environ.get("REDIS_TIMEOUT", 0.1))
+
+logger = logging.getLogger(__name__)
+
+
+def cache_key(features, model_version):
+    """
+    Canonical hash of a car: same features (whatever their order) and same model version give the same key.
+    """
+    canonical = json.dumps(features, sort_keys=True, separators=(",", ":"))
+    return hashlib.blake2b(f"{model_version}|{canonical}".encode(), digest_size=16).hexdigest()
+
+
+class LocalBackend:
+    """
+    In-memory LRU cache with a time to live: the least recently used entry is evicted when
+    max_entries is reached, and entries older than ttl seconds are ignored.
+    """
+    remote = False # a lookup is a dict access: no need to leave the event loop
+
+    def __init__(self, max_entries=PREDICTION_CACHE_SIZE, ttl=PREDICTION_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.nb_evictions = 0
+        self.nb_errors = 0
+        self._entries = OrderedDict() # key -> (expiry time, prediction)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.nb_evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def redis_errors():
+    # Errors of a Redis call: of the redis package if installed, and of the sockets
+    try:
+        import redis
+    except ImportError:
+        return (ConnectionError, TimeoutError)
+    return (redis.RedisError, ConnectionError, TimeoutError)
+
+
+class RedisBackend:
+    """
+    Cache shared by several API replicas. Redis evicts the entries itself (ttl, and maxmemory
+    policy of the server). `client` can be given for tests (e.g. fakeredis).
+    Calls are blocking network round-trips (remote = True: run outside the event loop) bounded by
+    REDIS_TIMEOUT, and errors are counted instead of raised: get -> miss, set / clear -> skipped.
+    """
+    prefix = "getaround:prediction:"
+    remote = True
+
+    def __init__(self, url=REDIS_URL, ttl=PREDICTION_CACHE_TTL, client=None, timeout=REDIS_TIMEOUT):
+        if client is None:
+            import redis # optional dependency, only needed with PREDICTION_CACHE_BACKEND=redis
+            client = redis.Redis.from_url(url, socket_timeout=timeout, socket_connect_timeout=timeout)
+        self.client = client
+        self.ttl = ttl
+        self.nb_evictions = 0
+        self.nb_errors = 0
+        self.errors = redis_errors()
+
+    def _failed(self, action):
+        self.nb_errors += 1
+        logger.warning("Redis %s failed, predictions cache skipped", action, exc_info=True)
+
+    def get(self, key):
+        try:
+            value = self.client.get(self.prefix + key)
+        except self.errors:
+            self._failed("get")
+            return None
+        return float(value) if value is not None else None
+
+    def set(self, key, value):
+        try:
+            self.client.set(self.prefix + key, repr(value), ex=int(self.ttl))
+        except self.errors:
+            self._failed("set")
+
+    def clear(self):
+        # Keys contain the model version, so old entries are never read again: deleting them only frees memory
+        try:
+            for key in self.client.scan_iter(match=self.prefix + "*"):
+                self.client.delete(key)
+        except self.errors:
+            self._failed("clear")
+
+    def __len__(self):
+        try:
+            return sum(1 for _ in self.client.scan_iter(match=self.prefix + "*"))
+        except self.errors:
+            self._failed("scan")
+            return 0
+
+
+class PredictionCache:
+    """
+    Predictions cache with hit / miss counters, in front of the model.
+    """
+    def __init__(self, backend=None):
+        if backend is None:
+            backend = RedisBackend() if PREDICTION_CACHE_BACKEND == "redis" else LocalBackend()
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, features, model_version):
+        prediction = self.backend.get(cache_key(features, model_version))
+        if prediction is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return prediction
+
+    def set(self, features, model_version, prediction):
+        self.backend.set(cache_key(features, model_version), prediction)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "backend": type(self.backend).__name__,
+            "size": len(self.backend),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0,
+            "evictions": self.backend.nb_evictions,
+            "errors": self.backend.nb_errors,
+        }
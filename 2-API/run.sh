@@ -2,6 +2,8 @@ docker run -it \
 -v "$(pwd):/home/app" \
 -p 4000:4000 \
 -e PORT=4000 \
+-e WEB_CONCURRENCY=2 \
+-e INFERENCE_WORKERS=4 \
 -e MLFLOW_TRACKING_URI=$MLFLOW_TRACKING_URI \
 -e AWS_ACCESS_KEY_ID=$AWS_ACCESS_KEY_ID \
 -e AWS_SECRET_ACCESS_KEY=$AWS_SECRET_ACCESS_KEY \
@@ -0,0 +1,34 @@
+# Smoke test of the load-test harness (bench_predict.py): the API starts on the stub model, without ML flow
+# Terminal command : python -m pytest test_bench_predict.py
+import asyncio
+
+import pandas as pd
+import pytest
+
+pytest.importorskip("httpx")
+pytest.importorskip("psutil")
+pytest.importorskip("uvicorn")
+
+import bench_predict
+
+
+def test_harness_serves_the_stub_model(pricing_csv, tmp_path):
+    model_dir, model_uri = bench_predict.fit_stub_model(pricing_csv, str(tmp_path))
+    assert model_uri.startswith("stub:")
+    df = pd.read_csv(pricing_csv, index_col=0).drop(columns="rental_price_per_day")
+    payloads = bench_predict.make_payloads(df, 200, 10, seed=0)
+
+    port = bench_predict.free_port()
+    # The API only serves the baked model of its MODEL_URI, set to the stub URI by start_server
+    server = bench_predict.start_server(str(tmp_path), model_uri, port, 1, {})
+    try:
+        raw = asyncio.run(bench_predict.drive(f"http://127.0.0.1:{port}", payloads, {"predict": 0.5, "batch": 0.5},
+                                              concurrency=2, duration=1, warmup=0, seed=0))
+    finally:
+        server.terminate()
+        server.wait()
+
+    summary = bench_predict.summarize(raw, 1, 10)
+    for endpoint in summary.values():
+        assert endpoint["nb_requests"] > 0
+        assert endpoint["nb_errors"] == 0
@@ -0,0 +1,83 @@
+# Unknown categories (category_validation.py): policies, fallback to reject, DataFrame checks
+# Terminal command : python -m pytest test_category_validation.py
+import numpy as np
+import pandas as pd
+import pytest
+
+from category_validation import CategoryValidator, UnknownCategory, OTHER_CATEGORY, pipeline_vocabulary
+
+
+# "fuel" has a pooled "__other__" category, "paint_color" has none
+VOCABULARY = {"fuel": ["diesel", "petrol", OTHER_CATEGORY], "paint_color": ["black", "grey", "white"]}
+MOST_FREQUENT = {"fuel": "diesel", "paint_color": "black"}
+CAR = {"fuel": "diesel", "paint_color": "grey", "mileage": 140411}
+
+
+def test_reject():
+    validator = CategoryValidator(VOCABULARY, MOST_FREQUENT, policy="reject")
+    assert validator.check_row(CAR) == CAR
+    with pytest.raises(UnknownCategory) as error:
+        validator.check_row({**CAR, "fuel": "hydrogen", "paint_color": "pink"})
+    assert error.value.errors == [(None, "fuel", "hydrogen"), (None, "paint_color", "pink")]
+    assert error.value.detail()[0]["loc"] == ["body", "fuel"]
+    assert validator.rejected_features == ["fuel", "paint_color"]
+    assert validator.stats()["nb_unknown"] == {"fuel": 1, "paint_color": 1}
+
+
+def test_other():
+    validator = CategoryValidator(VOCABULARY, MOST_FREQUENT, policy="other")
+    car = {**CAR, "fuel": "hydrogen", "paint_color": "pink"}
+    # No "__other__" for paint_color: most frequent category
+    assert validator.check_row(car) == {**CAR, "fuel": OTHER_CATEGORY, "paint_color": "black"}
+    assert car["fuel"] == "hydrogen" # the request is not modified
+    assert validator.stats()["replacements"] == {"fuel": OTHER_CATEGORY, "paint_color": "black"}
+
+
+def test_most_frequent():
+    validator = CategoryValidator(VOCABULARY, MOST_FREQUENT, policy="most_frequent")
+    assert validator.check_row({**CAR, "fuel": "hydrogen"}) == {**CAR, "fuel": "diesel"}
+    # No training profile: "__other__" if the model has it
+    validator = CategoryValidator(VOCABULARY, None, policy="most_frequent")
+    assert validator.check_row({**CAR, "fuel": "hydrogen"}) == {**CAR, "fuel": OTHER_CATEGORY}
+
+
+@pytest.mark.parametrize("policy", ["other", "most_frequent"])
+def test_fallback_to_reject(policy):
+    # Neither "__other__" nor a most frequent category for paint_color: rejected, never the reference category
+    validator = CategoryValidator(VOCABULARY, {"fuel": "diesel"}, policy=policy)
+    assert validator.rejected_features == ["paint_color"]
+    with pytest.raises(UnknownCategory) as error:
+        validator.check_rows([CAR, {**CAR, "fuel": "hydrogen", "paint_color": "pink"}])
+    assert error.value.errors == [(1, "paint_color", "pink")]
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        CategoryValidator(VOCABULARY, policy="ignore")
+
+
+def test_check_columns():
+    df = pd.DataFrame({"fuel": ["diesel", "hydrogen", "petrol"], "paint_color": ["grey", "pink", "white"], "mileage": [1, 2, 3]})
+    validator = CategoryValidator(VOCABULARY, {"fuel": "diesel"}, policy="other")
+    known = validator.known_rows(df)
+    np.testing.assert_array_equal(known, [True, False, True])
+    # known_rows neither counts nor replaces
+    assert validator.nb_unknown == {"fuel": 0, "paint_color": 0}
+
+    checked = validator.check_columns(df[known])
+    assert checked["fuel"].tolist() == ["diesel", "petrol"]
+    with pytest.raises(UnknownCategory) as error:
+        validator.check_columns(df, offset=100)
+    assert error.value.errors == [(101, "paint_color", "pink")]
+
+    replaced = validator.check_columns(df.drop(columns="paint_color").assign(paint_color="grey"))
+    assert replaced["fuel"].tolist() == ["diesel", OTHER_CATEGORY, "petrol"]
+    assert df["fuel"].tolist() == ["diesel", "hydrogen", "petrol"] # copied, not modified
+    assert validator.nb_unknown == {"fuel": 2, "paint_color": 1}
+
+
+def test_vocabulary_of_pipeline(pricing, fit_pipeline):
+    X, Y = pricing
+    vocabulary = pipeline_vocabulary(fit_pipeline(X, Y))
+    assert set(vocabulary) == set(X.select_dtypes("object").columns)
+    assert set(vocabulary["fuel"]) == set(X["fuel"])
@@ -0,0 +1,34 @@
+# Delay index file (delay_index.py): reloaded when it changes, kept when the new file cannot be read
+# Terminal command : python -m pytest test_delay_index.py
+import os
+
+import numpy as np
+
+from delay_index import DelayIndexFile, COMPLETE_SCOPE, METRICS
+
+
+def write_index(path, data_version, deltas):
+    # Index of one scope with the same sorted time deltas for every metric (see 3-streamlit/threshold_engine.py)
+    arrays = {f"{metric}_0": np.sort(deltas) for metric in METRICS}
+    np.savez(path, data_version=np.array(data_version), scopes=np.array([COMPLETE_SCOPE]), nb_rentals=np.array([len(deltas)]), **arrays)
+
+
+def test_reload_keeps_previous_index(tmp_path):
+    path = str(tmp_path / "delay_index.npz")
+    write_index(path, "v1", np.array([10, 30, 60]))
+    index_file = DelayIndexFile(path, reload_interval=0)
+    assert index_file.get().query(30)["rentals_affected"] == 2
+
+    write_index(path, "v2", np.array([10, 20, 30, 60]))
+    os.utime(path, (1, 1))
+    assert index_file.get().data_version == "v2"
+
+    # Truncated and empty files (a copy in progress): the previous index is still served
+    with open(path, "rb") as f:
+        content = f.read()
+    for broken in (content[:len(content) // 2], b""):
+        with open(path, "wb") as f:
+            f.write(broken)
+        os.utime(path, (len(broken) + 2, len(broken) + 2))
+        assert index_file.get().query(30)["rentals_affected"] == 3
+        assert index_file.get().data_version == "v2"
@@ -0,0 +1,48 @@
+# Parity of the compiled scorer (fast_scorer.py) with Pipeline.predict, on the pricing dataset (see conftest.py)
+# Terminal command : python -m pytest test_fast_scorer.py
+import numpy as np
+import pytest
+
+from fast_scorer import FastScorer, compile_pipeline
+
+
+def test_scorer_matches_pipeline(pricing, fit_pipeline):
+    X, Y = pricing
+    pipeline = fit_pipeline(X, Y)
+    scorer = compile_pipeline(pipeline)
+    expected = pipeline.predict(X)
+
+    np.testing.assert_allclose(scorer.predict(X), expected, rtol=0, atol=1e-6)
+    np.testing.assert_allclose([scorer.predict_one(row) for row in X.to_dict("records")], expected, rtol=0, atol=1e-6)
+    # dict of columns, as sent by the API
+    np.testing.assert_allclose(scorer.predict({name: X[name].tolist() for name in X.columns}), expected, rtol=0, atol=1e-6)
+
+
+def test_scorer_survives_export(pricing, fit_pipeline, tmp_path):
+    X, Y = pricing
+    pipeline = fit_pipeline(X, Y)
+    path = tmp_path / "fast_scorer.json"
+    compile_pipeline(pipeline).save(path)
+    np.testing.assert_allclose(FastScorer.load(path).predict(X), pipeline.predict(X), rtol=0, atol=1e-6)
+
+
+def test_unknown_categories_with_drop_first(pricing, fit_pipeline):
+    X, Y = pricing
+    # Encoder fitted without some categories: they are unknown for the model
+    train = X["model_key"] != "Toyota"
+    pipeline = fit_pipeline(X[train], Y[train], handle_unknown="ignore")
+    scorer = compile_pipeline(pipeline)
+    unknown = X[~train].copy()
+    unknown.loc[unknown.index[::2], "fuel"] = "plasma"
+
+    expected = pipeline.predict(unknown)
+    np.testing.assert_allclose(scorer.predict(unknown), expected, rtol=0, atol=1e-6)
+    np.testing.assert_allclose([scorer.predict_one(row) for row in unknown.to_dict("records")], expected, rtol=0, atol=1e-6)
+
+
+def test_unknown_category_raises_like_the_encoder(pricing, fit_pipeline):
+    X, Y = pricing
+    scorer = compile_pipeline(fit_pipeline(X, Y))
+    row = {**X.iloc[0].to_dict(), "fuel": "plasma"}
+    with pytest.raises(ValueError):
+        scorer.predict_one(row)
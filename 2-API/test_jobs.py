@@ -0,0 +1,123 @@
+# Offline scoring jobs (jobs.py): resume from the checkpoints of a dead worker, result download, input folder
+# Terminal command : python -m pytest test_jobs.py
+import io
+import os
+import time
+
+import pandas as pd
+import pytest
+from fastapi.testclient import TestClient
+
+import app as api
+from jobs import JobRunner, SQLiteJobStore, resolve_input_path
+
+
+CHUNK_SIZE = 50
+
+
+class RecordingScorer:
+    # "Model" pricing a car at its mileage, recording the chunks it scores (index of their first row // CHUNK_SIZE)
+    def __init__(self):
+        self.chunks = []
+
+    def __call__(self, chunk, version):
+        self.chunks.append(chunk.index[0] // CHUNK_SIZE)
+        return chunk["mileage"].astype(float).to_numpy()
+
+
+def make_runner(tmp_path, X, score):
+    store = SQLiteJobStore(str(tmp_path / "jobs.sqlite"))
+    return JobRunner(store, score, lambda: "1", list(X.columns), jobs_dir=str(tmp_path / "jobs"), workers=2,
+                     stale_seconds=60, poll_interval=0)
+
+
+def wait_for(runner, job_id, timeout=30):
+    deadline = time.monotonic() + timeout
+    while runner.store.get(job_id)["status"] not in ("done", "failed"):
+        assert time.monotonic() < deadline, f"job {job_id} not finished"
+        time.sleep(0.05)
+    return runner.store.get(job_id)
+
+
+@pytest.fixture
+def resumed_job(pricing, tmp_path):
+    """
+    Job of 230 rows (5 chunks) left running by a dead worker after scoring chunks 0 and 2, then resumed by
+    a new runner. Returns (runner, job id, scored cars, chunks scored by the new runner).
+    """
+    X, _ = pricing
+    cars = X.head(230)
+    source = tmp_path / "cars.csv"
+    cars.to_csv(source, index=False)
+
+    dead = make_runner(tmp_path, X, RecordingScorer())
+    job_id = dead.new_job()
+    dead.create(job_id, str(source), "csv", CHUNK_SIZE)
+    assert dead.store.claim(job_id, "dead-host:1", dead.stale_seconds)
+    dead.store.update(job_id, model_version="1")
+    chunks = pd.read_csv(source, chunksize=CHUNK_SIZE)
+    for index, chunk in enumerate(chunks):
+        if index in (0, 2):
+            dead._score_chunk(job_id, index, index * CHUNK_SIZE, "1", chunk)
+    # A live worker keeps its job, a worker without heartbeat for stale_seconds loses it
+    assert not dead.store.claim(job_id, "other-host:1", dead.stale_seconds)
+    dead.store.update(job_id, heartbeat=time.time() - 2 * dead.stale_seconds)
+
+    score = RecordingScorer()
+    runner = make_runner(tmp_path, X, score)
+    runner.start()
+    try:
+        job = wait_for(runner, job_id)
+    finally:
+        runner.stop()
+    assert job["status"] == "done", job["error"]
+    return runner, job_id, cars, score.chunks
+
+
+def test_resume_scores_only_missing_chunks(resumed_job):
+    runner, job_id, cars, scored_chunks = resumed_job
+    assert sorted(scored_chunks) == [1, 3, 4]
+    job = runner.store.get(job_id)
+    assert (job["nb_rows"], job["nb_rows_done"], job["nb_chunks_done"]) == (230, 230, 5)
+
+    result = pd.read_parquet(runner.result_path(job_id))
+    assert result["row"].tolist() == list(range(len(cars)))
+    assert result["prediction"].tolist() == cars["mileage"].astype(float).tolist()
+    assert not os.path.exists(os.path.join(runner.job_dir(job_id), "chunks"))
+
+
+def test_result_download(resumed_job, monkeypatch):
+    runner, job_id, cars, _ = resumed_job
+    monkeypatch.setattr(api, "jobs", runner)
+    client = TestClient(api.app) # no lifespan: the model is not loaded
+
+    response = client.get(f"/jobs/{job_id}/result", params={"format": "csv"})
+    assert response.status_code == 200 and response.headers["content-type"].startswith("text/csv")
+    result = pd.read_csv(io.StringIO(response.text))
+    assert result["row"].tolist() == list(range(len(cars)))
+    assert result["prediction"].tolist() == cars["mileage"].astype(float).tolist()
+
+    response = client.get(f"/jobs/{job_id}/result")
+    assert response.status_code == 200
+    pd.testing.assert_frame_equal(pd.read_parquet(io.BytesIO(response.content)), pd.read_parquet(runner.result_path(job_id)))
+
+    assert client.get(f"/jobs/{job_id}/result", params={"format": "json"}).status_code == 422
+    assert client.get("/jobs/unknown/result").status_code == 404
+
+
+def test_input_path_stays_in_input_folder(tmp_path):
+    input_dir, outside = tmp_path / "data", tmp_path / "secret.csv"
+    input_dir.mkdir()
+    (input_dir / "cars.csv").write_text("mileage\n1\n")
+    outside.write_text("mileage\n1\n")
+    os.symlink(outside, input_dir / "link.csv")
+
+    assert resolve_input_path("cars.csv", str(input_dir)) == os.path.realpath(input_dir / "cars.csv")
+    for path in ("../secret.csv", "sub/../../secret.csv", str(outside), "link.csv"):
+        with pytest.raises(ValueError, match="not in the input folder"):
+            resolve_input_path(path, str(input_dir))
+    with pytest.raises(ValueError, match="does not exist"):
+        resolve_input_path("missing.csv", str(input_dir))
+
+    response = TestClient(api.app).post("/jobs", data={"path": "../../../etc/passwd"})
+    assert response.status_code == 422 and "not in the input folder" in response.json()["detail"]
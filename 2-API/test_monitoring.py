@@ -0,0 +1,34 @@
+# Drift monitoring (monitoring.py): the queue of cars waiting to be counted is bounded by its number of cars
+# Terminal command : python -m pytest test_monitoring.py
+import time
+
+import pandas as pd
+
+from monitoring import DriftMonitor
+
+
+CAR = {"model_key": "Citroën", "mileage": 140411, "engine_power": 100}
+
+
+def test_queue_bounded_by_rows():
+    monitor = DriftMonitor(max_rows=100, log_interval=0)
+    batch = pd.DataFrame([CAR] * 60)
+    monitor.observe(batch)
+    monitor.observe(batch) # 120 cars waiting: dropped
+    monitor.observe({name: [value] * 30 for name, value in CAR.items()})
+    for _ in range(10):
+        monitor.observe(CAR, 50.0)
+    monitor.observe(CAR)
+    assert (monitor.queued_rows, monitor.nb_dropped) == (100, 2)
+
+    # Counted cars free the queue
+    monitor.start()
+    try:
+        deadline = time.monotonic() + 10
+        while monitor.queued_rows and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        monitor.stop()
+    assert monitor.queued_rows == 0 and monitor.report()["nb_observations"] == 100
+    monitor.observe(batch)
+    assert (monitor.queued_rows, monitor.nb_dropped) == (60, 2)
@@ -0,0 +1,73 @@
+# Cache of /predict results (prediction_cache.py): in-process backend, and Redis failures
+# Terminal command : python -m pytest test_prediction_cache.py
+import prediction_cache
+from prediction_cache import PredictionCache, LocalBackend, RedisBackend, cache_key
+
+
+CAR = {"model_key": "Citroën", "mileage": 140411, "engine_power": 100, "fuel": "diesel"}
+
+
+def test_hits_and_misses():
+    cache = PredictionCache(LocalBackend(max_entries=10, ttl=60))
+    assert cache.get(CAR, "1") is None
+    cache.set(CAR, "1", 106.5)
+    # Same features in another order: same key
+    assert cache.get(dict(reversed(list(CAR.items()))), "1") == 106.5
+    assert cache.get({**CAR, "mileage": 1}, "1") is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["size"], stats["errors"]) == (1, 2, 1, 0)
+
+
+def test_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(prediction_cache.time, "monotonic", lambda: now[0])
+    cache = PredictionCache(LocalBackend(max_entries=10, ttl=60))
+    cache.set(CAR, "1", 106.5)
+    now[0] += 59
+    assert cache.get(CAR, "1") == 106.5
+    now[0] += 2
+    assert cache.get(CAR, "1") is None
+    assert len(cache.backend) == 0
+
+
+def test_new_model_version():
+    cache = PredictionCache(LocalBackend(max_entries=10, ttl=60))
+    cache.set(CAR, "1", 106.5)
+    # The key contains the version: version 2 never reads a prediction of version 1
+    assert cache_key(CAR, "1") != cache_key(CAR, "2")
+    assert cache.get(CAR, "2") is None
+    # app.py empties the cache when a new version is loaded
+    cache.clear()
+    assert cache.get(CAR, "1") is None and cache.stats()["size"] == 0
+
+
+def test_lru_bound():
+    cache = PredictionCache(LocalBackend(max_entries=2, ttl=60))
+    cars = [{**CAR, "mileage": mileage} for mileage in range(3)]
+    cache.set(cars[0], "1", 0.0)
+    cache.set(cars[1], "1", 1.0)
+    cache.get(cars[0], "1") # cars[1] is now the least recently used
+    cache.set(cars[2], "1", 2.0)
+    assert [cache.get(car, "1") for car in cars] == [0.0, None, 2.0]
+    assert cache.stats()["size"] == 2 and cache.stats()["evictions"] == 1
+
+
+class DownClient:
+    # Redis client of a server that does not answer
+    def get(self, key):
+        raise TimeoutError("Timeout reading from socket")
+
+    def set(self, key, value, ex=None):
+        raise ConnectionError("Connection refused")
+
+    def scan_iter(self, match=None):
+        raise ConnectionError("Connection refused")
+
+
+def test_redis_failure_is_a_miss():
+    cache = PredictionCache(RedisBackend(client=DownClient(), ttl=60))
+    cache.set(CAR, "1", 106.5)
+    assert cache.get(CAR, "1") is None
+    cache.clear()
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["size"], stats["errors"]) == (0, 1, 0, 4)
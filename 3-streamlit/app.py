@@ -1,11 +1,15 @@
+import os
+import hashlib
 import streamlit as st
 import pandas as pd
 import plotly.express as px 
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 import numpy as np
-import pip
-pip.main(["install", "openpyxl"])
+
+from prepare_data import load_delay_data
+from threshold_engine import simulate_thresholds, COMPLETE_SCOPE
+from revenue_simulator import load_rental_revenue, RevenueIndex
 
 
 ### Config
@@ -15,8 +19,6 @@ st.set_page_config(
     layout="wide"
 )
 
-DATA_URL = ('https://full-stack-assets.s3.eu-west-3.amazonaws.com/Deployment/get_around_delay_analysis.xlsx')
-
 ### App
 st.title("Get Around Dashboard 🚗")
 
@@ -31,41 +33,38 @@ The goal of this dashboard is to help understanding what is the optimum threshol
 st.markdown("---")
 
 # load data
-df = pd.read_excel('https://full-stack-assets.s3.eu-west-3.amazonaws.com/Deployment/get_around_delay_analysis.xlsx', engine="openpyxl") 
-
-# Replacing NaN by 0 for "delay_at_checkout_in_minutes" and "previous_ended_rental_id"
-df["delay_at_checkout_in_minutes"] = df["delay_at_checkout_in_minutes"].fillna(0)
-df["previous_ended_rental_id"] = df["previous_ended_rental_id"].fillna(0)
-# Replacing NaN by very long value for "time_delta_with_previous_rental_in_minutes" to keep the raws and identify there is no next rent registered
-df["time_delta_with_previous_rental_in_minutes"] = df["time_delta_with_previous_rental_in_minutes"].fillna(5000)  
+# The Excel file is prepared once into a Feather file (see prepare_data.py): delay, prev_rent, rental,
+# previous rental columns (*_y) and impact are already computed. The source is checked for a new
+# version at most once per hour. Cached as a resource: all the sessions read the same (unmodified) frame
+@st.cache_resource(ttl=3600)
+def load_data():
+    return load_delay_data()
 
-# adding a column delay (1/0, keeping in mind no delay can be in advance), prev_rental (1/0) and rental (1/0 where 0 means canceled)
-df['delay'] = df['delay_at_checkout_in_minutes'].apply(lambda x: 1 if x >0 else 0)
-df["prev_rent"] = df["previous_ended_rental_id"].apply(lambda x: 1 if x >0 else 0)
-df["rental"] = df["state"].apply(lambda x: 1 if x == "ended" else 0)  
-
-# When there are 2 consecutive rents, let's put back the checking type and delay of the previous rent
-df_info_to_add = df[["rental_id", "checkin_type", "delay_at_checkout_in_minutes"]] #generating a second df to gather back the info about previous rent
-df_def = pd.merge(df, df_info_to_add, left_on="previous_ended_rental_id", right_on = "rental_id", how = "outer")
+st.subheader ("View the raw data here ⬇︎")
 
-# Replacing NaN by 0 or very long time, per same logic as above
-df_def["rental_id_y"] = df_def["rental_id_y"].fillna(0)
-df_def["checkin_type_y"] = df_def["checkin_type_y"].fillna(0)
-df_def["delay_at_checkout_in_minutes_y"] = df_def["delay_at_checkout_in_minutes_y"].fillna(5000)
-df_def = df_def.sort_values(by = "time_delta_with_previous_rental_in_minutes")
-df_def = df_def[df_def["state"] == "ended"] #remove canceled rents
+data_load_state = st.text('Loading data...')
+df_def, data_version = load_data()
+data = df_def
+data_load_state.text("") # change text from "Loading data..." to "" once the the load_data function has run
 
+# Revenue of each rental (daily price of the car given by the pricing model, see revenue_simulator.py)
+# and cumulative revenue per scope, computed once per dataset version. revenue_version (hash of the
+# revenue) is part of the cache key of everything computed from the revenue
+@st.cache_resource
+def load_revenue(_df_def, data_version):
+    revenue, pricing = load_rental_revenue(_df_def)
+    revenue_version = hashlib.sha1(revenue.tobytes()).hexdigest()[:8]
+    return revenue, revenue_version, RevenueIndex(_df_def, revenue), pricing
 
-# show raw data
-@st.cache(allow_output_mutation=True)
-def load_data(nrows):
-    return df_def
+revenue, revenue_version, revenue_index, pricing = load_revenue(df_def, data_version)
 
-st.subheader ("View the raw data here ⬇︎")
+# Rentals affected, cases solved, missed opportunities and revenue lost for every threshold and scope
+# (see threshold_engine.py) computed once per dataset and revenue version, all the threshold charts below read this table
+@st.cache_data
+def load_thresholds(_df_def, data_version, _revenue, revenue_version):
+    return simulate_thresholds(_df_def, revenue=_revenue)
 
-data_load_state = st.text('Loading data...')
-data = load_data(None)
-data_load_state.text("") # change text from "Loading data..." to "" once the the load_data function has run
+thresholds = load_thresholds(df_def, data_version, revenue, revenue_version)
 
 ## Run the below code if the check is checked ✅
 if st.checkbox('Show raw data'):
@@ -74,11 +73,114 @@ if st.checkbox('Show raw data'):
 
 
 # CHARTS
+# Figures that do not depend on a widget are built once per dataset version (cached, shared by the sessions).
+# The violin plots get at most MAX_CHART_POINTS rentals (random sample, same at every run), so the
+# figures sent to the browser stay the same size when the rental table grows.
+MAX_CHART_POINTS = int(os.environ.get("MAX_CHART_POINTS", 5000))
+
+def sample_for_chart(df, max_points=MAX_CHART_POINTS):
+    if len(df) <= max_points:
+        return df
+    rows = np.sort(np.random.default_rng(0).choice(len(df), max_points, replace=False))
+    return df.iloc[rows]
+
+def delayed_rentals(df):
+    # rents that had delay in previous rent (major outliers removed)
+    delay_to_keep = (df["delay_at_checkout_in_minutes_y"] > 0) & (df["delay_at_checkout_in_minutes_y"] < 1000)
+    has_prev_rent = df["prev_rent"] == 1
+    return df[delay_to_keep & has_prev_rent].reset_index(drop = True)
+
+def impact_violin(df_delay, title):
+    # Impact = "time_delta_with_previous_rental_in_minutes" - "delay_at_checkout_in_minutes_y". Negative means friction with next driver. The more negative, the more impact
+    # (column "impact" computed in prepare_data.py)
+    df_delay = sample_for_chart(df_delay)
+    return px.violin(df_delay,
+        x = df_delay["time_delta_with_previous_rental_in_minutes"],
+        y = df_delay["impact"],
+        title = title)
+
+def late_checkout_pie(df, title):
+    # rentals having delay from previous rent, and NOT having delay from previous rent
+    delay_prev = df[(df["delay_at_checkout_in_minutes_y"] > 0) & (df["delay_at_checkout_in_minutes_y"] < 5000)].shape[0]
+    no_delay_prev = df[df["previous_ended_rental_id"] > 0].shape[0]-delay_prev
+    return px.pie(values = [delay_prev, no_delay_prev], title = title, hole = 0.5, names = ["Delay", "No delay"])
+
+@st.cache_data
+def overview_figures(_df_def, _thresholds, data_version):
+    # Split mobile/connect and share of revenue potentially impacted (figures 1 to 3)
+    df_mobile = _df_def[_df_def["checkin_type_x"] == "mobile"]
+    df_connect = _df_def[_df_def["checkin_type_x"] == "connect"]
+    perc_mobile = df_mobile.shape[0]/_df_def.shape[0]*100
+    perc_connect = df_connect.shape[0]/_df_def.shape[0]*100
+
+    #Share of revenue having consecutive rents
+    tot = round(_df_def[_df_def["previous_ended_rental_id"] > 1].shape[0]/_df_def.shape[0] * 100 , 2)
+    mobile = round( df_mobile[df_mobile["previous_ended_rental_id"] > 1].shape[0] / df_mobile.shape[0] * 100 ,2)
+    connect = round( df_connect[df_connect["previous_ended_rental_id"] > 1].shape[0] / df_connect.shape[0] * 100 ,2)
+
+    x_data = [connect, mobile, tot]
+    y_data = ["connect", "mobile", "Complete scope"]
+    fig1 = px.bar(x=x_data, y=y_data,  orientation='h', title = "Share of revenue with consecutive rents (percent nb of rents)", text_auto = True, labels={"x": "% of revenue", "y":"scope"})
+
+    #Nb cars impacted by the feature
+    nb_car_impacted = _thresholds[_thresholds["scope"] == COMPLETE_SCOPE]
+    fig2 = px.area(
+    x = nb_car_impacted["threshold"],
+    y = nb_car_impacted["rentals_affected"],
+    labels = dict(x="Minutes between 2 rents", y= "Number of cars impacted"),
+    title ="Nb of rentals impacted according to threshold - Complete scope"
+    )
+
+    #Nb cars impacted by the feature splitting mobile / connect
+    nb_car_impacted_scope = _thresholds[_thresholds["scope"] != COMPLETE_SCOPE]
+    fig3 = px.scatter(nb_car_impacted_scope, x = "threshold", y = "rentals_affected", color = "scope",
+                labels = dict(threshold="Minutes between 2 rents", rentals_affected= "Number of cars impacted", scope = "Scope"),
+                title ="Nb of rentals impacted according to threshold - Mobile/Connect")
+    return perc_mobile, perc_connect, fig1, fig2, fig3
+
+@st.cache_data
+def late_checkout_figures(_df_def, data_version):
+    # Analysis of late check-outs on total scope (figure 4 and the 2 violin plots)
+    fig4 = late_checkout_pie(_df_def, "Delay in check-out - Complete scope")
+    df_delay = delayed_rentals(_df_def)
+    df_distribution = sample_for_chart(df_delay)
+    fig = px.violin(df_distribution,
+        y = df_distribution["delay_at_checkout_in_minutes_y"],
+        title ="Distribution (Major outliers removed)")
+    fig5 = impact_violin(df_delay, "Impact on the next driver  = time delta with prev rent - delay (minutes) - Complete scope")
+    return fig4, fig, fig5, len(df_delay)
+
+@st.cache_data
+def scope_figures(_df_def, data_version, scope):
+    # Same as the complete scope, for the rentals of one check-in type (figures 6 and 7)
+    df_def_scope = _df_def[_df_def["checkin_type_x"]==scope]
+    fig6 = late_checkout_pie(df_def_scope, "Delay in check-out - Mobile/ Connect")
+    fig6.update_traces(textinfo='value')
+    fig7 = impact_violin(delayed_rentals(df_def_scope), "Impact on the next driver  = time delta with prev rent - delay (minutes) - Mobile/ Connect")
+    return fig6, fig7
+
+@st.cache_data
+def cases_chart(_thresholds, data_version, scope, title):
+    # Problematic cases solved and missed opportunities (impact >= 0) depending on threshold, for one scope
+    cases = _thresholds[_thresholds["scope"] == scope]
+    fig = px.line(x = cases["threshold"], y = cases["cases_solved"], 
+                color = px.Constant("Nb problematic cases solved"), 
+                labels = dict(x="Minutes between 2 rents", y= "Number of cases", color = "Case"), 
+                title = title)
+    fig.add_scatter(x = cases["threshold"], y = cases["missed_opportunities"], name = "Missed opportunities")
+    return fig
+
+@st.cache_data
+def revenue_figure(_thresholds, data_version, revenue_version):
+    return px.line(_thresholds, x = "threshold", y = "revenue_lost", color = "scope",
+                labels = dict(threshold="Minutes between 2 rents", revenue_lost= "Revenue lost (€)", scope = "Scope"),
+                title ="Revenue of the rentals impacted according to threshold")
+
+
+perc_mobile, perc_connect, fig1, fig2, fig3 = overview_figures(df_def, thresholds, data_version)
 
 ## Split mobile/connect
 st.subheader("Split Mobile/ Connect (nb of rents)")
-perc_mobile = df_def[df_def["checkin_type_x"] == "mobile"].shape[0]/df_def.shape[0]*100
-perc_connect = df_def[df_def["checkin_type_x"] == "connect"].shape[0]/df_def.shape[0]*100
 
 col1, col2 = st.columns((1,5))
 with col1:
@@ -93,196 +195,104 @@ st.subheader("Share of revenue potentially impacted by the feature 💲")
 col1, col2, col3 = st.columns(3)
 
 with col1: #Share of revenue having consecutive rents
-    
-    df_mobile = df_def[df_def["checkin_type_x"] == "mobile"]
-    df_connect = df_def[df_def["checkin_type_x"] == "connect"]
-
-    tot = round(df_def[df_def["previous_ended_rental_id"] > 1].shape[0]/df_def.shape[0] * 100 , 2)
-    mobile = round( df_mobile[df_mobile["previous_ended_rental_id"] > 1].shape[0] / df_mobile.shape[0] * 100 ,2)
-    connect = round( df_connect[df_connect["previous_ended_rental_id"] > 1].shape[0] / df_connect.shape[0] * 100 ,2)
-
-    x_data = [connect, mobile, tot]
-    y_data = ["connect", "mobile", "Complete scope"]
-
-    fig1 = px.bar(df_def, x=x_data, y=y_data,  orientation='h', title = "Share of revenue with consecutive rents (percent nb of rents)", text_auto = True, labels={"x": "% of revenue", "y":"scope"})
     st.plotly_chart(fig1, use_container_width=True)
 
 with col2: #Nb cars impacted by the feature
-
-    nb_car_impacted = pd.DataFrame(df_def.groupby("time_delta_with_previous_rental_in_minutes")["time_delta_with_previous_rental_in_minutes"].count())
-    nb_car_impacted = nb_car_impacted.rename(columns = {"time_delta_with_previous_rental_in_minutes" : "cars_count"})
-    nb_car_impacted.reset_index(inplace = True)
-    nb_car_impacted["cumulated_cars_count"] = nb_car_impacted["cars_count"].cumsum()
-    nb_car_impacted = nb_car_impacted[nb_car_impacted["time_delta_with_previous_rental_in_minutes"]< 5000]
-
-    fig2 = px.area(
-    x = nb_car_impacted["time_delta_with_previous_rental_in_minutes"],
-    y = nb_car_impacted["cumulated_cars_count"],
-    labels = dict(x="Minutes between 2 rents", y= "Number of cars impacted"),
-    title ="Nb of rentals impacted according to threshold - Complete scope"
-    )
     st.plotly_chart(fig2, use_container_width=True)
 
 with col3: #Nb cars impacted by the feature splitting mobile / connect
-    nb_car_impacted_mob = pd.DataFrame(df_mobile.groupby("time_delta_with_previous_rental_in_minutes")["time_delta_with_previous_rental_in_minutes"].count())
-    nb_car_impacted_mob = nb_car_impacted_mob.rename(columns = {"time_delta_with_previous_rental_in_minutes" : "cars_count"})
-    nb_car_impacted_mob.reset_index(inplace = True)
-    nb_car_impacted_mob["cumulated_cars_count"] = nb_car_impacted_mob["cars_count"].cumsum()
-    nb_car_impacted_mob = nb_car_impacted_mob[nb_car_impacted_mob["time_delta_with_previous_rental_in_minutes"]< 5000]
-
-    nb_car_impacted_conn = pd.DataFrame(df_connect.groupby("time_delta_with_previous_rental_in_minutes")["time_delta_with_previous_rental_in_minutes"].count())
-    nb_car_impacted_conn = nb_car_impacted_conn.rename(columns = {"time_delta_with_previous_rental_in_minutes" : "cars_count"})
-    nb_car_impacted_conn.reset_index(inplace = True)
-    nb_car_impacted_conn["cumulated_cars_count"] = nb_car_impacted_conn["cars_count"].cumsum()
-    nb_car_impacted_conn = nb_car_impacted_conn[nb_car_impacted_conn["time_delta_with_previous_rental_in_minutes"]< 5000]
-
-    x = nb_car_impacted["time_delta_with_previous_rental_in_minutes"]
-    y1 = nb_car_impacted_mob["cumulated_cars_count"]
-    y2 = nb_car_impacted_conn["cumulated_cars_count"]
-
-    fig3 = px.scatter(x =x, y = y1, color = px.Constant("mobile"), labels = dict(x="Minutes between 2 rents", y= "Number of cars impacted", color = "Scope"),
-                title ="Nb of rentals impacted according to threshold - Mobile/Connect")
-    fig3.add_scatter(x =x, y = y2, name = "Connect")
-
     st.plotly_chart(fig3, use_container_width=True)
 
 
 ## Late check-outs
 st.subheader("Late check-outs ⌚")
+# The violin plots are the heaviest charts: only sent to the browser when asked
+show_distributions = st.checkbox("Show the distributions of delays (violin plots)")
 
 ### Create 3 columns - Analysis of late check-outs on total scope
+fig4, fig, fig5, nb_delayed = late_checkout_figures(df_def, data_version)
 col1, col2, col3 = st.columns((1,0.5,2))
 
 with col1: #share of late check_out, total scope
-    # rentals having delay from previous rent:
-    delay_prev = df_def[(df_def["delay_at_checkout_in_minutes_y"] > 0) & (df_def["delay_at_checkout_in_minutes_y"] < 5000)].shape[0]
-    # rentals NOT having delay from previous rent:
-    no_delay_prev = df_def[df_def["previous_ended_rental_id"] > 0].shape[0]-delay_prev  
-
-    fig4 = px.pie(df_def, values = [delay_prev, no_delay_prev], title = "Delay in check-out - Complete scope", hole = 0.5, names = ["Delay", "No delay"])
     st.plotly_chart(fig4, use_container_width=True)
 
-with col2: #Distribution of delays
-    # keeping only rents that had delay in previous rent
-    delay_to_keep = (df_def["delay_at_checkout_in_minutes_y"] > 0) & (df_def["delay_at_checkout_in_minutes_y"] < 1000)
-    has_prev_rent = df_def["prev_rent"] == 1
-    mask = (delay_to_keep) & (has_prev_rent)
-    df_delay = df_def[mask]
-    df_delay = df_delay.copy()
-
-    fig = px.violin(df_delay,
-        y = df_delay["delay_at_checkout_in_minutes_y"],
-        title ="Distribution (Major outliers removed)")
-    st.plotly_chart(fig, use_container_width=True)
-    
-with col3:# impact on next driver, total scope
-    # Impact = "time_delta_with_previous_rental_in_minutes" - "delay_at_checkout_in_minutes_y". Negative means friction with next driver. The more negative, the more impact
-    df_delay["impact"] = df_delay["time_delta_with_previous_rental_in_minutes"] -  df_delay["delay_at_checkout_in_minutes_y"]
-    df_delay = df_delay.reset_index(drop = True)    
-
-    fig5 = px.violin(df_delay,
-        x = df_delay["time_delta_with_previous_rental_in_minutes"],
-        y = df_delay["impact"],
-        title = "Impact on the next driver  = time delta with prev rent - delay (minutes) - Complete scope")
-    st.plotly_chart(fig5, use_container_width=True)
-
-### Create 2 columns - Analysis of late check-outs by scope
-col1, col2 = st.columns((1,2))
-
-with col1: #share of late check_out - select mobile or connect
-    scope = st.selectbox("Select a scope", df_def["checkin_type_x"].sort_values().unique())
-    df_def_scope = df_def[df_def["checkin_type_x"]==scope]
-
-    delay_prev_scope = df_def_scope[(df_def_scope["delay_at_checkout_in_minutes_y"] > 0) & (df_def_scope["delay_at_checkout_in_minutes_y"] < 5000)].shape[0]
-    no_delay_prev_scope = df_def_scope[df_def_scope["previous_ended_rental_id"] > 0].shape[0]-delay_prev_scope 
-
-    fig6 = px.pie(df_def_scope, values = [delay_prev_scope, no_delay_prev_scope], title = "Delay in check-out - Mobile/ Connect", hole = 0.5, names = ["Delay", "No delay"])
-    fig6.update_traces(textinfo='value')
-    st.plotly_chart(fig6, use_container_width=True)
-
-with col2: # impact on next driver, same filter applied as chart just above mobile or connect, same format as impact on next driver for total scope
-    delay_to_keep_scope = (df_def_scope["delay_at_checkout_in_minutes_y"] > 0) & (df_def_scope["delay_at_checkout_in_minutes_y"] < 1000)
-    has_prev_rent_scope = df_def_scope["prev_rent"] == 1
-    mask = (delay_to_keep_scope) & (has_prev_rent_scope)
-    df_delay_scope = df_def_scope[mask]
-    df_delay_scope = df_delay_scope.copy()
-
-    df_delay_scope["impact"] = df_delay_scope["time_delta_with_previous_rental_in_minutes"] -  df_delay_scope["delay_at_checkout_in_minutes_y"]
-    df_delay_scope = df_delay_scope.reset_index(drop = True)    
-
-    fig7 = px.violin(df_delay,
-        x = df_delay_scope["time_delta_with_previous_rental_in_minutes"],
-        y = df_delay_scope["impact"],
-        title = "Impact on the next driver  = time delta with prev rent - delay (minutes) - Mobile/ Connect")
-    st.plotly_chart(fig7, use_container_width=True)
-
-## Number of problematic cases solved
-st.subheader("Number of problematic cases solved ✔︎")
-### Create 2 columns: 1 on total scope, 1 on scope selected per above
-col1, col2 = st.columns(2)
-
-with col1: # total scope
-    # problematic scope are where impact(defined above) is negative
-    problematic = df_delay[df_delay["impact"] < 0]
-
-    # group by time "time_delta_with_previous_rental_in_minutes", count cumulated cases
-    nb_cases_solved = pd.DataFrame(problematic.groupby("time_delta_with_previous_rental_in_minutes")["time_delta_with_previous_rental_in_minutes"].count())
-    nb_cases_solved = nb_cases_solved.rename(columns = {"time_delta_with_previous_rental_in_minutes" : "cases_counts"})
-    nb_cases_solved.reset_index(inplace = True)
-    nb_cases_solved["cumulated_cases_count"] = nb_cases_solved["cases_counts"].cumsum()
-
-    # missed opportunities calculated on total number rentals, where impact is positive
-    df_def["impact"] = df_def["time_delta_with_previous_rental_in_minutes"] -  df_def["delay_at_checkout_in_minutes_y"]
-    missed_opportunity = df_def[df_def["impact"] >= 0]
-
-    # group by time "time_delta_with_previous_rental_in_minutes", count cumulated cases
-    nb_missed_opportunity = pd.DataFrame(missed_opportunity.groupby("time_delta_with_previous_rental_in_minutes")["time_delta_with_previous_rental_in_minutes"].count())
-    nb_missed_opportunity = nb_missed_opportunity.rename(columns = {"time_delta_with_previous_rental_in_minutes" : "cases_counts"})
-    nb_missed_opportunity.reset_index(inplace = True)
-    nb_missed_opportunity["cumulated_cases_count"] = nb_missed_opportunity["cases_counts"].cumsum()
-
-    x = nb_cases_solved["time_delta_with_previous_rental_in_minutes"]
-    y1 = nb_cases_solved["cumulated_cases_count"]
-    y2 = nb_missed_opportunity["cumulated_cases_count"]
-
-    fig8 = px.line(x =x, y = y1, 
-                color = px.Constant("Nb problematic cases solved"), 
-                labels = dict(x="Minutes between 2 rents", y= "Number of cases", color = "Case"), 
-                title ="Nb of cases solved depending on threshold - Complete scope")
-    fig8.add_scatter(x =x, y = y2, name = "Missed opportunities")
-
-    st.plotly_chart(fig8, use_container_width=True)
-
-with col2: # filter on scope, per filter applied at section "late check-outs"
-    # Same logic as on total scope
-    problematic_scope = df_delay_scope[df_delay_scope["impact"] < 0]
-    problematic_scope = problematic_scope.copy()
-
-    nb_cases_solved_scope = pd.DataFrame(problematic_scope.groupby("time_delta_with_previous_rental_in_minutes")["time_delta_with_previous_rental_in_minutes"].count())
-    nb_cases_solved_scope = nb_cases_solved_scope.rename(columns = {"time_delta_with_previous_rental_in_minutes" : "cases_counts"})
-    nb_cases_solved_scope.reset_index(inplace = True)
-    nb_cases_solved_scope["cumulated_cases_count"] = nb_cases_solved_scope["cases_counts"].cumsum()
-
-    df_def_scope["impact"] = df_def_scope["time_delta_with_previous_rental_in_minutes"] -  df_def_scope["delay_at_checkout_in_minutes_y"]
-    missed_opportunity_scope = df_def_scope[df_def_scope["impact"] >= 0]
-
-    nb_missed_opportunity_scope = pd.DataFrame(missed_opportunity_scope.groupby("time_delta_with_previous_rental_in_minutes")["time_delta_with_previous_rental_in_minutes"].count())
-    nb_missed_opportunity_scope = nb_missed_opportunity_scope.rename(columns = {"time_delta_with_previous_rental_in_minutes" : "cases_counts"})
-    nb_missed_opportunity_scope.reset_index(inplace = True)
-    nb_missed_opportunity_scope["cumulated_cases_count"] = nb_missed_opportunity_scope["cases_counts"].cumsum()
-
-    x = nb_cases_solved_scope["time_delta_with_previous_rental_in_minutes"]
-    y1 = nb_cases_solved_scope["cumulated_cases_count"]
-    y2 = nb_missed_opportunity_scope["cumulated_cases_count"]
-
-    fig9 = px.line(x =x, y = y1, 
-                color = px.Constant("Nb problematic cases solved"), 
-                labels = dict(x="Minutes between 2 rents", y= "Number of cases", color = "Case"), 
-                title ="Nb of cases solved depending on threshold - Mobile/connect")
-    fig9.add_scatter(x =x, y = y2, name = "Missed opportunities")
-
-    st.plotly_chart(fig9, use_container_width=True)
-    st.markdown("""(Per filter applied on graphs section 'late check-outs')""")
+if show_distributions:
+    with col2: #Distribution of delays
+        st.plotly_chart(fig, use_container_width=True)
+
+    with col3:# impact on next driver, total scope
+        st.plotly_chart(fig5, use_container_width=True)
+        if nb_delayed > MAX_CHART_POINTS:
+            st.markdown(f"""(Random sample of {MAX_CHART_POINTS} of the {nb_delayed} late check-outs)""")
+
+
+# Only this part runs again when another scope is selected (the charts above are not rebuilt nor sent again)
+@st.fragment
+def scope_section(show_distributions):
+    ### Create 2 columns - Analysis of late check-outs by scope
+    col1, col2 = st.columns((1,2))
+
+    with col1: #share of late check_out - select mobile or connect
+        scope = st.selectbox("Select a scope", df_def["checkin_type_x"].sort_values().unique())
+        fig6, fig7 = scope_figures(df_def, data_version, scope)
+        st.plotly_chart(fig6, use_container_width=True)
+
+    with col2: # impact on next driver, same filter applied as chart just above mobile or connect, same format as impact on next driver for total scope
+        if show_distributions:
+            st.plotly_chart(fig7, use_container_width=True)
+
+    ## Number of problematic cases solved
+    st.subheader("Number of problematic cases solved ✔︎")
+    ### Create 2 columns: 1 on total scope, 1 on scope selected per above
+    col1, col2 = st.columns(2)
+
+    with col1: # total scope
+        fig8 = cases_chart(thresholds, data_version, COMPLETE_SCOPE, "Nb of cases solved depending on threshold - Complete scope")
+        st.plotly_chart(fig8, use_container_width=True)
+
+    with col2: # filter on scope, per filter applied at section "late check-outs"
+        fig9 = cases_chart(thresholds, data_version, scope, "Nb of cases solved depending on threshold - Mobile/connect")
+        st.plotly_chart(fig9, use_container_width=True)
+        st.markdown("""(Per filter applied on graphs section 'late check-outs')""")
+
+scope_section(show_distributions)
+
+
+## Revenue impact
+# Only this part runs again when the slider moves
+@st.fragment
+def revenue_section():
+    st.subheader("Revenue lost depending on threshold 💶")
+    ### Create 2 columns: revenue lost for the threshold selected, revenue lost for all thresholds
+    col1, col2 = st.columns((1,2))
+
+    with col1: # read from the cumulative revenue, no computation when the slider moves
+        threshold = st.slider("Threshold (minutes)", min_value=0, max_value=720, value=60, step=15)
+        for revenue_scope in revenue_index.scopes:
+            lost = revenue_index.revenue_lost(threshold, revenue_scope)
+            total = revenue_index.total_revenue(revenue_scope)
+            share = lost / total * 100 if total else 0
+            st.metric(f"Revenue lost - {revenue_scope}", f"{lost:,.0f} €", f"-{share:.1f} % of revenue", delta_color="off")
+
+    with col2: # cached figure (a copy at each call), only the threshold line is added
+        fig10 = revenue_figure(thresholds, data_version, revenue_version)
+        fig10.add_vline(x = threshold, line_dash = "dash")
+        st.plotly_chart(fig10, use_container_width=True)
+
+revenue_section()
+
+if pricing["priced_by_model"]:
+    st.markdown("""(Each rental is valued at the daily price of its car given by the pricing model)""")
+else:
+    st.markdown("""(Features of the cars not available: each rental is valued at the average daily price of the pricing dataset)""")
+# Degraded revenue: API unreachable (prices of the last scoring, if any) or cars refused by the pricing model
+if pricing["error"] is not None:
+    st.warning(f"The pricing API could not be used ({pricing['error']}): the prices of the last scoring are used, if any.")
+if pricing["rejected_cars"]:
+    rejected_cars = pricing["rejected_cars"]
+    st.warning(f"{len(rejected_cars)} cars refused by the pricing API are valued at the average daily price.")
+    with st.expander("Cars refused by the pricing API"):
+        st.dataframe(pd.DataFrame({"car_id": list(rejected_cars), "reason": list(rejected_cars.values())}))
 
 # Separator
 st.markdown("---")
@@ -316,6 +326,7 @@ st.sidebar.markdown("""
     * [Share of revenue potentially impacted by the feature](#share-of-revenue-potentially-impacted-by-the-feature)
     * [Late check-outs](#late-check-outs)
     * [Number of problematic cases solved](#number-of-problematic-cases-solved)
+    * [Revenue lost depending on threshold](#revenue-lost-depending-on-threshold)
     * [Conclusion](#conclusion)
 """)
 e = st.sidebar.empty()
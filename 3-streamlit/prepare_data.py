@@ -0,0 +1,168 @@
+# Data preparation for the dashboard
+# The delay analysis Excel file is downloaded and prepared once, then stored as a Feather file
+# (columnar, memory-mappable) that the dashboard loads in milliseconds. The file is rebuilt only
+# when the source changes (ETag / Last-Modified of the URL, or modification time of a local file).
+# The source is checked at most every DATA_MAX_AGE seconds: a fresher file is used without any request.
+#
+# Terminal command to build (or refresh) the file: python prepare_data.py
+import os
+import json
+import time
+import hashlib
+import argparse
+import urllib.request
+from datetime import datetime, timezone
+
+import pandas as pd
+import pyarrow.feather as feather
+
+
+DATA_URL = os.environ.get("DATA_URL", 'https://full-stack-assets.s3.eu-west-3.amazonaws.com/Deployment/get_around_delay_analysis.xlsx')
+DATA_CACHE_PATH = os.environ.get("DATA_CACHE_PATH", "data/get_around_delay_analysis.feather")
+# Seconds during which the file is used without checking the source again (0 = checked at each load)
+DATA_MAX_AGE = float(os.environ.get("DATA_MAX_AGE", 600))
+
+# Value used for "no previous rental" in time delta and previous delay columns
+NO_PREVIOUS_RENTAL = 5000
+
+
+def source_fingerprint(source):
+    """
+    Identifies the version of the source without downloading it: ETag (or Last-Modified) of a URL,
+    modification time of a local file.
+    """
+    if source.startswith(("http://", "https://")):
+        request = urllib.request.Request(source, method="HEAD")
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.headers.get("ETag") or response.headers.get("Last-Modified")
+    return str(os.path.getmtime(source))
+
+
+def prepare(df):
+    """
+    Builds the dataset used by the dashboard: one row per ended rental, with the check-in type
+    and the delay of the previous rental of the same car (columns *_y), sorted by time delta.
+    """
+    # Replacing NaN by 0 for "delay_at_checkout_in_minutes" and "previous_ended_rental_id"
+    df["delay_at_checkout_in_minutes"] = df["delay_at_checkout_in_minutes"].fillna(0)
+    df["previous_ended_rental_id"] = df["previous_ended_rental_id"].fillna(0)
+    # Replacing NaN by very long value for "time_delta_with_previous_rental_in_minutes" to keep the raws and identify there is no next rent registered
+    df["time_delta_with_previous_rental_in_minutes"] = df["time_delta_with_previous_rental_in_minutes"].fillna(NO_PREVIOUS_RENTAL)
+
+    # adding a column delay (1/0, keeping in mind no delay can be in advance), prev_rental (1/0) and rental (1/0 where 0 means canceled)
+    df["delay"] = (df["delay_at_checkout_in_minutes"] > 0).astype(int)
+    df["prev_rent"] = (df["previous_ended_rental_id"] > 0).astype(int)
+    df["rental"] = (df["state"] == "ended").astype(int)
+
+    # When there are 2 consecutive rents, let's put back the checking type and delay of the previous rent
+    # (left join: rentals that are only someone's previous rental are removed below with canceled rents anyway)
+    df_info_to_add = df[["rental_id", "checkin_type", "delay_at_checkout_in_minutes"]]
+    df_def = pd.merge(df, df_info_to_add, left_on="previous_ended_rental_id", right_on="rental_id", how="left")
+
+    # Replacing NaN by 0 or very long time, per same logic as above ("0" as text to keep one type per column)
+    df_def["rental_id_y"] = df_def["rental_id_y"].fillna(0)
+    df_def["checkin_type_y"] = df_def["checkin_type_y"].fillna("0")
+    df_def["delay_at_checkout_in_minutes_y"] = df_def["delay_at_checkout_in_minutes_y"].fillna(NO_PREVIOUS_RENTAL)
+
+    # Impact on next driver = time delta with previous rent - delay of previous rent. Negative means friction
+    df_def["impact"] = df_def["time_delta_with_previous_rental_in_minutes"] - df_def["delay_at_checkout_in_minutes_y"]
+
+    df_def = df_def[df_def["state"] == "ended"] #remove canceled rents
+    df_def = df_def.sort_values(by="time_delta_with_previous_rental_in_minutes", kind="stable")
+    return df_def.reset_index(drop=True)
+
+
+def read_metadata(cache_path):
+    try:
+        with open(cache_path + ".json") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_metadata(cache_path, metadata):
+    with open(cache_path + ".json.tmp", "w") as f:
+        json.dump(metadata, f)
+    os.replace(cache_path + ".json.tmp", cache_path + ".json")
+
+
+def file_metadata(cache_path):
+    """
+    Metadata of a cache file whose .json is missing or unreadable (e.g. file copied alone): the version
+    comes from the modification time of the file.
+    """
+    mtime = os.path.getmtime(cache_path)
+    return {
+        "source": None,
+        "fingerprint": None,
+        "built_at": datetime.fromtimestamp(mtime, timezone.utc).isoformat(),
+        "nb_rows": feather.read_table(cache_path, memory_map=True).num_rows,
+        "version": hashlib.sha1(f"{cache_path}|{mtime}".encode()).hexdigest()[:8],
+    }
+
+
+def build_cache(source=DATA_URL, cache_path=DATA_CACHE_PATH, force=False, max_age=DATA_MAX_AGE):
+    """
+    Rebuilds the cache file if the source changed since the last build (checked at most every max_age
+    seconds). Returns the metadata of the cache file (source, fingerprint, build date, time of the last
+    check and "version" of the dataset).
+    """
+    metadata = read_metadata(cache_path)
+    cached = os.path.exists(cache_path) and "version" in metadata
+    if not force and cached and time.time() - metadata.get("checked_at", 0) < max_age:
+        return metadata
+    try:
+        fingerprint = source_fingerprint(source)
+    except OSError:
+        # Source unreachable: keep the file already built if any
+        if cached:
+            return metadata
+        if os.path.exists(cache_path):
+            return file_metadata(cache_path)
+        raise
+
+    if not force and cached and metadata.get("fingerprint") == fingerprint:
+        metadata["checked_at"] = time.time()
+        write_metadata(cache_path, metadata)
+        return metadata
+
+    df = pd.read_excel(source, engine="openpyxl")
+    df_def = prepare(df)
+
+    os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+    # Uncompressed Feather can be memory-mapped: loading does not copy the columns. Written under another name
+    # then renamed: a dashboard or a build running at the same time never reads a partial file (and the
+    # file memory-mapped by a running dashboard is not modified)
+    df_def.to_feather(cache_path + ".tmp", compression="uncompressed")
+    os.replace(cache_path + ".tmp", cache_path)
+
+    metadata = {
+        "source": source,
+        "fingerprint": fingerprint,
+        "built_at": datetime.now(timezone.utc).isoformat(),
+        "nb_rows": len(df_def),
+        "checked_at": time.time(),
+    }
+    # Short id of the dataset version, used as cache key by the dashboard
+    metadata["version"] = hashlib.sha1(f"{source}|{fingerprint}".encode()).hexdigest()[:8]
+    write_metadata(cache_path, metadata)
+    return metadata
+
+
+def load_delay_data(source=DATA_URL, cache_path=DATA_CACHE_PATH):
+    """
+    Returns (prepared dataset, dataset version), rebuilding the cache file first if needed.
+    """
+    metadata = build_cache(source, cache_path)
+    return feather.read_feather(cache_path, memory_map=True), metadata["version"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prepare the delay analysis dataset for the dashboard")
+    parser.add_argument("--source", default=DATA_URL, help="URL or path of the Excel file")
+    parser.add_argument("--out", default=DATA_CACHE_PATH, help="Path of the prepared Feather file")
+    parser.add_argument("--force", action="store_true", help="Rebuild even if the source did not change")
+    args = parser.parse_args()
+
+    metadata = build_cache(args.source, args.out, force=args.force)
+    print(f"{metadata['nb_rows']} rentals prepared in {args.out} (version {metadata['version']})")
@@ -0,0 +1,160 @@
+# Revenue impact of the threshold
+# Each rental of the delay dataset is valued with the daily price of its car given by the pricing
+# model (/predict/batch endpoint of the API). Cars are priced once and the prices are kept in a file,
+# then the revenue of every rental is stored in cumulative arrays so that the revenue lost for any
+# threshold and scope is read in O(log n), e.g. when the threshold slider moves.
+#
+# The delay dataset only has a car_id: the features of the cars (columns of the /predict endpoint)
+# come from CAR_FEATURES_PATH (CSV with a car_id column). Cars without features are valued at
+# DEFAULT_DAILY_PRICE, the average daily price of the pricing dataset, like the cars refused by the API
+# (e.g. 422 for a category unknown by the model). Rentals have no duration in the dataset, so one rental = one day of rent.
+import os
+import json
+import urllib.error
+import urllib.request
+
+import numpy as np
+import pandas as pd
+import pyarrow.feather as feather
+
+from threshold_engine import scope_masks
+
+
+PRICING_API_URL = os.environ.get("PRICING_API_URL", "https://apiga.herokuapp.com")
+CAR_FEATURES_PATH = os.environ.get("CAR_FEATURES_PATH")
+CAR_PRICES_PATH = os.environ.get("CAR_PRICES_PATH", "data/car_prices.feather")
+# Average rental_price_per_day of get_around_pricing_project.csv
+DEFAULT_DAILY_PRICE = float(os.environ.get("DEFAULT_DAILY_PRICE", 121.2))
+# Number of cars sent in one call to /predict/batch
+SCORING_BATCH_SIZE = 5000
+# Answers of the API to invalid cars: the batch is split to find them (any other error stops the scoring)
+INVALID_CARS_STATUS = (400, 422)
+
+
+def call_api(path, payload=None):
+    # payload: JSON string, sent with POST
+    data = payload.encode() if payload is not None else None
+    request = urllib.request.Request(PRICING_API_URL.rstrip("/") + path, data=data,
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=120) as response:
+        return json.load(response)
+
+
+def error_detail(error):
+    # "detail" of the JSON body of an HTTPError of the API (messages of a list of validation errors), or its reason
+    try:
+        detail = json.load(error)["detail"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return str(error.reason)
+    if isinstance(detail, list):
+        return "; ".join(str(item.get("msg", item)) if isinstance(item, dict) else str(item) for item in detail)
+    return str(detail)
+
+
+def price_batch(batch, rejected):
+    """
+    Prices of a batch of cars (list of Series indexed by car_id). A batch refused by the API as invalid is
+    split in 2 until the cars refused are found: they are added to rejected {car_id: reason}, not priced.
+    """
+    try:
+        response = call_api("/predict/batch", batch.drop(columns="car_id").to_json(orient="records"))
+    except urllib.error.HTTPError as error:
+        if error.code not in INVALID_CARS_STATUS:
+            raise
+        if len(batch) == 1:
+            rejected[batch["car_id"].iloc[0]] = error_detail(error)
+            return []
+        middle = len(batch) // 2
+        return price_batch(batch.iloc[:middle], rejected) + price_batch(batch.iloc[middle:], rejected)
+    return [pd.Series(response["predictions"], index=batch["car_id"].to_numpy())]
+
+
+def read_car_prices(path=CAR_PRICES_PATH):
+    """
+    Returns (prices of the cars already priced, indexed by car_id, model version used).
+    """
+    if not os.path.exists(path):
+        return pd.Series(dtype=float), None
+    prices = feather.read_feather(path)
+    with open(path + ".json") as f:
+        model_version = json.load(f)["model_version"]
+    return prices.set_index("car_id")["price"], model_version
+
+
+def score_cars(car_features, path=CAR_PRICES_PATH):
+    """
+    Daily price of each car (Series indexed by car_id) and cars refused by the API ({car_id: reason}).
+    Only the cars not priced yet by the current model version are sent to the API, by batches of
+    SCORING_BATCH_SIZE cars. The refused cars are not kept: they are sent again at the next scoring.
+    """
+    prices, priced_version = read_car_prices(path)
+    model_version = call_api("/model")["version"]
+    if model_version != priced_version:
+        prices = pd.Series(dtype=float) # new model: every car is priced again
+
+    to_score = car_features[~car_features["car_id"].isin(prices.index)]
+    new_prices, rejected = [], {}
+    for start in range(0, len(to_score), SCORING_BATCH_SIZE):
+        new_prices += price_batch(to_score.iloc[start:start + SCORING_BATCH_SIZE], rejected)
+    if not new_prices:
+        return prices, rejected
+
+    prices = pd.concat([prices] + new_prices)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    prices.rename_axis("car_id").rename("price").reset_index().to_feather(path)
+    with open(path + ".json", "w") as f:
+        json.dump({"model_version": model_version}, f)
+    return prices, rejected
+
+
+def rental_revenue(df_def, car_prices=None):
+    """
+    Revenue of each rental of df_def (same order): daily price of its car, DEFAULT_DAILY_PRICE if unknown.
+    """
+    if car_prices is None or car_prices.empty:
+        return np.full(len(df_def), DEFAULT_DAILY_PRICE)
+    return df_def["car_id"].map(car_prices).fillna(DEFAULT_DAILY_PRICE).to_numpy()
+
+
+def load_rental_revenue(df_def):
+    """
+    Revenue of each rental, with the cars priced by the pricing model when CAR_FEATURES_PATH is set.
+    Returns (revenue array, pricing): pricing gives if the pricing model was used ("priced_by_model"),
+    the cars refused by the API ("rejected_cars", {car_id: reason}) and why the API could not be used ("error").
+    """
+    pricing = {"priced_by_model": False, "rejected_cars": {}, "error": None}
+    if CAR_FEATURES_PATH is None:
+        return rental_revenue(df_def), pricing
+    car_features = pd.read_csv(CAR_FEATURES_PATH)
+    car_features = car_features[car_features["car_id"].isin(df_def["car_id"].unique())]
+    try:
+        car_prices, pricing["rejected_cars"] = score_cars(car_features)
+    except OSError as error:
+        # API unreachable or failing: use the prices already computed, if any
+        pricing["error"] = f"{type(error).__name__}: {error}"
+        car_prices, _ = read_car_prices()
+    pricing["priced_by_model"] = not car_prices.empty
+    return rental_revenue(df_def, car_prices), pricing
+
+
+class RevenueIndex:
+    """
+    Cumulative revenue of the rentals sorted by time delta with the previous rental, per scope.
+    The revenue lost with a threshold T is the revenue of the rentals with a time delta <= T
+    (those consecutive rentals could not be booked anymore).
+    """
+    def __init__(self, df_def, revenue):
+        delta = df_def["time_delta_with_previous_rental_in_minutes"].to_numpy()
+        self.scopes = {}
+        for scope, mask in scope_masks(df_def).items():
+            order = np.argsort(delta[mask], kind="stable")
+            self.scopes[scope] = (delta[mask][order], np.cumsum(revenue[mask][order]))
+
+    def total_revenue(self, scope):
+        cumulated = self.scopes[scope][1]
+        return float(cumulated[-1]) if len(cumulated) else 0.0
+
+    def revenue_lost(self, threshold, scope):
+        delta, cumulated = self.scopes[scope]
+        nb_rentals = np.searchsorted(delta, threshold, side="right")
+        return float(cumulated[nb_rentals - 1]) if nb_rentals else 0.0
@@ -0,0 +1,137 @@
+# Threshold simulation for the dashboard
+# For every candidate threshold (minimum minutes between 2 rentals) and every scope (complete scope
+# or one check-in type), counts how many rentals would be affected, how many problematic cases would
+# be solved and how many opportunities would be missed. All counts come from one binning of the
+# time deltas, instead of one groupby + cumsum per chart.
+# The same counts are exported for the API (endpoint /delay/threshold) as sorted arrays, see save_threshold_index.
+#
+# Terminal command to export the index for the API: python threshold_engine.py --out ../2-API/data/delay_index.npz
+import os
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from prepare_data import NO_PREVIOUS_RENTAL
+
+
+COMPLETE_SCOPE = "Complete scope"
+METRICS = ["rentals_affected", "cases_solved", "missed_opportunities"]
+
+# Previous rentals with a delay above this value are considered as outliers (not a friction case)
+MAX_DELAY = 1000
+
+
+def scope_masks(df_def):
+    """
+    Rows of each scope: complete scope, then one scope per check-in type (connect, mobile).
+    """
+    checkin_type = df_def["checkin_type_x"].to_numpy()
+    masks = {COMPLETE_SCOPE: np.ones(len(df_def), dtype=bool)}
+    for scope in np.sort(df_def["checkin_type_x"].unique()):
+        masks[scope] = checkin_type == scope
+    return masks
+
+
+def metric_masks(df_def):
+    """
+    Rows counted by each metric, for a threshold above their time delta:
+    - rentals_affected: all the rentals
+    - cases_solved: rentals whose previous rental was late (delay between 0 and MAX_DELAY) and
+      the delay was longer than the time between the 2 rentals (impact < 0)
+    - missed_opportunities: rentals whose previous rental was returned in time (impact >= 0)
+    """
+    delay_prev = df_def["delay_at_checkout_in_minutes_y"].to_numpy()
+    impact = df_def["impact"].to_numpy()
+    late_prev = (delay_prev > 0) & (delay_prev < MAX_DELAY) & (df_def["prev_rent"].to_numpy() == 1)
+    return {
+        "rentals_affected": np.ones(len(df_def), dtype=bool),
+        "cases_solved": late_prev & (impact < 0),
+        "missed_opportunities": impact >= 0,
+    }
+
+
+def default_thresholds(df_def):
+    # Every time delta observed between 2 rentals
+    delta = df_def["time_delta_with_previous_rental_in_minutes"].to_numpy()
+    return np.unique(delta[delta < NO_PREVIOUS_RENTAL])
+
+
+def simulate_thresholds(df_def, thresholds=None, revenue=None):
+    """
+    Returns one tidy table: scope, threshold, rentals_affected, cases_solved, missed_opportunities.
+    A rental is counted for a threshold when its time delta with the previous rental is lower or equal.
+    With the revenue of each rental (see revenue_simulator.py), the table also has revenue_lost:
+    revenue of the rentals affected.
+    """
+    thresholds = default_thresholds(df_def) if thresholds is None else np.sort(np.asarray(thresholds))
+    delta = df_def["time_delta_with_previous_rental_in_minutes"].to_numpy()
+
+    # Index of the first threshold a rental is counted for (len(thresholds) = never counted)
+    first_threshold = np.searchsorted(thresholds, delta, side="left")
+
+    metrics = metric_masks(df_def)
+    tables = []
+    for scope, scope_mask in scope_masks(df_def).items():
+        table = {"scope": scope, "threshold": thresholds}
+        for metric in METRICS:
+            counts = np.bincount(first_threshold[scope_mask & metrics[metric]], minlength=len(thresholds) + 1)
+            table[metric] = np.cumsum(counts[:len(thresholds)])
+        if revenue is not None:
+            revenue_lost = np.bincount(first_threshold[scope_mask], weights=revenue[scope_mask], minlength=len(thresholds) + 1)
+            table["revenue_lost"] = np.cumsum(revenue_lost[:len(thresholds)])
+        tables.append(pd.DataFrame(table))
+    return pd.concat(tables, ignore_index=True)
+
+
+def threshold_index(df_def, revenue=None):
+    """
+    Sorted time deltas of the rentals counted by each metric, per scope: the value of a metric for any
+    threshold T is the number of deltas <= T (binary search), and revenue_lost the cumulative revenue of
+    the rentals at that position. Rentals without previous rental are never affected and are left out.
+    Scopes are numbered in the order of the "scopes" array (keys rentals_affected_0, cases_solved_0...).
+    """
+    delta = df_def["time_delta_with_previous_rental_in_minutes"].to_numpy()
+    has_previous = delta < NO_PREVIOUS_RENTAL
+    metrics = metric_masks(df_def)
+    masks = scope_masks(df_def)
+    arrays = {
+        "scopes": np.array(list(masks)),
+        "nb_rentals": np.array([mask.sum() for mask in masks.values()]),
+    }
+    if revenue is not None:
+        arrays["total_revenue"] = np.array([revenue[mask].sum() for mask in masks.values()])
+    for i, scope_mask in enumerate(masks.values()):
+        for metric in METRICS:
+            arrays[f"{metric}_{i}"] = np.sort(delta[scope_mask & has_previous & metrics[metric]])
+        if revenue is not None:
+            rows = scope_mask & has_previous
+            order = np.argsort(delta[rows], kind="stable")
+            arrays[f"revenue_lost_{i}"] = np.cumsum(revenue[rows][order])
+    return arrays
+
+
+def save_threshold_index(df_def, path, data_version, revenue=None):
+    # .npz file read by 2-API/delay_index.py (no pandas needed to query it). Written under another name then
+    # renamed: the API, which reloads the file when it changes, never reads a partial index
+    with open(path + ".tmp", "wb") as f:
+        np.savez(f, data_version=np.array(data_version), **threshold_index(df_def, revenue))
+    os.replace(path + ".tmp", path)
+
+
+if __name__ == "__main__":
+    from prepare_data import load_delay_data
+
+    parser = argparse.ArgumentParser(description="Export the threshold index of the delay dataset for the API")
+    parser.add_argument("--out", default="data/delay_index.npz", help="Path of the index file")
+    parser.add_argument("--with-revenue", action="store_true", help="Add the revenue lost (see revenue_simulator.py)")
+    args = parser.parse_args()
+
+    df_def, data_version = load_delay_data()
+    revenue = None
+    if args.with_revenue:
+        from revenue_simulator import load_rental_revenue
+        revenue, _ = load_rental_revenue(df_def)
+    os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+    save_threshold_index(df_def, args.out, data_version, revenue)
+    print(f"Threshold index of {len(df_def)} rentals (version {data_version}) written in {args.out}")